@@ -12,24 +12,48 @@ import time
 import datetime
 import os
 import shutil
-import platform
-import configparser
-import queue
+import threading
+import collections
 
-libname_christoph = 'C:\Program Files\Pico Technology\PicoScope6\ps4000A.dll'
-libname_micha = 'C:\Program Files (x86)\Pico Technology\PicoScope6\ USBDrDAQ.dll'
-libname_pokini = '/opt/picoscope/lib/libps4000a.so'
+from ringbuffer import RingBuffer
+from conversion import Converter
+from metrics import Metrics
+from decimation import Decimator, DECIMATION_TIERS
+from driver import BUFFER_CALLBACK, load_library
+from config import RELOADABLE, RANGE_VOLTS, MAX_Y, load_config, sample_rate_string
+# recorder, sharedring, simdriver, streamserver and asyncio are imported where they are used, they cost startup time
 
 parameterfilestring = 'parameters.ini'
 
-codedirectory_pokini = '/home/kipfer/pqpico'
-datadirectory_pokini = '/home/kipfer/pqpico/Data'
+# Directories, looked up when a run starts: set them here or with the environment
+# variables DRDAQ_CODEDIRECTORY and DRDAQ_DATADIRECTORY, by default ~/pqpico and ~/pqpico/Data
+# The driver library is found as described in driver.py
+CODEDIRECTORY = None
+DATADIRECTORY = None
 
 
-# if 1, prints diagnostics to standard output
-VERBOSE = 1
-# If 1, generates profile.txtpicotec
-PROFILING = 0 # Attention, may redirect standard print output, restart python kernel if output disappears
+# if 1, prints diagnostics to standard output, the streaming hot path does not print
+VERBOSE = 0
+# If 1, collects metrics of the streaming hot path, see get_metrics() and metrics.py
+PROFILING = 0
+# If 1, or with the environment variable DRDAQ_SIMULATE=1, streams from simdriver.SimulatedLibrary
+# when there is no driver library or no unit. Otherwise opening raises OpenError
+SIMULATE = 0
+
+# Opening waits at most READY_TIMEOUT seconds for the unit to answer ps4000aPingUnit, polling every READY_POLL seconds
+READY_TIMEOUT = 0.2
+READY_POLL = 0.001
+
+# Streaming settings (sample interval, buffer sizes, poll interval, channels) come from parameters.ini,
+# see config.py. While streaming, the acquisition thread checks it for changes every CONFIG_CHECK_INTERVAL seconds
+CONFIG_CHECK_INTERVAL = 1.0
+
+# Seconds between two reports of the drift of the sample clock against the system clock, see get_drift
+DRIFT_REPORT_INTERVAL = 10.0
+
+# asyncio interface: blocks buffered per stream() consumer, seconds a driver wait may block an executor thread
+STREAM_QUEUE_SIZE = 8
+STREAM_WAIT_TIMEOUT = 0.1
 
 ## Constants of PS2000.dll
 # channel identifiers
@@ -59,27 +83,27 @@ RANGE_50V   = 11 # 50 V
 RANGE_100V   = 12 # 100 V
 RANGE_200V   = 13 # 200 V
 
-# map the range the the scale factor
-RANGE_SCALE_MAP = {
-RANGE_20mV  : 0.02,
-RANGE_50mV  : 0.05,
-RANGE_100mV : 0.1,
-RANGE_200mV : 0.2,
-RANGE_500mV : 0.5,
-RANGE_1V    : 1.0,
-RANGE_2V    : 2.0,
-RANGE_5V    : 5.0,
-RANGE_10V   : 10.0,
-RANGE_20V   : 20.0,
-}
+# Full scale in volts of the range codes: config.RANGE_VOLTS
 
 #analog offset inital valiue
 ANALOG_OFFSET_0V = 0# 0V offset
 
-# Y Resolution Limits
-MAX_Y = 32768
+# Y Resolution Limits, MAX_Y is config.MAX_Y
 MIN_Y = -32767
 
+# Trigger directions of ps4000aSetSimpleTrigger
+TRIGGER_ABOVE = 0
+TRIGGER_BELOW = 1
+TRIGGER_RISING = 2
+TRIGGER_FALLING = 3
+TRIGGER_RISING_OR_FALLING = 4
+
+# Downsampling modes of ps4000aRunStreaming
+RATIO_MODE_NONE = 0
+RATIO_MODE_AGGREGATE = 1
+RATIO_MODE_DECIMATE = 2
+RATIO_MODE_AVERAGE = 4
+
 # Time Units
 FEMTOSECONDS = 0
 PICOSECONDS = 1
@@ -88,98 +112,200 @@ MICROSECONDS = 3
 MILLISECONDS = 4
 SECONDS = 5
 
-# Strings for Sample Rate
-SAMPLERATE_MAP = {
-0:'T',
-1:'G',
-2:'M',
-3:'k',
-4:'',
-5:'',
-}
-
-# Set the correct dll as  LIBNAME
-if sys.platform == 'win32':
-    LIBNAME = libname_micha
-else:
-    LIBNAME = libname_pokini
-    DATADIRECTORY = datadirectory_pokini     
-     
-class DRDAQ:
-    def __init__(self):
-        # These can be overridden by parameters.ini:
-        self.handle = None
-        self.channels = [0,0]
-        #self.streaming_sample_interval = ctypes.c_uint(1)
-        #self.streaming_sample_interval_unit = 3
-        #self.streaming_buffer_length = 10000000
-        
-        # Load and apply parameters from the parameters.ini-file in the codedirectory
-        #self.apply_parameters()
-        #self.streaming_sample_interval = ctypes.c_uint(self.streaming_sample_interval)
-                
-
-        # load the library
-        if platform.system() == 'Windows':
-            self.lib = ctypes.windll.LoadLibrary(LIBNAME)
-        elif platform.system() == 'Linux':
-            self.lib = ctypes.cdll.LoadLibrary(LIBNAME)
-        else:
-            print('Unknown Platform')
+def get_codedirectory():
+    return CODEDIRECTORY or os.environ.get('DRDAQ_CODEDIRECTORY') or os.path.expanduser('~/pqpico')
+
+
+def get_datadirectory():
+    return DATADIRECTORY or os.environ.get('DRDAQ_DATADIRECTORY') or os.path.join(get_codedirectory(),'Data')
 
-        if VERBOSE:
-            print(self.__dict__)
 
-        # Load the library
+def get_simulate():
+    return bool(SIMULATE) or os.environ.get('DRDAQ_SIMULATE', '0') not in ('', '0')
+
+
+class OpenError(OSError):
+    '''no unit could be opened and the simulator is not enabled, see SIMULATE'''
+
+
+class DRDAQ:
+    def __init__(self, serial=None, libname=None, lib=None, metrics=None, config=None):
+        '''serial: open the unit with this serial number, None opens the first unit found
+        lib: use this library object instead of loading libname, e.g. a simdriver.SimulatedLibrary
+        metrics: metrics.Metrics registry, by default one that is enabled if PROFILING is set
+        config: config.Config or path of a parameters.ini, by default parameters.ini in the code directory'''
+        self.handle = None
+        self.serial = serial
+        self.libname = libname
+        # 1 for every enabled channel A-H, settings of each channel as set in set_channel
+        self.channels = [0]*8
+        self.channel_settings = {}
+        self.enabled_channels = []
+
+        # Settings of parameters.ini, parsed and checked once
+        if config is None or isinstance(config, str):
+            config = load_config(config or os.path.join(get_codedirectory(),parameterfilestring))
+        self.config = config
+        # set by reload_config if settings wait for the next run
+        self.config_waiting = False
+
+        # Load the library once per process, the simulated one if there is none and SIMULATE is set
         try:
-            if platform.system() == 'Windows':
-                self.lib = ctypes.windll.LoadLibrary(LIBNAME)
-            elif platform.system() == 'Linux':
-                self.lib = ctypes.cdll.LoadLibrary(LIBNAME)
+            if lib is not None:
+                self.lib = lib
             else:
-                print('Unknown Platform')
-            self.fakeDataMode = False
+                self.lib = load_library(self.libname)
         except OSError:
+            if not get_simulate():
+                raise
             print('\nNo Picoscope library found, switching to fake data mode\n')
-            self.fakeDataMode = True
-
-        # Open Data Queue
-        self.dataqueue = queue.queue()
+            from simdriver import SimulatedLibrary
+            self.lib = SimulatedLibrary()
+        # without simdriver imported the library cannot be a simulated one
+        simdriver = sys.modules.get('simdriver')
+        self.fakeDataMode = simdriver is not None and isinstance(self.lib, simdriver.SimulatedLibrary)
+
+        # Metrics of the hot path, all of them are no-ops if the registry is disabled
+        self.metrics = metrics if metrics is not None else Metrics(enabled=bool(PROFILING))
+        self.metric_callback_duration = self.metrics.histogram('callback_duration_seconds', 'Duration of the buffer callback')
+        self.metric_samples = self.metrics.counter('samples_total', 'Samples per channel received from the driver')
+        self.metric_blocks = self.metrics.counter('callbacks_total', 'Buffer callbacks')
+        self.metric_queue_depth = self.metrics.gauge('queue_depth_samples', 'Samples in the ring buffer not yet read')
+        self.metric_overflows = self.metrics.counter('vertical_overflows_total', 'Callbacks that reported a vertical overflow')
+        self.metric_dropped = self.metrics.counter('dropped_samples_total', 'Samples dropped because the ring buffer was full')
+        self.metric_recorder_dropped = self.metrics.counter('recorder_dropped_blocks_total', 'Blocks the recorder could not take')
+        self.metric_drift = self.metrics.gauge('clock_drift_seconds', 'System clock minus sample clock at the newest value')
+        self.metric_drift_ppm = self.metrics.gauge('clock_drift_ppm', 'Drift of the system clock against the sample clock')
+
+        # The ring buffer for the streamed data is created in set_data_buffer
+        self.ringbuffer = None
+        self.channel_data = None
+        self.channel_arrays = {}
+        # Counts to volts for the enabled channels, created in set_data_buffer
+        self.converter = None
+        # Downsampling of the driver, the aggregate mode delivers a maximum and a minimum row per channel
+        self.ratio_mode = RATIO_MODE_NONE
+        self.downsample_ratio = 1
+        # Software decimation into preview tiers, see set_decimation
+        self.decimator = None
+        # Shared memory ring for subscribers in other processes, see publish
+        self.publisher = None
+        # Publishers ended by stop_publishing while the callback may still write to them,
+        # released by the acquisition thread between two driver polls
+        self.ended_publishers = collections.deque()
+        # Socket server for clients in other programs, see serve_stream
+        self.stream_server = None
+
+        # Acquisition thread, started by run_streaming and stopped by stop_sampling
+        self.acquisition_thread = None
+        self.stop_event = threading.Event()
+        self.data_event = threading.Event()
+        self.poll_interval = config.poll_interval
+        # Hot reload of parameters.ini, see reload_config
+        self.config_mtime = self.get_config_mtime()
+        self.config_checked = 0.0
+        self.pending_config = None
+
+        # The callback is constructed once and kept referenced as long as the object lives,
+        # the driver must never call into a garbage collected CFUNCTYPE
+        self.buffer_callback = self.construct_buffer_callback()
+
+        # asyncio interface, see start(), stop() and stream()
+        self.stream_queues = []
+        self.pump_task = None
+
+        # Session folder of the run in the data directory, None if run_streaming(session=False)
+        self.folder = None
+        # Recorder for the streamed blocks, created by run_streaming(record=True)
+        self.recorder = None
+        # Process pool of the compressing recorder, started by the first run_streaming(compress=True)
+        # before the driver and the acquisition thread run, shut down by close_unit
+        self.compress_pool = None
+        # Timing of a run, set by run_streaming: every value has its index in the stream,
+        # its time is anchor_ns + index*interval_fs/10**6, see get_sample_time_ns
+        self.start_time = None
+        self.anchor_ns = None
+        self.interval_fs = None
+        # Values per channel received from the driver in this run, the index of the next value
+        self.samples_received = 0
+        # (ring buffer write count, stream index - ring index) after every block the ring buffer
+        # could not take completely, the consumer maps ring positions to stream indices with it
+        # Consecutive lost blocks share one entry, so without a consumer there is only one
+        self.ring_gaps = collections.deque()
+        self.stream_offset = 0
+        self.block_index = 0
+        # Sample clock against system clock, see get_drift
+        self.drift = None
+        self.drift_checked = 0.0
+        # Sample indices of the hardware trigger events, see get_trigger_events
+        self.trigger_events = []
 
         # open the picoscope
         self.handle = self.open_unit()
-        self.set_channel()
+        self.apply_config()
         self.get_Timebase()
-        self.set_data_buffer()
 
         # make sure all settings are applied by the picoscope
-        time.sleep(0.2)
-
-# Load parameters from parameters.ini
-    def apply_parameters(self):
-        if VERBOSE:
-            print('\n==== apply_parameters ====')
-        confparser = configparser.ConfigParser()
-        confparser.read(parameterfilestring)
-        inisections = confparser.sections()
-
-        self.parameters = {}
-
-        for section in inisections:
+        self.wait_ready()
+
+# Apply all settings of self.config: sample interval, buffer length, channels, decimation
+    def apply_config(self):
+        config = self.config
+        self.streaming_sample_interval = ctypes.c_uint(config.sample_interval)
+        self.streaming_sample_interval_unit = config.sample_interval_unit
+        self.streaming_buffer_length = config.buffer_length
+        for channel in range(len(self.channels)):
+            if channel in config.channels:
+                self.set_channel(**config.get_channel_settings(channel))
+            elif self.channels[channel]:
+                self.set_channel(channel, enabled=False)
+        self.set_data_buffer(mode=self.ratio_mode)
+        self.set_decimation(config.decimation_tiers or None)
+        self.config_waiting = False
+
+# Reload parameters.ini while streaming: the RELOADABLE settings apply at once, between two driver polls,
+# the others only at the next run. Returns the changed settings that have to wait for the next run
+# A broken file raises config.ConfigError and leaves the running settings alone
+    def reload_config(self, path=None):
+        config = load_config(path or self.config.path)
+        waiting = [key for key in self.config.changes(config) if key not in RELOADABLE]
+        if waiting:
+            self.config_waiting = True
             if VERBOSE:
-                print('-- ['+section+']')
-            for parameter in confparser.options(section):
-                value = confparser.get(section,parameter)
-                if VERBOSE:
-                    print('   - '+parameter+' : '+value)
-                self.parameters[parameter] = int(value)
+                print(' Settings applied at the next run: '+', '.join(waiting))
+        if self.acquisition_thread is None:
+            self.apply_reloadable(config)
+        else:
+            # picked up by the acquisition thread, the only thread that calls the callback
+            self.pending_config = config
+        return waiting
+
+    def apply_reloadable(self, config):
+        self.poll_interval = config.poll_interval
+        if config.decimation_tiers != self.config.decimation_tiers:
+            self.set_decimation(config.decimation_tiers or None)
+        self.config = config
+
+    def get_config_mtime(self):
+        if self.config.path is None or not os.path.exists(self.config.path):
+            return None
+        return os.path.getmtime(self.config.path)
 
-        # Make all parameters self variables:
-        self.__dict__.update(self.parameters)
+    def check_config(self):
+        '''reloads parameters.ini if it changed since it was read'''
+        self.config_checked = time.perf_counter()
+        mtime = self.get_config_mtime()
+        if mtime == self.config_mtime:
+            return
+        self.config_mtime = mtime
+        try:
+            self.reload_config()
+        except ValueError as e:
+            print(' parameters.ini not reloaded: '+str(e))
 
-# return parameters dictionary
+# Settings of parameters.ini as read at the start or the last reload
     def get_parameters(self):
-        return self.parameters
+        return self.config
 
 # Basic Open and Close operations
     def open_unit(self):
@@ -187,14 +313,14 @@ class DRDAQ:
         if VERBOSE == 1:
             print('==== open_unit ====')
 
-        # If fake Data is enabled, ignore everything:
-        if self.fakeDataMode:
-            pass
-            return 0
-    
-        # Open Picoscope:
+        # Open Picoscope, a specific one if a serial number is given:
         self.handle = ctypes.c_int16()
-        picoStatus = self.lib.UsbDrDaqOpenUnit(ctypes.byref(self.handle))
+        if self.serial is None:
+            picoStatus = self.lib.UsbDrDaqOpenUnit(ctypes.byref(self.handle))
+            self.record_status('UsbDrDaqOpenUnit', picoStatus)
+        else:
+            picoStatus = self.lib.ps4000aOpenUnit(ctypes.byref(self.handle), ctypes.c_char_p(self.serial.encode()))
+            self.record_status('ps4000aOpenUnit', picoStatus)
         if VERBOSE:
             print(' PicoStatus: '+str(picoStatus))
             print(' Handle is '+str(self.handle.value))
@@ -212,26 +338,55 @@ class DRDAQ:
                 if VERBOSE:
                     print(' OK: Supply mode changed')
                     
-        # Handle Error Cases
-        if self.handle.value == -1:
-            print(' Failed to open oscilloscope')
-        elif self.handle.value == 0:
-            print(' No oscilloscope found')
-            self.fakeDataMode = True
+        # Handle Error Cases, the simulator takes over only if SIMULATE is set
+        if self.handle.value in (-1, 0):
+            if self.handle.value == -1:
+                message = 'Failed to open oscilloscope, status '+str(picoStatus)
+            else:
+                message = 'No oscilloscope found'
+            print(' '+message)
+            if self.fakeDataMode or not get_simulate():
+                raise OpenError(message)
             print('\nNo Picoscope found, switching to fake data mode\n')
-        print(self.handle)
+            self.fakeDataMode = True
+            from simdriver import SimulatedLibrary
+            self.lib = SimulatedLibrary()
+            return self.open_unit()
+        if VERBOSE:
+            print(self.handle)
 
         return self.handle
 
+    def wait_ready(self, timeout=READY_TIMEOUT):
+        '''polls ps4000aPingUnit until the unit answers, returns False after timeout seconds'''
+        end = time.perf_counter()+timeout
+        while True:
+            res = self.lib.ps4000aPingUnit(self.handle)
+            if res == 0:
+                return True
+            if time.perf_counter() > end:
+                self.record_status('ps4000aPingUnit', res)
+                if VERBOSE:
+                    print(' Unit not ready: '+str(res))
+                return False
+            time.sleep(READY_POLL)
+
     def close_unit(self):
         '''close the interface to the unit'''
         if VERBOSE == 1:
             print('==== close_unit ====')
-        if self.fakeDataMode:
-            return
 
+        # no callback may run while the publisher and the buffers go away
+        self.stop_acquisition_thread()
+        self.stop_serving_stream()
+        self.stop_publishing()
+        if self.compress_pool is not None:
+            self.compress_pool.shutdown()
+            self.compress_pool = None
         res = self.lib.ps4000aCloseUnit(self.handle.value)
-        print(' '+str(res))
+        self.record_status('ps4000aCloseUnit', res)
+        if VERBOSE:
+            print(' '+str(res))
         self.handle = None
         return res
         
@@ -247,148 +402,256 @@ class DRDAQ:
         if VERBOSE:
             print('==== SetChannel ====')
 
-        if self.fakeDataMode:
-            return
+        # Remember the settings of the channel, they apply to the whole run
+        self.channels[channel] = 1 if enabled else 0
+        self.channel_settings[channel] = {'enabled':enabled, 'dc':dc, 'vertrange':vertrange, 'analogOffset':analogOffset}
+        # a new range or offset of a channel in the buffers changes its volts at once, like for the recorder
+        if self.converter is not None and channel in self.row_channels:
+            self.converter = Converter(*self.get_channel_scales())
 
         try:
             res = self.lib.ps4000aSetChannel(self.handle, channel, enabled, dc, vertrange, analogOffset)
-            if channel == PS4000_CHANNEL_A:
-                self.channels[0] = 1
-            elif channel == PS4000_CHANNEL_B:
-                self.channels[1] = 1
+            self.record_status('ps4000aSetChannel', res)
             if VERBOSE == 1:
                 print(' Channel set to Channel '+str(channel))
                 print(' Status of setChannel '+str(res)+' (0 = PICO_OK)')
         finally:
             pass
         
-# Set Data Buffer for each channel of the PS4824 scope      
-    def set_data_buffer(self, channel=PS4000_CHANNEL_A, segmentIndex=0, mode=0):
-        print('==== SetDataBuffer ====')
-
-        if self.fakeDataMode:
-            return
+# Set Data Buffers for all enabled channels of the PS4824 scope
+# All channels share one contiguous (rows, samples) array, one row per enabled channel
+# In the aggregate mode the maxima of all channels are followed by their minima, see row_channels
+    def set_data_buffer(self, segmentIndex=0, mode=RATIO_MODE_NONE):
+        if VERBOSE:
+            print('==== SetDataBuffer ====')
 
         bufferlength = self.streaming_buffer_length
-        try:
-            if channel == PS4000_CHANNEL_A: #channel A is set
-                self.channel_A_buffer=(ctypes.c_short * bufferlength)()
-                #self.streaming_buffer_length = bufferlength
-                res = self.lib.ps4000aSetDataBuffer(self.handle,channel,ctypes.byref(self.channel_A_buffer),self.streaming_buffer_length,segmentIndex,mode)
-            if channel == PS4000_CHANNEL_B: #channel B is set
-                self.channel_B_buffer=(ctypes.c_short * bufferlength)()
-                #self.streaming_buffer_length = bufferlength
-                res = self.lib.ps4000aSetDataBuffer(self.handle,channel,ctypes.byref(self.channel_B_buffer),self.streaming_buffer_length,segmentIndex,mode)
-            if channel == PS4000_CHANNEL_C: #channel C is set
-                self.channel_C_buffer=(ctypes.c_short * bufferlength)()
-                #self.streaming_buffer_length = bufferlength
-                res = self.lib.ps4000aSetDataBuffer(self.handle,channel,ctypes.byref(self.channel_C_buffer),self.streaming_buffer_length,segmentIndex,mode)
-            if channel == PS4000_CHANNEL_D: #channel D is set
-                self.channel_D_buffer=(ctypes.c_short * bufferlength)()
-                #self.streaming_buffer_length = bufferlength
-                res = self.lib.ps4000aSetDataBuffer(self.handle,channel,ctypes.byref(self.channel_D_buffer),self.streaming_buffer_length,segmentIndex,mode)
-            if channel == PS4000_CHANNEL_E: #channel E is set
-                self.channel_E_buffer=(ctypes.c_short * bufferlength)()
-                #self.streaming_buffer_length = bufferlength
-                res = self.lib.ps4000aSetDataBuffer(self.handle,channel,ctypes.byref(self.channel_E_buffer),self.streaming_buffer_length,segmentIndex,mode)
-            if channel == PS4000_CHANNEL_F: #channel F is set
-                self.channel_F_buffer=(ctypes.c_short * bufferlength)()
-                #self.streaming_buffer_length = bufferlength
-                res = self.lib.ps4000aSetDataBuffer(self.handle,channel,ctypes.byref(self.channel_F_buffer),self.streaming_buffer_length,segmentIndex,mode)
-            if channel == PS4000_CHANNEL_G: #channel G is set
-                self.channel_G_buffer=(ctypes.c_short * bufferlength)()
-                #self.streaming_buffer_length = bufferlength
-                res = self.lib.ps4000aSetDataBuffer(self.handle,channel,ctypes.byref(self.channel_G_buffer),self.streaming_buffer_length,segmentIndex,mode)
-            if channel == PS4000_CHANNEL_H: #channel H is set
-                self.channel_H_buffer=(ctypes.c_short * bufferlength)()
-                #self.streaming_buffer_length = bufferlength
-                res = self.lib.ps4000aSetDataBuffer(self.handle,channel,ctypes.byref(self.channel_H_buffer),self.streaming_buffer_length,segmentIndex,mode)
+        self.enabled_channels = [channel for channel in range(len(self.channels)) if self.channels[channel]]
+        self.ratio_mode = mode
+        self.row_channels = list(self.enabled_channels)
+        if mode == RATIO_MODE_AGGREGATE:
+            self.row_channels += self.enabled_channels
+        nchannels = len(self.row_channels)
+
+        self.channel_data = np.zeros((nchannels,bufferlength), dtype=np.int16)
+        # numpy views on the rows, one per channel (the maxima in the aggregate mode)
+        self.channel_arrays = dict(zip(self.enabled_channels, self.channel_data))
+        self.channel_min_arrays = {}
+        if mode == RATIO_MODE_AGGREGATE:
+            self.channel_min_arrays = dict(zip(self.enabled_channels, self.channel_data[len(self.enabled_channels):]))
+
+        # Conversion factors of the enabled channels, fixed for the run
+        self.converter = Converter(*self.get_channel_scales())
+
+        # Fixed size ring buffer between the callback and the consumer
+        capacity = self.config.ring_buffer_blocks*bufferlength
+        if self.ringbuffer is None or self.ringbuffer.data.shape != (nchannels,capacity):
+            self.ringbuffer = RingBuffer(capacity, channels=nchannels)
+
+        if self.decimator is not None:
+            self.set_decimation(list((tier.kind, tier.factor) for tier in self.decimator.tiers.values()))
+        # subscribers see the end of the old stream and have to attach again
+        if self.publisher is not None and self.publisher.data.shape != (nchannels,self.config.ring_buffer_blocks*bufferlength):
+            name = self.publisher.name
+            self.stop_publishing()
+            self.publish(name)
 
-            if VERBOSE:
-                print(' Result: '+str(res)+' (0 = PICO_OK)')
+        try:
+            for channel, row in self.channel_arrays.items():
+                if mode == RATIO_MODE_AGGREGATE:
+                    res = self.lib.ps4000aSetDataBuffers(self.handle,channel,row.ctypes.data_as(ctypes.POINTER(ctypes.c_short)),
+                            self.channel_min_arrays[channel].ctypes.data_as(ctypes.POINTER(ctypes.c_short)),bufferlength,segmentIndex,mode)
+                    self.record_status('ps4000aSetDataBuffers', res)
+                else:
+                    res = self.lib.ps4000aSetDataBuffer(self.handle,channel,row.ctypes.data_as(ctypes.POINTER(ctypes.c_short)),bufferlength,segmentIndex,mode)
+                    self.record_status('ps4000aSetDataBuffer', res)
+                if VERBOSE:
+                    print(' Channel '+'ABCDEFGH'[channel]+' Result: '+str(res)+' (0 = PICO_OK)')
         finally:
             pass     
 
+# Channel metadata of the run, the rows of every block follow enabled_channels
+    def get_channel_info(self):
+        factors, offsets = self.get_channel_scales()
+        return [dict(self.channel_settings[channel], channel=channel, scale=factor)
+                for channel, factor in zip(self.enabled_channels, factors)]
+
+# Volts per count and analog offset in volts of each row of the blocks
+    def get_channel_scales(self):
+        factors = [RANGE_VOLTS[self.channel_settings[channel]['vertrange']]/MAX_Y for channel in self.row_channels]
+        offsets = [self.channel_settings[channel]['analogOffset'] for channel in self.row_channels]
+        return factors, offsets
+
+# Software decimation of the stream into tiers of (kind, factor), see decimation.py
+# The tiers are computed in the callback from every block, independent of the raw consumer
+# New tiers start at the next sample of the stream, tiers=None switches the decimation off
+    def set_decimation(self, tiers=DECIMATION_TIERS):
+        if tiers is None:
+            self.decimator = None
+        else:
+            self.decimator = Decimator(self.channel_data.shape[0], tiers, origin=self.samples_received)
+        return self.decimator
+
+# Shared memory fan-out: every block is also copied once into a ring that other processes
+# read with sharedring.Subscriber(name), without pickling and without slowing down the callback
+    def publish(self, name=None):
+        '''returns the sharedring.Publisher, its name is the one to attach to'''
+        if self.publisher is None:
+            from sharedring import Publisher
+            self.publisher = Publisher(name, self.channel_data.shape[0], self.config.ring_buffer_blocks*self.streaming_buffer_length)
+            if self.anchor_ns is not None:
+                self.set_publisher_timing()
+        return self.publisher
+
+    def set_publisher_timing(self):
+        # the publisher counts the samples since it was created, its current write_count is the next stream index
+        self.publisher.set_timing(self.anchor_ns, self.interval_fs, self.samples_received-self.publisher.write_count)
+
+# Streaming server: the blocks in binary frames to clients on a local TCP port or Unix socket path,
+# see streamserver.py. It reads the shared memory ring of publish(), the consumers in this process are not affected
+    def serve_stream(self, address=('127.0.0.1', 9465)):
+        '''returns the streamserver.StreamServer, its address is the one to connect to'''
+        if self.stream_server is None:
+            from streamserver import StreamServer
+            self.stream_server = StreamServer(self, address)
+        return self.stream_server
+
+    def stop_serving_stream(self):
+        if self.stream_server is not None:
+            self.stream_server.close()
+            self.stream_server = None
+
+    def stop_publishing(self):
+        # detached first, the callback takes self.publisher once per block
+        publisher, self.publisher = self.publisher, None
+        if publisher is None:
+            return
+        publisher.end()
+        if self.acquisition_thread is None or self.acquisition_thread is threading.current_thread():
+            publisher.release()
+        else:
+            self.ended_publishers.append(publisher)
+
+    def release_publishers(self):
+        while self.ended_publishers:
+            self.ended_publishers.popleft().release()
+
+# New values of a tier as (rows, values) array, e.g. get_tier_data('minmax100')
+    def get_tier_data(self, name, n=None):
+        return self.decimator.get_data(name, n)
+
+# Sample index and time of the first value last returned by get_tier_data
+    def get_tier_start(self, name):
+        sampleIndex = self.decimator.get_start(name)
+        return sampleIndex, self.get_sample_time_ns(sampleIndex)/1e9
+
     def construct_buffer_callback(self):
-        # Buffer callback C function template
-        C_BUFFER_CALLBACK = ctypes.CFUNCTYPE(
-                None,
-                ctypes.c_int16,
-                ctypes.c_int32,
-                ctypes.c_uint32,
-                ctypes.c_int16,
-                ctypes.c_uint32,
-                ctypes.c_int16,
-                ctypes.c_int16,
-                ctypes.c_void_p)
-        
-        # Callback function
+        # Callback function, of the C function type driver.BUFFER_CALLBACK
         def get_buffer_callback(handle, noOfSamples, startIndex, overflow, triggerAt, triggered, autoStop, pParameter):
-            
-            if overflow:
-                print(' Vertical Overflow')
-            #filename = time.strftime("%Y%m%d_%H_%M_%S_%f.csv")
-            filename=datetime.datetime.now()
-            filename= filename.strftime("%Y%m%d_%H_%M_%S_%f")
-            CH1='CH1_' + filename 
-            #CH2='CH2_' + filename
-            
-            if VERBOSE:
-                print('------------------')
-                print(' startIndex = '+str(startIndex))
-                print(' Number of samples collected: '+str(noOfSamples))
-                print(' Value of first sample: '+str(self.channel_A_buffer[startIndex]))
-            
-            #create array from buffer
-            data_CH1 = self.channel_A_buffer[startIndex:startIndex+noOfSamples]
-            if VERBOSE:
-                print('--> Number of samples saved: '+str(len(data_CH1)))
-
-            self.dataqueue.put(data_CH1)
-            if VERBOSE:
-                print('Dataqueue size: '+str(self.dataqueue.qsize()))
-            #np.save(os.path.join(self.folder,filename),data_CH1)
-            #np.save(path2,streamed_data_CH2)
-            #print('File saved:',CH1,CH2)
-            
+            # no output in here, everything worth knowing goes into the metrics
+            metricsEnabled = self.metrics.enabled
+            if metricsEnabled:
+                called = time.perf_counter()
+
+            #copy the new samples of all channels from the driver buffer into the ring buffer
+            data = self.channel_data[:,startIndex:startIndex+noOfSamples]
+            if triggered:
+                # triggerAt counts from startIndex
+                self.trigger_events.append(self.samples_received+triggerAt)
+            stored = self.ringbuffer.write(data)
+            if stored < noOfSamples:
+                # the rest of the block is lost, the next value in the ring is further on in the stream
+                gap = (self.ringbuffer.write_count, self.samples_received+noOfSamples-self.ringbuffer.write_count)
+                if self.ring_gaps and self.ring_gaps[-1][0] == gap[0]:
+                    # nothing stored since the last gap (the ring is full), it just got longer
+                    self.ring_gaps[-1] = gap
+                else:
+                    self.ring_gaps.append(gap)
+            self.samples_received += noOfSamples
+            decimator = self.decimator
+            if decimator is not None:
+                decimator.process(data)
+            publisher = self.publisher
+            if publisher is not None:
+                publisher.write(data)
+            self.data_event.set()
+
+            if metricsEnabled:
+                self.metric_blocks.inc()
+                self.metric_samples.inc(noOfSamples)
+                if overflow:
+                    self.metric_overflows.inc()
+                if stored < noOfSamples:
+                    self.metric_dropped.inc(noOfSamples-stored)
+                self.metric_queue_depth.set(self.ringbuffer.lag())
+                self.metric_callback_duration.observe(time.perf_counter()-called)
             return 0
             
-        return C_BUFFER_CALLBACK(get_buffer_callback)
+        return BUFFER_CALLBACK(get_buffer_callback)
 
 # Running and Retrieving Data NOTE: Bufferlength must be the same as set in set_data_buffer function
-    def run_streaming(self, downSampleRatio=1, downSampleRatioMode=0):
+# session=False streams without a session folder in the data directory, e.g. for a replay, then nothing can be recorded
+    def run_streaming(self, downSampleRatio=1, downSampleRatioMode=0, pollInterval=None, record=False, compress=False,
+                      preTriggerSamples=0, postTriggerSamples=0, autoStop=0, session=True):
         if VERBOSE:
             print('==== RunStreaming ====')
-
-        if self.fakeDataMode:
-            return
+        if record and not session:
+            raise ValueError('recording needs a session folder')
+        if record and compress and self.compress_pool is None:
+            import recorder
+            self.compress_pool = recorder.start_pool()
+
+        if self.config_waiting:
+            self.apply_config()
+        if pollInterval is not None:
+            self.poll_interval = pollInterval
+
+        # the buffers must match the downsampling mode, the aggregate mode needs a second buffer per channel
+        if downSampleRatioMode != self.ratio_mode:
+            self.set_data_buffer(mode=downSampleRatioMode)
+        self.downsample_ratio = downSampleRatio if downSampleRatioMode != RATIO_MODE_NONE else 1
+
+        # the stream indices start at 0 with every run, and so does the overrun accounting
+        self.ringbuffer.clear()
+        self.ringbuffer.reset_stats()
+        self.samples_received = 0
+        self.ring_gaps.clear()
+        self.stream_offset = -self.ringbuffer.write_count
+        self.block_index = 0
+        self.trigger_events = []
+        if self.decimator is not None:
+            self.set_decimation(list((tier.kind, tier.factor) for tier in self.decimator.tiers.values()))
 
         #prepareMeasurements
         sampleIntervalTimeUnit = self.streaming_sample_interval_unit
 
         #Generate new folder for streaming data
-        if self.streaming_sample_interval.value == 1:
-            samplerate_string = str('1')+SAMPLERATE_MAP[self.streaming_sample_interval_unit-1]
-        else:
-            samplerate_string = str(1000/self.streaming_sample_interval.value)+SAMPLERATE_MAP[self.streaming_sample_interval_unit]
-        foldername = datetime.datetime.now().strftime('%Y-%m-%d__%H-%M-%S__'+samplerate_string+'S')
-        # -> results in a foldername like '2015-01-22__22-32-40__500k'
-        folder = os.path.join(datadirectory_pokini,foldername)
-        self.folder = folder
-        if not os.path.exists(folder):
-            os.makedirs(folder)
+        folder = None
+        if session:
+            samplerate_string = sample_rate_string(self.get_sample_interval_seconds())
+            foldername = datetime.datetime.now().strftime('%Y-%m-%d__%H-%M-%S__'+samplerate_string+'S')
+            # -> results in a foldername like '2015-01-22__22-32-40__500k'
+            # units opened by serial number, e.g. by multiunit, run at the same time: '2015-01-22__22-32-40__500k__AB123-456'
+            if self.serial is not None:
+                foldername += '__'+''.join(c if c.isalnum() else '-' for c in self.serial)
+            folder = os.path.join(get_datadirectory(),foldername)
+            if not os.path.exists(folder):
+                os.makedirs(folder)
 
-        if VERBOSE:
-            print(' Data will be saved to '+str(folder))
-        
-        # Copy parameters.ini into the folder
-        shutil.copy2(os.path.join(codedirectory_pokini,'parameters.ini'),folder)
+            if VERBOSE:
+                print(' Data will be saved to '+str(folder))
+
+            # Copy parameters.ini into the folder
+            parameterfile = self.config.path
+            if parameterfile is not None and os.path.exists(parameterfile):
+                shutil.copy2(parameterfile,folder)
+        self.folder = folder
 
         try:
-            autoStop=0
-            maxPreTriggerSamples=None
-            maxPostTriggerSamples=None
-            print(' Streaming Sample Interval before: '+str(self.streaming_sample_interval.value))
+            maxPreTriggerSamples=preTriggerSamples
+            maxPostTriggerSamples=postTriggerSamples
+            if VERBOSE:
+                print(' Streaming Sample Interval before: '+str(self.streaming_sample_interval.value))
             res = self.lib.ps4000aRunStreaming(self.handle,
                     ctypes.byref(self.streaming_sample_interval),
                     self.streaming_sample_interval_unit,
@@ -398,6 +661,15 @@ class DRDAQ:
                     downSampleRatio,
                     downSampleRatioMode,
                     self.streaming_buffer_length)
+            # the anchor of the run: the first sample is taken when ps4000aRunStreaming returns,
+            # with the interval the driver actually uses, in femtoseconds to keep it exact
+            # A replayed recording keeps its own anchor, see replay.ReplayLibrary
+            self.anchor_ns = getattr(self.lib, 'anchor_ns', None) or time.time_ns()
+            self.interval_fs = self.streaming_sample_interval.value * 10**(3*self.streaming_sample_interval_unit) * self.downsample_ratio
+            self.start_time = self.anchor_ns/1e9
+            self.drift = None
+            self.drift_checked = time.perf_counter()
+            self.record_status('ps4000aRunStreaming', res)
             # DOC of ps4000aRunStreaming(handler, pointer to sampleInterval, sampleIntervalTimeUnit, maxPretriggerSamples=none, maxPosttriggerSamples=none,autostop=none,downsamplingrate=no, downsamlingratiomode=0,bufferlength= must be the same as in setbuffer)
             if VERBOSE:
                 print(' Result: '+str(res)+' (0 = PICO_OK, 64 = PICO_INVALID_SAMPLERATIO)')
@@ -405,15 +677,116 @@ class DRDAQ:
         finally:
             pass
 
-    def get_Timebase(self, timebase=99,noSamples=1000,segmentIndex= 1):
+        if self.publisher is not None:
+            self.set_publisher_timing()
+
+        # Record every block read by get_queue_data into segment files in the folder
+        if record:
+            from recorder import Recorder
+            self.recorder = Recorder(folder, self.row_channels, self.get_value_interval_seconds(), compress=compress,
+                                     scales=self.get_channel_scales(), anchorNs=self.anchor_ns, intervalFs=self.interval_fs,
+                                     simulated=self.fakeDataMode, pool=self.compress_pool)
 
-        if self.fakeDataMode:
+        self.start_acquisition_thread()
+
+# Acquisition thread: polls the driver so that the data flow does not depend on the consumer
+    def start_acquisition_thread(self):
+        if self.acquisition_thread is not None:
+            return
+        self.stop_event.clear()
+        self.acquisition_thread = threading.Thread(target=self.acquisition_loop, name='DRDAQ acquisition')
+        self.acquisition_thread.daemon = True
+        self.acquisition_thread.start()
+
+    def acquisition_loop(self):
+        while not self.stop_event.is_set():
+            self.get_streaming_latest_values()
+            # no callback runs now, a publisher ended before this poll is not written any more
+            self.release_publishers()
+            if self.pending_config is not None:
+                config, self.pending_config = self.pending_config, None
+                self.apply_reloadable(config)
+            if time.perf_counter()-self.config_checked > CONFIG_CHECK_INTERVAL:
+                self.check_config()
+            if time.perf_counter()-self.drift_checked > DRIFT_REPORT_INTERVAL:
+                self.check_drift()
+            self.stop_event.wait(self.poll_interval)
+
+    def stop_acquisition_thread(self):
+        if self.acquisition_thread is None:
             return
+        self.stop_event.set()
+        self.acquisition_thread.join()
+        self.acquisition_thread = None
+        self.release_publishers()
+        # wake up consumers waiting for data
+        self.data_event.set()
+
+# Hardware trigger, threshold in counts, direction one of the TRIGGER_ constants
+# autoTriggerMs=0 waits forever for the trigger
+    def set_simple_trigger(self, channel=PS4000_CHANNEL_A, threshold=0, direction=TRIGGER_RISING, delay=0, autoTriggerMs=0, enable=True):
+        if VERBOSE:
+            print('==== SetSimpleTrigger ====')
+        res = self.lib.ps4000aSetSimpleTrigger(self.handle, int(enable), channel, threshold, direction, delay, autoTriggerMs)
+        self.record_status('ps4000aSetSimpleTrigger', res)
+        if VERBOSE:
+            print(' Result: '+str(res)+' (0 = PICO_OK)')
+        return res
+
+# Sample indices (as in get_block_start) of the hardware trigger events since the last call
+    def get_trigger_events(self):
+        events = self.trigger_events
+        self.trigger_events = []
+        return events
+
+# Time of a value in the stream, integer nanoseconds since the epoch
+# Values of several channels or runs are aligned by their indices: no float and no datetime is involved
+    def get_sample_time_ns(self, sampleIndex):
+        return self.anchor_ns + sampleIndex*self.interval_fs//10**6
+
+# Index of the value taken at timeNs (nanoseconds since the epoch), or just after it
+    def get_sample_index(self, timeNs):
+        return -((self.anchor_ns-timeNs)*10**6//self.interval_fs)
+
+# Drift of the system clock against the sample clock: the time the newest value arrived minus the time
+# its index gives. The offset includes the transfer latency, the slope in ppm is the drift of the clocks
+    def check_drift(self):
+        now = time.time_ns()
+        self.drift_checked = time.perf_counter()
+        if self.anchor_ns is None or not self.samples_received:
+            return None
+        offset = (now - self.get_sample_time_ns(self.samples_received))/1e9
+        ppm = None
+        if self.drift is not None and now > self.drift['time_ns']:
+            ppm = (offset-self.drift['offset_seconds'])/((now-self.drift['time_ns'])/1e9)*1e6
+        self.drift = {'time_ns':now, 'sample_index':self.samples_received, 'offset_seconds':offset, 'ppm':ppm}
+        if self.metrics.enabled:
+            self.metric_drift.set(offset)
+            if ppm is not None:
+                self.metric_drift_ppm.set(ppm)
+        if VERBOSE:
+            print(' Clock drift: %.6f s' % offset + ('' if ppm is None else ', %.1f ppm' % ppm))
+        return self.drift
+
+# Last drift report of check_drift as dict: time_ns, sample_index, offset_seconds, ppm (None in the first report)
+    def get_drift(self):
+        return self.drift
+
+# Sample interval in seconds, as returned by the driver in run_streaming
+    def get_sample_interval_seconds(self):
+        return self.streaming_sample_interval.value * 10.0**(3*self.streaming_sample_interval_unit-15)
+
+# Time between two values of the delivered blocks, the sample interval times the downsampling ratio
+    def get_value_interval_seconds(self):
+        return self.get_sample_interval_seconds()*self.downsample_ratio
+
+    def get_Timebase(self, timebase=99,noSamples=1000,segmentIndex=0):
 
         try:
-            self.timeIntervalNS = ctypes.c_uint(0)
-            self.maxSamples = ctypes.c_uint(0)
-            res=self.lib.ps4000aGetTimebase(self.handle, timebase, noSamples, ctypes.byref(self.timeIntervalNS),ctypes.byref(self.maxSamples),None)
+            self.timeIntervalNS = ctypes.c_int32(0)
+            self.maxSamples = ctypes.c_int32(0)
+            res=self.lib.ps4000aGetTimebase(self.handle, timebase, noSamples, ctypes.byref(self.timeIntervalNS),ctypes.byref(self.maxSamples),segmentIndex)
+            self.record_status('ps4000aGetTimebase', res)
             if VERBOSE:
                 print('TimeInterval_Ns: '+ str(self.timeIntervalNS))
                 print('maxSamples: '+str(self.maxSamples))
@@ -423,29 +796,73 @@ class DRDAQ:
 
 # Actually retrieve the data on the pc
     def get_streaming_latest_values(self):
-        
-        if self.fakeDataMode:
-            return self.enqueue_fake_data()
-
-        buffer_callback = self.construct_buffer_callback()
-        res = self.lib.ps4000aGetStreamingLatestValues(self.handle, buffer_callback)
-        
+        res = self.lib.ps4000aGetStreamingLatestValues(self.handle, self.buffer_callback, None)
+        if res and self.metrics.enabled:
+            self.record_status('ps4000aGetStreamingLatestValues', res)
         return res
 
-# Provide Access to the data in the queue, type is np.array
-    def get_queue_data(self):
-        self.get_streaming_latest_values()
-        if not self.dataqueue.empty():
-            return np.array(self.dataqueue.get())
+# Provide Access to the data in the ring buffer, type is np.array of shape (channels, samples)
+# The returned array is a view into the ring buffer and stays valid until the next call,
+# only if the data wraps around the end of the ring it is copied once
+# While the acquisition thread runs, waits up to timeout seconds for new data
+    def get_queue_data(self, n=None, timeout=None):
+        # the block of the last call is not used any more, the producer may overwrite it
+        self.ringbuffer.release()
+        if self.acquisition_thread is None:
+            self.get_streaming_latest_values()
+        elif timeout and not self.ringbuffer.available():
+            self.data_event.clear()
+            if not self.ringbuffer.available():
+                self.data_event.wait(timeout)
+        # a block never spans values the ring buffer had to drop, its index is that of its first value
+        position = self.ringbuffer.read_count
+        while self.ring_gaps and self.ring_gaps[0][0] <= position:
+            self.stream_offset = self.ring_gaps.popleft()[1]
+        if self.ring_gaps:
+            gap = self.ring_gaps[0][0]-position
+            n = gap if n is None else min(n, gap)
+        views = self.ringbuffer.read(n)
+        if not views:
+            return None
+        self.block_index = position + self.stream_offset
+        if len(views) == 1:
+            data = views[0]
         else:
+            data = np.concatenate(views, axis=-1)
+
+        if self.recorder is not None:
+            sampleIndex, timestamp = self.get_block_start()
+            if not self.recorder.write(data, timestamp, sampleIndex):
+                self.metric_recorder_dropped.inc()
+        return data
+
+# Same as get_queue_data, but in volts as float32
+# The recorder still gets the counts, the returned array is reused by the next call
+    def get_queue_volts(self, n=None, timeout=None):
+        data = self.get_queue_data(n, timeout)
+        if data is None:
             return None
+        return self.converter.convert(data)
+
+# Index in the stream and time of the first value of the block last returned by get_queue_data
+# The index counts all values of the run, also those the ring buffer had to drop
+    def get_block_start(self):
+        return self.block_index, self.get_sample_time_ns(self.block_index)/1e9
+
+# Overrun accounting of the ring buffer: dropped samples, high water mark and current lag
+    def get_buffer_stats(self):
+        return self.ringbuffer.get_stats()
     
     def stop_sampling(self):
-        if self.fakeDataMode:
-            return
+        self.stop_acquisition_thread()
+
+        if self.recorder is not None:
+            self.recorder.close()
+            self.recorder = None
 
         try:
             res = self.lib.ps4000aStop(self.handle)
+            self.record_status('ps4000aStop', res)
             if VERBOSE:
                 print('Stopping sampling of Scope')
                 print('Result: '+str(res)+' (0= PICO_OK)')
@@ -453,20 +870,81 @@ class DRDAQ:
             pass
         return res    
 
-    def enqueue_fake_data(self):
-        if 'self.fakeDataPosition' not in locals():
-            self.fakeDataPosition = np.random.random_integers(0,10000)
-        x = np.linspace(0,np.pi,self.streaming_sample_interval.value)        
-        data = np.sin(50*x)
-        data = np.floor(data*18/50*32768/8)*8
-        self.dataqueue.put(data)
+# Metrics
+    def record_status(self, function, status):
+        '''count the status codes returned by the driver, per function'''
+        self.metrics.counter('driver_status_total', 'Status codes returned by the driver',
+                             {'function':function, 'status':str(status)}).inc()
+
+    def get_metrics(self):
+        '''snapshot of the metrics and the ring buffer statistics'''
+        snapshot = self.metrics.snapshot()
+        if self.ringbuffer is not None:
+            for key, value in self.ringbuffer.get_stats().items():
+                snapshot['ringbuffer_'+key] = value
+        # samples of this run, counted from 0 with the run like start_time, samples_total counts all runs
+        if self.start_time is not None:
+            snapshot['samples_per_second'] = self.samples_received/max(time.time()-self.start_time, 1e-9)
+        return snapshot
+
+    def serve_metrics(self, address=('127.0.0.1', 9464)):
+        '''Prometheus text of the metrics on a local TCP port (HTTP) or a Unix socket path'''
+        return self.metrics.serve(address)
+
+# asyncio interface: all driver calls run in the default executor, never on the event loop
+    async def start(self, downSampleRatio=1, downSampleRatioMode=0, pollInterval=None):
+        '''coroutine version of run_streaming, blocks are then available through stream()'''
+        import asyncio
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.run_streaming, downSampleRatio, downSampleRatioMode, pollInterval)
+        self.pump_task = loop.create_task(self.pump_blocks())
+
+    async def stop(self):
+        '''coroutine version of stop_sampling, ends all running stream() iterators'''
+        import asyncio
+        if self.pump_task is not None:
+            self.pump_task.cancel()
+            try:
+                await self.pump_task
+            except asyncio.CancelledError:
+                pass
+            self.pump_task = None
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.stop_sampling)
+        # None marks the end of the stream, make room for it in full queues
+        for streamqueue in self.stream_queues:
+            if streamqueue.full():
+                streamqueue.get_nowait()
+            streamqueue.put_nowait(None)
+
+    async def pump_blocks(self):
+        '''moves blocks from the ring buffer into the queues of all stream() consumers'''
+        import asyncio
+        loop = asyncio.get_running_loop()
+        while True:
+            data = await loop.run_in_executor(None, self.get_queue_data, None, STREAM_WAIT_TIMEOUT)
+            if data is None:
+                continue
+            block = data.copy()
+            # back-pressure: wait until every consumer has room, the ring buffer absorbs the delay
+            await asyncio.gather(*[streamqueue.put(block) for streamqueue in list(self.stream_queues)])
+
+    async def stream(self, maxsize=STREAM_QUEUE_SIZE):
+        '''async iterator of sample blocks: async for block in drdaq.stream()
+        Every consumer gets its own bounded queue, all consumers share the same block arrays'''
+        import asyncio
+        streamqueue = asyncio.Queue(maxsize)
+        self.stream_queues.append(streamqueue)
+        try:
+            while True:
+                block = await streamqueue.get()
+                if block is None:
+                    return
+                yield block
+        finally:
+            self.stream_queues.remove(streamqueue)
 
 if __name__ == '__main__':
-    #try:
-    pico = DRDAQ()
-    #except:
-        #print('Error opening Picoscope')
-
     try:
         pico = DRDAQ()
     except:
@@ -474,10 +952,10 @@ if __name__ == '__main__':
 
     try:
         pico.run_streaming()
-        for step in xrange(3):
-            time.sleep(0.2)
-            pico.get_streaming_latest_values()
-            print(str(len(pico.get_queue_data())))
+        for step in range(3):
+            data = pico.get_queue_data(timeout=0.2)
+            if data is not None:
+                print(str(data.shape[1]))
         time.sleep(0.5)
         pico.stop_sampling()
     finally:      
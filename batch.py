@@ -0,0 +1,315 @@
+# -*- coding: utf-8 -*-
+"""
+Parallel post-processing of recorded sessions
+
+The recordings are split into chunks of whole blocks and the chunks are
+processed by a pool of worker processes. A task only names the folder and
+the block range, every worker opens the segment files itself with np.memmap
+(see recorder.Recording), so no samples are pickled between the processes.
+
+Each reducer processes the blocks of one chunk in volts and returns a small
+result. The results of all chunks are merged in the order of the chunks, so
+the merged result does not depend on the number of workers. A reducer that
+looks back over its input (history samples) is first primed with the samples
+before the chunk, and the blocks of a recording count as one continuous
+stream, so the result does not depend on the chunk size either:
+ - Statistics: count, mean, RMS, min and max per channel
+ - Spectrum:   mean power spectrum per channel
+ - Events:     times where a channel crosses a level
+
+    python batch.py ~/pqpico/Data --workers 16 --output week.npz
+"""
+
+import argparse
+import copy
+import os
+import sys
+import time
+import concurrent.futures
+
+import numpy as np
+
+from recorder import INDEX_DTYPE, Recording
+from trigger import LevelTrigger
+
+# Blocks per task, a chunk never spans two recordings
+CHUNK_BLOCKS = 64
+
+# Samples per FFT of the Spectrum reducer
+SPECTRUM_LENGTH = 2**14
+
+EVENT_DTYPE = np.dtype([('timestamp','<f8'),     # time of the event in seconds since the epoch
+                        ('channel','<u1')])
+
+
+class Statistics:
+    name = 'statistics'
+    # samples before a chunk that prime needs
+    history = 0
+
+    def __init__(self):
+        # per channel: [count, sum, sum of squares, min, max]
+        self.values = {}
+
+    def prime(self, volts, channels, position):
+        pass
+
+    def process(self, volts, channels, timestamp, sampleInterval, position):
+        for row, channel in enumerate(channels):
+            x = volts[row].astype(np.float64)
+            if len(x) == 0:
+                continue
+            new = [len(x), x.sum(), np.dot(x, x), x.min(), x.max()]
+            if channel in self.values:
+                self.values[channel] = self.combine(self.values[channel], new)
+            else:
+                self.values[channel] = new
+
+    @staticmethod
+    def combine(a, b):
+        return [a[0]+b[0], a[1]+b[1], a[2]+b[2], min(a[3], b[3]), max(a[4], b[4])]
+
+    def result(self):
+        return self.values
+
+    def merge(self, results):
+        merged = {}
+        for values in results:
+            for channel, value in values.items():
+                merged[channel] = self.combine(merged[channel], value) if channel in merged else value
+        return dict((channel, {'samples':count, 'mean':total/count, 'rms':np.sqrt(squares/count), 'min':low, 'max':high})
+                    for channel, (count, total, squares, low, high) in sorted(merged.items()))
+
+
+class Spectrum:
+    name = 'spectrum'
+
+    def __init__(self, length=SPECTRUM_LENGTH):
+        self.length = length
+        self.history = length-1
+        self.window = np.hanning(length)
+        # per channel: [segments, sum of the power spectra]
+        self.values = {}
+        self.sample_interval = None
+        # samples of the segment not yet complete and the position of the first of them
+        self.carry = None
+        self.carry_position = 0
+
+    def prime(self, volts, channels, position):
+        # history is one sample short of a segment, nothing is computed
+        self.segments(volts, position)
+
+    def process(self, volts, channels, timestamp, sampleInterval, position):
+        self.sample_interval = sampleInterval
+        x = self.segments(volts, position)
+        if x is None:
+            return
+        for row, channel in enumerate(channels):
+            power = np.abs(np.fft.rfft(x[row]*self.window, axis=1))**2
+            count, total = self.values.get(channel, (0, 0.0))
+            self.values[channel] = (count+x.shape[1], total+power.sum(axis=0))
+
+    def segments(self, volts, position):
+        '''(channels, segments, length) of the segments completed by volts, None if there is none
+        The segments start at the multiples of length of the position in the recording'''
+        if self.carry is not None and self.carry_position+self.carry.shape[1] == position:
+            x = np.concatenate((self.carry, volts), axis=1)
+            position = self.carry_position
+        else:
+            x = volts
+        skip = -position % self.length
+        x = x[:,skip:]
+        position += skip
+        segments = x.shape[1]//self.length
+        # volts is reused by the caller for the next block
+        self.carry = x[:,segments*self.length:].copy()
+        self.carry_position = position+segments*self.length
+        if segments == 0:
+            return None
+        return x[:,:segments*self.length].reshape(x.shape[0], segments, self.length)
+
+    def result(self):
+        return self.values, self.sample_interval
+
+    def merge(self, results):
+        merged = {}
+        sampleInterval = None
+        for values, interval in results:
+            sampleInterval = sampleInterval or interval
+            for channel, (count, total) in values.items():
+                previous = merged.get(channel, (0, 0.0))
+                merged[channel] = (previous[0]+count, previous[1]+total)
+        spectra = dict((channel, total/count) for channel, (count, total) in sorted(merged.items()))
+        frequencies = None
+        if sampleInterval:
+            frequencies = np.fft.rfftfreq(self.length, sampleInterval)
+        return {'frequencies':frequencies, 'power':spectra}
+
+
+class Events:
+    name = 'events'
+    # the last sample before a chunk, a crossing between it and the first sample belongs to the chunk
+    history = 1
+
+    def __init__(self, level, channel=0, rising=True):
+        '''level in volts'''
+        self.level = level
+        self.channel = channel
+        self.rising = rising
+        self.trigger = None
+        self.events = []
+
+    def prime(self, volts, channels, position):
+        if self.channel in channels:
+            self.get_trigger(channels).find(volts, 0)
+
+    def get_trigger(self, channels):
+        if self.trigger is None:
+            self.trigger = LevelTrigger(self.level, channels.index(self.channel), self.rising)
+        return self.trigger
+
+    def process(self, volts, channels, timestamp, sampleInterval, position):
+        if self.channel not in channels:
+            return
+        # with sampleIndex 0 the trigger returns the positions in this block of the first samples past the level
+        hits = self.get_trigger(channels).find(volts, 0)
+        if len(hits):
+            self.events.append(timestamp+hits*sampleInterval)
+
+    def result(self):
+        events = np.zeros(sum(len(e) for e in self.events), dtype=EVENT_DTYPE)
+        if self.events:
+            events['timestamp'] = np.concatenate(self.events)
+        events['channel'] = self.channel
+        return events
+
+    def merge(self, results):
+        # chunks are in time order within a recording, the recordings in name order
+        return np.concatenate(list(results)) if results else np.zeros(0, dtype=EVENT_DTYPE)
+
+
+def make_chunks(folders, chunkBlocks=CHUNK_BLOCKS):
+    '''(folder, first block, last block+1) of every chunk of the recordings'''
+    chunks = []
+    for folder in folders:
+        blocks = os.path.getsize(os.path.join(folder,'index.bin'))//INDEX_DTYPE.itemsize
+        for first in range(0, blocks, chunkBlocks):
+            chunks.append((folder, first, min(first+chunkBlocks, blocks)))
+    return chunks
+
+
+# Recordings opened by this worker process, the memmaps stay open for the next chunks,
+# with the position of every block in the recording, blocks after a gap follow on directly
+worker_recordings = {}
+
+
+def get_volts(recording, blocknumber, out=None):
+    '''(channels, samples) float32 volts of a block, counts if the recording has no scale factors
+    out: array of at least the size of the block to convert into'''
+    counts = recording.get_block(blocknumber)
+    if recording.converter is None:
+        return counts.astype(np.float32)
+    if out is None:
+        return recording.converter.convert(counts, out=np.empty(counts.shape, dtype=np.float32))
+    return recording.converter.convert(counts, out=out[:,:counts.shape[1]])
+
+
+def get_history(recording, first, samples):
+    '''(channels, up to samples) volts just before block first'''
+    pieces = []
+    count = 0
+    blocknumber = first
+    while count < samples and blocknumber > 0:
+        blocknumber -= 1
+        pieces.insert(0, get_volts(recording, blocknumber))
+        count += pieces[0].shape[1]
+    if not pieces:
+        return np.zeros((len(recording.channels),0), dtype=np.float32)
+    return np.concatenate(pieces, axis=1)[:,max(count-samples, 0):]
+
+
+def process_chunk(task):
+    '''runs in a worker: feeds the blocks of one chunk to fresh copies of the reducers'''
+    folder, first, last, reducers = task
+    # the same prototypes arrive for every chunk, also without a pool
+    reducers = copy.deepcopy(reducers)
+    if folder not in worker_recordings:
+        recording = Recording(folder)
+        positions = np.concatenate(([0], np.cumsum(recording.index['samples'], dtype=np.int64)))
+        worker_recordings[folder] = (recording, positions)
+    recording, positions = worker_recordings[folder]
+
+    history = get_history(recording, first, max(reducer.history for reducer in reducers))
+    for reducer in reducers:
+        n = min(reducer.history, history.shape[1])
+        if n:
+            reducer.prime(history[:,history.shape[1]-n:], recording.channels, int(positions[first])-n)
+
+    out = None
+    for blocknumber in range(first, last):
+        if out is None or out.shape[1] < recording.index['samples'][blocknumber]:
+            out = np.empty((len(recording.channels),int(recording.index['samples'][blocknumber])), dtype=np.float32)
+        volts = get_volts(recording, blocknumber, out)
+        timestamp = float(recording.index['timestamp'][blocknumber])
+        for reducer in reducers:
+            reducer.process(volts, recording.channels, timestamp, recording.sample_interval, int(positions[blocknumber]))
+    return [reducer.result() for reducer in reducers]
+
+
+def run_batch(folders, reducers, workers=None, chunkBlocks=CHUNK_BLOCKS):
+    '''processes all blocks of the recording folders with the reducers on workers processes,
+    returns {reducer.name: merged result}'''
+    folders = sorted(folders)
+    tasks = [(folder, first, last, reducers) for folder, first, last in make_chunks(folders, chunkBlocks)]
+    if workers == 1:
+        results = [process_chunk(task) for task in tasks]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+            # map returns the results in the order of the tasks, whatever finishes first
+            results = list(pool.map(process_chunk, tasks, chunksize=max(len(tasks)//(4*(workers or os.cpu_count() or 1)), 1)))
+    return dict((reducer.name, reducer.merge([result[i] for result in results]))
+                for i, reducer in enumerate(reducers))
+
+
+def find_recordings(datadirectory, t1=None, t2=None):
+    '''recording folders of a data directory, only those between t1 and t2 if given'''
+    if t1 is not None or t2 is not None:
+        from sessionindex import SessionIndex
+        index = SessionIndex(datadirectory)
+        names = index.find_sessions(-np.inf if t1 is None else t1, np.inf if t2 is None else t2)
+    else:
+        names = [name for name in os.listdir(datadirectory)
+                 if os.path.exists(os.path.join(datadirectory, name, 'index.bin'))]
+    return [os.path.join(datadirectory, name) for name in sorted(names)]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Statistics, spectra and level crossings of recorded sessions')
+    parser.add_argument('datadirectory')
+    parser.add_argument('--workers', type=int, default=None, help='worker processes, default one per core')
+    parser.add_argument('--chunk-blocks', type=int, default=CHUNK_BLOCKS)
+    parser.add_argument('--level', type=float, default=0.0, help='level of the crossings in volts')
+    parser.add_argument('--channel', type=int, default=0, help='channel of the crossings')
+    parser.add_argument('--start', type=float, default=None, help='first time, seconds since the epoch')
+    parser.add_argument('--end', type=float, default=None, help='last time, seconds since the epoch')
+    parser.add_argument('--output', help='write the results to this .npz file')
+    args = parser.parse_args()
+
+    folders = find_recordings(args.datadirectory, args.start, args.end)
+    if not folders:
+        print('No recordings found in '+args.datadirectory)
+        sys.exit(1)
+    start = time.perf_counter()
+    results = run_batch(folders, [Statistics(), Spectrum(), Events(args.level, args.channel)],
+                        args.workers, args.chunk_blocks)
+    print(' %d recordings processed in %.2f s' % (len(folders), time.perf_counter()-start))
+    for channel, values in results['statistics'].items():
+        print(' Channel '+'ABCDEFGH'[channel]+': '+', '.join('%s %.4g' % item for item in values.items()))
+    print(' Level crossings: '+str(len(results['events'])))
+
+    if args.output:
+        spectra = results['spectrum']
+        arrays = {'events':results['events'], 'frequencies':spectra['frequencies']}
+        for channel, power in spectra['power'].items():
+            arrays['power_'+'ABCDEFGH'[channel]] = power
+        np.savez(args.output, **arrays)
@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of the acquisition to disk path, running on the simulated library
+
+ - startup:    new process: import DrDAQ, open the unit and wait for the first block
+ - pipeline:   driver callback -> ring buffer -> consumer, per block size, channel count and
+               poll interval, with callback latency percentiles, dropped samples and the
+               high water mark of the ring buffer: what the consumer takes out of what the
+               driver delivers, with poll interval 0 the limit of the pipeline
+ - realtime:   the same at real time speed for several sample intervals, reports lost samples
+ - ringbuffer: write/read hand-off alone
+ - conversion: counts to volts
+ - recorder:   raw and compressed segment writers
+
+The results are printed as JSON, python benchmark.py --output results.json writes them to a file
+so that two versions can be compared.
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+import DrDAQ
+from DrDAQ import DRDAQ
+from simdriver import SimulatedLibrary
+from ringbuffer import RingBuffer
+from conversion import Converter
+from recorder import Recorder
+
+BLOCK_SIZES = [10000, 50000, 200000]
+CHANNEL_COUNTS = [1, 4, 8]
+SAMPLE_INTERVALS_US = [4, 2, 1]
+# Poll intervals of the pipeline benchmark in seconds, with 0 the driver is polled
+# as fast as it goes and the consumer decides what is sustainable
+POLL_INTERVALS = [0.0, 0.001, 0.005]
+
+
+# Cold start of a new process: import DrDAQ, open the simulated unit and wait for the first block
+STARTUP_SCRIPT = '''
+import sys, time, json
+launched = int(sys.argv[1])
+start = time.perf_counter()
+import DrDAQ
+from simdriver import SimulatedLibrary
+imported = time.perf_counter()
+pico = DrDAQ.DRDAQ(lib=SimulatedLibrary())
+opened = time.perf_counter()
+pico.run_streaming()
+while pico.get_queue_data(timeout=0.001) is None:
+    pass
+first = time.perf_counter()
+since_launch = (time.time_ns()-launched)/1e6
+pico.stop_sampling()
+pico.close_unit()
+print(json.dumps([imported-start, opened-imported, first-opened, first-start, since_launch]))
+'''
+
+
+def percentile_us(durations, q):
+    if not durations:
+        return None
+    return float(np.percentile(durations, q)*1e6)
+
+
+def open_simulated(lib, blockSamples, channels, intervalUs=2):
+    pico = DRDAQ(lib=lib)
+    for channel in range(1, channels):
+        pico.set_channel(channel)
+    pico.streaming_buffer_length = blockSamples
+    pico.streaming_sample_interval = DrDAQ.ctypes.c_uint(intervalUs)
+    pico.streaming_sample_interval_unit = DrDAQ.MICROSECONDS
+    pico.set_data_buffer()
+    return pico
+
+
+def consume(pico, seconds):
+    '''reads the blocks of a running DRDAQ for some seconds, returns the number of samples per channel'''
+    samples = 0
+    end = time.perf_counter()+seconds
+    while time.perf_counter() < end:
+        data = pico.get_queue_data(timeout=0.05)
+        if data is not None:
+            samples += data.shape[-1]
+    return samples
+
+
+def bench_pipeline(blockSamples, channels, seconds, pollInterval=0.0):
+    lib = SimulatedLibrary(speed=None, timing=True)
+    pico = open_simulated(lib, blockSamples, channels)
+    start = time.perf_counter()
+    pico.run_streaming(pollInterval=pollInterval)
+    samples = consume(pico, seconds)
+    pico.stop_sampling()
+    duration = time.perf_counter()-start
+    stats = pico.get_buffer_stats()
+    delivered = pico.samples_received
+    pico.close_unit()
+    return {'benchmark':'pipeline', 'block_samples':blockSamples, 'channels':channels, 'poll_interval':pollInterval,
+            'samples_per_second':samples*channels/duration,
+            'delivered_per_second':delivered*channels/duration,
+            'callbacks':len(lib.callback_durations),
+            'callback_p50_us':percentile_us(lib.callback_durations, 50),
+            'callback_p99_us':percentile_us(lib.callback_durations, 99),
+            'callback_us_per_ksample':1e3*percentile_us(lib.callback_durations, 50)/(blockSamples*channels),
+            'dropped':stats['dropped'], 'high_water':stats['high_water']}
+
+
+def bench_realtime(intervalUs, channels, seconds, blockSamples=50000):
+    lib = SimulatedLibrary(speed=1.0, timing=True)
+    pico = open_simulated(lib, blockSamples, channels, intervalUs)
+    pico.run_streaming()
+    samples = consume(pico, seconds)
+    pico.stop_sampling()
+    stats = pico.get_buffer_stats()
+    lost = sum(lib.lost_samples.values())
+    pico.close_unit()
+    return {'benchmark':'realtime', 'sample_interval_us':intervalUs, 'channels':channels, 'block_samples':blockSamples,
+            'samples_per_second':samples*channels/seconds,
+            'callback_p50_us':percentile_us(lib.callback_durations, 50),
+            'callback_p99_us':percentile_us(lib.callback_durations, 99),
+            'dropped':stats['dropped']+lost, 'driver_lost':lost}
+
+
+def bench_startup(repeats=5):
+    '''import, open and first block of new processes, in ms, the median of the runs'''
+    env = dict(os.environ, DRDAQ_DATADIRECTORY=DrDAQ.get_datadirectory())
+    runs = []
+    for repeat in range(repeats):
+        output = subprocess.check_output([sys.executable, '-c', STARTUP_SCRIPT, str(time.time_ns())],
+                                         cwd=os.path.dirname(os.path.abspath(__file__)), env=env)
+        runs.append(json.loads(output.decode().splitlines()[-1]))
+    imported, opened, first, total, launch = np.median(np.array(runs), axis=0)
+    return {'benchmark':'startup', 'repeats':repeats,
+            'import_ms':imported*1e3, 'open_ms':opened*1e3, 'first_block_ms':first*1e3,
+            'import_to_first_block_ms':total*1e3, 'launch_to_first_block_ms':launch}
+
+
+def bench_ringbuffer(blockSamples, channels, repeats=200):
+    ring = RingBuffer(16*blockSamples, channels=channels)
+    block = np.zeros((channels,blockSamples), dtype=np.int16)
+    durations = []
+    for i in range(repeats):
+        start = time.perf_counter()
+        ring.write(block)
+        ring.read()
+        durations.append(time.perf_counter()-start)
+    return {'benchmark':'ringbuffer', 'block_samples':blockSamples, 'channels':channels,
+            'samples_per_second':blockSamples*channels*repeats/sum(durations),
+            'p50_us':percentile_us(durations, 50), 'p99_us':percentile_us(durations, 99),
+            'dropped':ring.dropped}
+
+
+def bench_conversion(blockSamples, channels, repeats=100):
+    converter = Converter([50.0/32768]*channels, [0.0]*channels)
+    block = np.random.randint(-32768, 32767, (channels,blockSamples)).astype(np.int16)
+    durations = []
+    for i in range(repeats):
+        start = time.perf_counter()
+        converter.convert(block)
+        durations.append(time.perf_counter()-start)
+    return {'benchmark':'conversion', 'block_samples':blockSamples, 'channels':channels,
+            'samples_per_second':blockSamples*channels*repeats/sum(durations),
+            'p50_us':percentile_us(durations, 50), 'p99_us':percentile_us(durations, 99)}
+
+
+def bench_recorder(blockSamples, channels, compress, blocks=100):
+    import compression
+    data = compression.mains_waveform(blockSamples*8, channels).T
+    folder = tempfile.mkdtemp(prefix='drdaq_bench_')
+    try:
+        recorder = Recorder(folder, range(channels), 2e-6, compress=compress, queueBlocks=blocks)
+        durations = []
+        start = time.perf_counter()
+        for i in range(blocks):
+            offset = (i % 8)*blockSamples
+            called = time.perf_counter()
+            recorder.write(data[:,offset:offset+blockSamples], i*blockSamples*2e-6)
+            durations.append(time.perf_counter()-called)
+        recorder.close()
+        duration = time.perf_counter()-start
+        stored = sum(os.path.getsize(os.path.join(folder,f)) for f in os.listdir(folder) if f.startswith('segment'))
+    finally:
+        shutil.rmtree(folder)
+    return {'benchmark':'recorder', 'compressed':compress, 'block_samples':blockSamples, 'channels':channels,
+            'samples_per_second':blockSamples*channels*blocks/duration,
+            'write_p50_us':percentile_us(durations, 50), 'write_p99_us':percentile_us(durations, 99),
+            'compression_ratio':blockSamples*channels*blocks*2.0/stored,
+            'dropped':recorder.blocks_dropped}
+
+
+def get_version():
+    try:
+        return subprocess.check_output(['git','describe','--always','--dirty'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(quick=False):
+    seconds = 0.5 if quick else 2.0
+    blocksizes = BLOCK_SIZES[:2] if quick else BLOCK_SIZES
+    channelcounts = CHANNEL_COUNTS[:2] if quick else CHANNEL_COUNTS
+    intervals = SAMPLE_INTERVALS_US[:2] if quick else SAMPLE_INTERVALS_US
+    polls = POLL_INTERVALS[::2] if quick else POLL_INTERVALS
+
+    results = [bench_startup(3 if quick else 5)]
+    for blockSamples in blocksizes:
+        for channels in channelcounts:
+            for pollInterval in polls:
+                results.append(bench_pipeline(blockSamples, channels, seconds, pollInterval))
+            results.append(bench_ringbuffer(blockSamples, channels))
+            results.append(bench_conversion(blockSamples, channels))
+    for intervalUs in intervals:
+        for channels in channelcounts:
+            results.append(bench_realtime(intervalUs, channels, seconds))
+    for compress in (False, True):
+        for channels in channelcounts:
+            results.append(bench_recorder(50000, channels, compress, blocks=20 if quick else 100))
+
+    return {'version':get_version(),
+            'time':time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python':platform.python_version(),
+            'numpy':np.__version__,
+            'machine':platform.machine(),
+            'cpus':os.cpu_count(),
+            'results':results}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the DRDAQ acquisition to disk path on the simulated library')
+    parser.add_argument('--quick', action='store_true', help='fewer and shorter runs')
+    parser.add_argument('--output', help='write the JSON results to this file instead of stdout')
+    args = parser.parse_args()
+
+    # No diagnostics in the hot path, run folders go to a temporary directory
+    DrDAQ.VERBOSE = 0
+    datadirectory = tempfile.mkdtemp(prefix='drdaq_bench_data_')
+    DrDAQ.DATADIRECTORY = datadirectory
+    try:
+        report = run(args.quick)
+    finally:
+        shutil.rmtree(datadirectory)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=1)
+    else:
+        json.dump(report, sys.stdout, indent=1)
+        print()
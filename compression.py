@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""
+Lossless compression of recorded blocks: delta encoding, byte shuffle, zlib
+
+Every block is compressed on its own, so any block of a recording can be
+decompressed without touching the others. Blocks that do not get smaller
+are stored raw, a payload of exactly the raw size marks such a block.
+
+Run this file to print compression ratio and throughput for simulated
+mains waveforms.
+"""
+
+import os
+import sys
+import time
+import zlib
+import concurrent.futures
+
+import numpy as np
+
+CODEC = 'zlib-delta'
+ZLIB_LEVEL = 1
+
+
+def compress_block(data):
+    '''(samples, channels) int16 array -> bytes'''
+    data = np.ascontiguousarray(data, dtype='<i2')
+    # Differences between neighbouring samples are small for mains waveforms,
+    # the int16 arithmetic wraps around and is undone exactly by the cumsum
+    delta = np.empty_like(data)
+    delta[0] = data[0]
+    np.subtract(data[1:], data[:-1], out=delta[1:])
+    # All low bytes first, then all high bytes, the high bytes are mostly 0x00 or 0xff
+    shuffled = delta.view(np.uint8).reshape(-1,2).T.copy()
+    compressed = zlib.compress(shuffled, ZLIB_LEVEL)
+    if len(compressed) >= data.nbytes:
+        return data.tobytes()
+    return compressed
+
+
+def decompress_block(payload, samples, channels):
+    '''bytes from compress_block -> (samples, channels) int16 array'''
+    if len(payload) == samples*channels*2:
+        return np.frombuffer(payload, dtype='<i2').reshape(samples,channels)
+    shuffled = np.frombuffer(zlib.decompress(payload), dtype=np.uint8).reshape(2,-1)
+    delta = shuffled.T.copy().view('<i2').reshape(samples,channels)
+    return np.cumsum(delta, axis=0, dtype=np.int16)
+
+
+def mains_waveform(samples, channels=1, sampleRate=500e3, frequency=50.0):
+    '''sine-like test signal with harmonics and ADC noise, quantized like the scope data'''
+    t = np.arange(samples)/sampleRate
+    data = np.empty((samples,channels), dtype=np.int16)
+    for channel in range(channels):
+        phase = 2*np.pi*channel/3
+        signal = (np.sin(2*np.pi*frequency*t+phase)
+                  + 0.03*np.sin(2*np.pi*3*frequency*t+phase)
+                  + 0.02*np.sin(2*np.pi*5*frequency*t+phase))
+        noise = np.random.normal(0, 2, samples)
+        data[:,channel] = np.round(signal*18/50*32767 + noise)
+    return data
+
+
+def benchmark(seconds=4, channels=3, blockSamples=50000, workers=None):
+    '''prints compression ratio and MB/s, single process and with a process pool'''
+    data = mains_waveform(int(seconds*500e3), channels)
+    blocks = [data[i:i+blockSamples] for i in range(0, data.shape[0], blockSamples)]
+    rawbytes = data.nbytes
+
+    start = time.perf_counter()
+    payloads = [compress_block(block) for block in blocks]
+    single = time.perf_counter()-start
+    compressedbytes = sum(len(payload) for payload in payloads)
+
+    for block, payload in zip(blocks, payloads):
+        assert np.array_equal(decompress_block(payload, *block.shape), block)
+
+    start = time.perf_counter()
+    with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+        list(pool.map(compress_block, blocks))
+    parallel = time.perf_counter()-start
+
+    print('Codec:              '+CODEC)
+    print('Raw data:           %.1f MB, %d channels, %d blocks' % (rawbytes/1e6, channels, len(blocks)))
+    print('Compression ratio:  %.2f' % (rawbytes/compressedbytes))
+    print('Single process:     %.1f MB/s' % (rawbytes/1e6/single))
+    print('Process pool (%d):   %.1f MB/s' % (workers or os.cpu_count(), rawbytes/1e6/parallel))
+    print('Realtime factor at 500 kS/s per channel: %.1f' % (rawbytes/parallel/(500e3*2*channels)))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        benchmark(channels=int(sys.argv[1]))
+    else:
+        benchmark()
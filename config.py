@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+"""
+Typed configuration of a DRDAQ, read from parameters.ini
+
+Every setting has a type and a default. load_config() parses and checks the file once and precomputes the
+derived values, a mistake raises ConfigError naming the section and key:
+
+    [streaming]
+    sample_interval = 2
+    sample_interval_unit = us
+    buffer_length = 50000
+
+    [channel_A]
+    enabled = yes
+    range = 50V
+
+Derived values of a Config:
+ - sample_interval_seconds, sample_rate_string ('500k')
+ - samples_per_cycle and buffer_length, rounded to whole mains cycles if align_to_cycles is set
+ - decimation_tiers: (kind, factor) pairs for decimation.Decimator
+
+Settings in RELOADABLE take effect while streaming (DRDAQ.reload_config), all
+others at the next run_streaming. window_cycles is for the consumers of the
+blocks, e.g. pqanalysis.PQAnalyzer, they read it from DRDAQ.config.
+"""
+
+import configparser
+import os
+
+# ps4000a range codes by name and their full scale in volts, the only copy of the table:
+# DRDAQ.get_channel_scales and the simulator use it, a count is RANGE_VOLTS[range]/MAX_Y volts
+RANGES = {'10mV':0, '20mV':1, '50mV':2, '100mV':3, '200mV':4, '500mV':5,
+          '1V':6, '2V':7, '5V':8, '10V':9, '20V':10, '50V':11, '100V':12, '200V':13}
+RANGE_VOLTS = [0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0, 10.0, 20.0, 50.0, 100.0, 200.0]
+MAX_Y = 32768
+
+# ps4000a time units by name
+TIME_UNITS = {'fs':0, 'ps':1, 'ns':2, 'us':3, 'ms':4, 's':5}
+
+CHANNEL_NAMES = 'ABCDEFGH'
+
+# section: [(key, type, default)]
+SCHEMA = {
+    'streaming': [('sample_interval', 'int', 2),
+                  ('sample_interval_unit', 'unit', 'us'),
+                  ('buffer_length', 'int', 50000),
+                  ('ring_buffer_blocks', 'int', 16),
+                  ('mains_frequency', 'float', 50.0),
+                  ('align_to_cycles', 'bool', True),
+                  ('poll_interval', 'float', 0.005)],
+    'analysis':  [('window_cycles', 'int', 10),
+                  ('decimation_tiers', 'tiers', 'none')],
+}
+CHANNEL_SCHEMA = [('enabled', 'bool', False),
+                  ('range', 'range', '50V'),
+                  ('dc', 'bool', True),
+                  ('analog_offset', 'float', 0.0)]
+
+# Settings that can change while streaming
+RELOADABLE = ('poll_interval', 'window_cycles', 'decimation_tiers')
+
+
+class ConfigError(ValueError):
+    pass
+
+
+def parse_tiers(text):
+    '''"minmax100,mean10000" -> [('minmax', 100), ('mean', 10000)], "none" -> []'''
+    tiers = []
+    for item in text.replace(' ','').split(','):
+        if item in ('', 'none'):
+            continue
+        kind = item.rstrip('0123456789')
+        if kind not in ('minmax', 'mean') or kind == item or int(item[len(kind):]) < 2:
+            raise ValueError('tiers look like minmax100,mean10000')
+        tiers.append((kind, int(item[len(kind):])))
+    return tiers
+
+
+def parse_value(kind, text):
+    text = text.strip()
+    if kind == 'int':
+        value = int(text)
+        if value <= 0:
+            raise ValueError('must be positive')
+        return value
+    if kind == 'float':
+        return float(text)
+    if kind == 'bool':
+        if text.lower() not in configparser.ConfigParser.BOOLEAN_STATES:
+            raise ValueError('must be yes or no')
+        return configparser.ConfigParser.BOOLEAN_STATES[text.lower()]
+    if kind == 'unit':
+        if text not in TIME_UNITS:
+            raise ValueError('must be one of '+', '.join(TIME_UNITS))
+        return TIME_UNITS[text]
+    if kind == 'range':
+        if text not in RANGES:
+            raise ValueError('must be one of '+', '.join(RANGES))
+        return RANGES[text]
+    if kind == 'tiers':
+        return parse_tiers(text)
+    raise ValueError('unknown type '+kind)
+
+
+def sample_rate_string(intervalSeconds):
+    '''1/interval with an SI prefix, 2e-6 -> '500k' '''
+    rate = 1.0/intervalSeconds
+    for prefix, factor in (('G',1e9), ('M',1e6), ('k',1e3)):
+        if rate >= factor:
+            return '%g%s' % (round(rate/factor, 6), prefix)
+    return '%g' % round(rate, 6)
+
+
+class Config:
+    def __init__(self, values=None, channels=None, path=None):
+        '''values: {key: value} of the SCHEMA settings, defaults for the missing ones
+        channels: {channel number: {key: value}} of the CHANNEL_SCHEMA settings, channel A if None'''
+        self.path = path
+        for section in SCHEMA.values():
+            for key, kind, default in section:
+                setattr(self, key, parse_value(kind, str(default)) if isinstance(default, str) else default)
+        for key, value in (values or {}).items():
+            setattr(self, key, value)
+        if channels is None:
+            channels = {0:{'enabled':True}}
+        self.channels = {}
+        for channel, settings in channels.items():
+            self.channels[channel] = dict((key, parse_value(kind, str(default)) if isinstance(default, str) else default)
+                                          for key, kind, default in CHANNEL_SCHEMA)
+            self.channels[channel].update(settings)
+        self.check()
+        self.derive()
+
+    def check(self):
+        if self.poll_interval <= 0:
+            raise ConfigError('[streaming] poll_interval: must be positive')
+        if self.mains_frequency <= 0:
+            raise ConfigError('[streaming] mains_frequency: must be positive')
+        if not any(settings['enabled'] for settings in self.channels.values()):
+            raise ConfigError('no channel is enabled')
+
+    def derive(self):
+        self.sample_interval_seconds = self.sample_interval*10.0**(3*self.sample_interval_unit-15)
+        self.sample_rate_string = sample_rate_string(self.sample_interval_seconds)
+        self.samples_per_cycle = 1.0/(self.mains_frequency*self.sample_interval_seconds)
+        # whole mains cycles per block, if a cycle has a whole number of samples
+        cycle = int(round(self.samples_per_cycle))
+        if self.align_to_cycles and abs(self.samples_per_cycle-cycle) < 1e-6 and cycle > 0:
+            self.buffer_length = max(int(round(self.buffer_length/float(cycle))), 1)*cycle
+        self.enabled_channels = sorted(channel for channel, settings in self.channels.items() if settings['enabled'])
+
+    def get_channel_settings(self, channel):
+        '''settings of a channel as arguments of DRDAQ.set_channel'''
+        settings = self.channels[channel]
+        return {'channel':channel, 'enabled':settings['enabled'], 'dc':settings['dc'],
+                'vertrange':settings['range'], 'analogOffset':settings['analog_offset']}
+
+    def changes(self, other):
+        '''keys of the settings that differ in the Config other'''
+        changed = [key for section in SCHEMA.values() for key, kind, default in section
+                   if getattr(self, key) != getattr(other, key)]
+        if self.channels != other.channels:
+            changed.append('channels')
+        return changed
+
+
+def load_config(path):
+    '''Config of a parameters.ini, the defaults if the file does not exist'''
+    if path is None or not os.path.exists(path):
+        return Config(path=path)
+    confparser = configparser.ConfigParser()
+    try:
+        confparser.read(path)
+    except configparser.Error as e:
+        raise ConfigError(str(e))
+
+    values = {}
+    channels = {}
+    for section in confparser.sections():
+        if section in SCHEMA:
+            schema = SCHEMA[section]
+            target = values
+        elif section.startswith('channel_') and section[8:] in CHANNEL_NAMES and len(section) == 9:
+            schema = CHANNEL_SCHEMA
+            target = channels.setdefault(CHANNEL_NAMES.index(section[8:]), {})
+        else:
+            raise ConfigError('['+section+']: unknown section')
+        kinds = dict((key, kind) for key, kind, default in schema)
+        for key, text in confparser.items(section):
+            if key not in kinds:
+                raise ConfigError('['+section+'] '+key+': unknown setting')
+            try:
+                target[key] = parse_value(kinds[key], text)
+            except ValueError as e:
+                raise ConfigError('['+section+'] '+key+' = '+text+': '+str(e))
+    return Config(values, channels or None, path)
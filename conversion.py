@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+"""
+Conversion of ADC counts to volts
+
+The factors are precomputed once per run from the channel settings, a block
+is then converted with one multiply (and one subtract if there is an analog
+offset) into a reusable float32 buffer.
+"""
+
+import numpy as np
+
+
+class Converter:
+    def __init__(self, factors, offsets=None):
+        '''factors: volts per count of each channel | offsets: analog offset of each channel in volts'''
+        self.factors = np.asarray(factors, dtype=np.float32).reshape(-1,1)
+        if offsets is None:
+            offsets = np.zeros(len(self.factors))
+        self.offsets = np.asarray(offsets, dtype=np.float32).reshape(-1,1)
+        self.has_offset = bool(self.offsets.any())
+        # Reusable output buffer, grows to the largest block converted
+        self.out = None
+
+    def convert(self, counts, out=None):
+        '''(channels, samples) int16 counts -> float32 volts
+        Without out, the result is written to an internal buffer that is reused by the next call'''
+        if out is None:
+            if self.out is None or self.out.shape[0] != counts.shape[0] or self.out.shape[1] < counts.shape[1]:
+                self.out = np.empty(counts.shape, dtype=np.float32)
+            out = self.out[:,:counts.shape[1]]
+        np.multiply(counts, self.factors, out=out)
+        # the analog offset is added to the input before the ADC, take it off again
+        if self.has_offset:
+            np.subtract(out, self.offsets, out=out)
+        return out
+
+    def to_counts(self, volts):
+        '''float volts -> int16 counts, e.g. for trigger levels'''
+        counts = np.round((np.asarray(volts)+self.offsets)/self.factors)
+        return np.clip(counts, -32768, 32767).astype(np.int16)
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""
+Software decimation: several resolutions of one stream at the same time
+
+Every tier reduces groups of factor samples of every row to
+ - 'minmax': the maximum and the minimum, the rows of a tier block are the maxima
+             of all input rows followed by their minima (as the driver's aggregate mode)
+ - 'mean':   the mean as float32
+and keeps its values in its own ring buffer, so a dashboard can read a small
+preview tier without ever touching the raw data. The full resolution tier is
+the raw stream itself (DRDAQ.get_queue_data).
+
+Samples left over at the end of a block are carried into the next block, so
+the tiers do not depend on the block size. get_start() gives the raw stream
+index of the values last read: a tier counts from its origin, the stream index
+of its first input sample, and also counts the values its ring had to drop.
+"""
+
+import collections
+
+import numpy as np
+
+from ringbuffer import RingBuffer
+
+# (kind, factor) of the default tiers: 1/100 min/max and 1/10000 mean
+DECIMATION_TIERS = (('minmax', 100), ('mean', 10000))
+# Size of the ring buffer of every tier in values
+TIER_CAPACITY = 2**16
+
+
+class Tier:
+    def __init__(self, kind, factor, rows, capacity=TIER_CAPACITY, dtype=np.int16, origin=0):
+        '''kind: 'minmax' or 'mean' | factor: input samples per value | rows: rows of the input blocks
+        origin: raw stream index of the first input sample'''
+        if kind not in ('minmax', 'mean'):
+            raise ValueError('Unknown decimation kind '+str(kind))
+        self.kind = kind
+        self.factor = int(factor)
+        self.rows = rows
+        self.name = kind+str(self.factor)
+        if kind == 'minmax':
+            self.ringbuffer = RingBuffer(capacity, channels=2*rows, dtype=dtype)
+        else:
+            self.ringbuffer = RingBuffer(capacity, channels=rows, dtype=np.float32)
+        # Input samples of an incomplete group, at most factor-1
+        self.carry = np.zeros((rows,self.factor), dtype=dtype)
+        self.carried = 0
+        self.origin = origin
+        # (ring write count, values dropped before it) after every write the ring could not take completely,
+        # consecutive drops share one entry
+        self.gaps = collections.deque()
+        self.dropped_before = 0
+        # raw stream index of the first value last returned by read
+        self.start = origin
+
+    def store(self, values):
+        if self.ringbuffer.write(values) < values.shape[1]:
+            gap = (self.ringbuffer.write_count, self.ringbuffer.dropped)
+            if self.gaps and self.gaps[-1][0] == gap[0]:
+                self.gaps[-1] = gap
+            else:
+                self.gaps.append(gap)
+
+    def read(self, n=None):
+        '''views of the next values, never across values the ring had to drop'''
+        self.ringbuffer.release()
+        position = self.ringbuffer.read_count
+        while self.gaps and self.gaps[0][0] <= position:
+            self.dropped_before = self.gaps.popleft()[1]
+        if self.gaps:
+            gap = self.gaps[0][0]-position
+            n = gap if n is None else min(n, gap)
+        views = self.ringbuffer.read(n)
+        if views:
+            self.start = self.origin + (position+self.dropped_before)*self.factor
+        return views
+
+    def reduce(self, groups):
+        '''(rows, values, factor) -> (output rows, values)'''
+        if self.kind == 'minmax':
+            out = np.empty((2*self.rows,groups.shape[1]), dtype=groups.dtype)
+            np.max(groups, axis=2, out=out[:self.rows])
+            np.min(groups, axis=2, out=out[self.rows:])
+            return out
+        return groups.mean(axis=2, dtype=np.float64).astype(np.float32)
+
+    def process(self, block):
+        n = block.shape[1]
+        start = 0
+        # complete the carried group first, the rest of the block is reduced without a copy
+        if self.carried:
+            start = min(n, self.factor-self.carried)
+            self.carry[:,self.carried:self.carried+start] = block[:,:start]
+            self.carried += start
+            if self.carried < self.factor:
+                return
+            self.store(self.reduce(self.carry[:,np.newaxis,:]))
+            self.carried = 0
+
+        values = (n-start)//self.factor
+        if values:
+            end = start+values*self.factor
+            self.store(self.reduce(block[:,start:end].reshape(self.rows, values, self.factor)))
+            start = end
+        self.carried = n-start
+        self.carry[:,:self.carried] = block[:,start:]
+
+
+class Decimator:
+    def __init__(self, rows, tiers=DECIMATION_TIERS, capacity=TIER_CAPACITY, dtype=np.int16, origin=0):
+        '''rows: rows of the input blocks | tiers: (kind, factor) pairs
+        origin: raw stream index of the first sample that will be processed'''
+        self.tiers = {}
+        for kind, factor in tiers:
+            tier = Tier(kind, factor, rows, capacity, dtype, origin)
+            self.tiers[tier.name] = tier
+        self.samples = 0
+
+    def process(self, block):
+        '''feed the next (rows, samples) block of the raw stream'''
+        for tier in self.tiers.values():
+            tier.process(block)
+        self.samples += block.shape[1]
+
+    def get_data(self, name, n=None):
+        '''new values of a tier as (rows, values) array, None if there are none
+        The array is a view that stays valid until the next call for the same tier'''
+        views = self.tiers[name].read(n)
+        if not views:
+            return None
+        elif len(views) == 1:
+            return views[0]
+        return np.concatenate(views, axis=-1)
+
+    def get_start(self, name):
+        '''index in the raw stream of the first sample of the values last returned by get_data'''
+        return self.tiers[name].start
+
+    def get_stats(self):
+        return dict((name, tier.ringbuffer.get_stats()) for name, tier in self.tiers.items())
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""
+Lazy binding of the Picoscope driver library
+
+load_library() returns one DriverLibrary per library path and process, the
+shared library is loaded when the first DRDAQ needs it, never on import.
+Every function gets its argtypes and restype from PROTOTYPES once, when it
+is first looked up. After that the configured function is an attribute of the
+DriverLibrary, so a call costs the same as on the plain ctypes library.
+
+The library path is LIBNAMES[sys.platform] unless the DRDAQ_LIBNAME
+environment variable names another one.
+"""
+
+import ctypes
+import os
+import sys
+
+LIBNAMES = {'win32':'C:\\Program Files (x86)\\Pico Technology\\PicoScope6\\USBDrDAQ.dll',
+            'linux':'/opt/picoscope/lib/libps4000a.so'}
+
+# ps4000aStreamingReady(handle, noOfSamples, startIndex, overflow, triggerAt, triggered, autoStop, pParameter)
+BUFFER_CALLBACK = ctypes.CFUNCTYPE(
+        None,
+        ctypes.c_int16,
+        ctypes.c_int32,
+        ctypes.c_uint32,
+        ctypes.c_int16,
+        ctypes.c_uint32,
+        ctypes.c_int16,
+        ctypes.c_int16,
+        ctypes.c_void_p)
+
+PICO_STATUS = ctypes.c_uint32
+# enums (channel, coupling, range, time units, ratio mode, trigger direction) are C ints
+ENUM = ctypes.c_int
+P_INT16 = ctypes.POINTER(ctypes.c_int16)
+P_INT32 = ctypes.POINTER(ctypes.c_int32)
+
+# name: (restype, argtypes)
+PROTOTYPES = {
+    'ps4000aOpenUnit':                 (PICO_STATUS, [P_INT16, ctypes.c_char_p]),
+    'ps4000aCloseUnit':                (PICO_STATUS, [ctypes.c_int16]),
+    'ps4000aPingUnit':                 (PICO_STATUS, [ctypes.c_int16]),
+    'ps4000aChangePowerSource':        (PICO_STATUS, [ctypes.c_int16, PICO_STATUS]),
+    'ps4000aEnumerateUnits':           (PICO_STATUS, [P_INT16, ctypes.c_char_p, P_INT16]),
+    'ps4000aSetChannel':               (PICO_STATUS, [ctypes.c_int16, ENUM, ctypes.c_int16, ENUM, ENUM, ctypes.c_float]),
+    'ps4000aSetDataBuffer':            (PICO_STATUS, [ctypes.c_int16, ENUM, P_INT16, ctypes.c_int32, ctypes.c_uint32, ENUM]),
+    'ps4000aSetDataBuffers':           (PICO_STATUS, [ctypes.c_int16, ENUM, P_INT16, P_INT16, ctypes.c_int32, ctypes.c_uint32, ENUM]),
+    'ps4000aGetTimebase':              (PICO_STATUS, [ctypes.c_int16, ctypes.c_uint32, ctypes.c_int32, P_INT32, P_INT32, ctypes.c_uint32]),
+    'ps4000aSetSimpleTrigger':         (PICO_STATUS, [ctypes.c_int16, ctypes.c_int16, ENUM, ctypes.c_int16, ENUM, ctypes.c_uint32, ctypes.c_int16]),
+    'ps4000aRunStreaming':             (PICO_STATUS, [ctypes.c_int16, ctypes.POINTER(ctypes.c_uint32), ENUM, ctypes.c_uint32, ctypes.c_uint32,
+                                                      ctypes.c_int16, ctypes.c_uint32, ENUM, ctypes.c_uint32]),
+    'ps4000aGetStreamingLatestValues': (PICO_STATUS, [ctypes.c_int16, BUFFER_CALLBACK, ctypes.c_void_p]),
+    'ps4000aStop':                     (PICO_STATUS, [ctypes.c_int16]),
+    'UsbDrDaqOpenUnit':                (PICO_STATUS, [P_INT16]),
+    'UsbDrDaqCloseUnit':               (PICO_STATUS, [ctypes.c_int16]),
+    'UsbDrDaqPingUnit':                (PICO_STATUS, [ctypes.c_int16]),
+}
+
+# One DriverLibrary per library path
+libraries = {}
+
+
+def get_libname():
+    return os.environ.get('DRDAQ_LIBNAME') or LIBNAMES.get(sys.platform, LIBNAMES['linux'])
+
+
+class DriverLibrary:
+    def __init__(self, libname):
+        self.libname = libname
+        self.lib = None
+
+    def load(self):
+        '''loads the shared library, raises OSError if it is missing'''
+        if self.lib is None:
+            if sys.platform == 'win32':
+                self.lib = ctypes.windll.LoadLibrary(self.libname)
+            else:
+                self.lib = ctypes.cdll.LoadLibrary(self.libname)
+        return self.lib
+
+    def __getattr__(self, name):
+        # only called for functions that are not bound yet
+        if name.startswith('__'):
+            raise AttributeError(name)
+        function = getattr(self.load(), name)
+        if name in PROTOTYPES:
+            function.restype, function.argtypes = PROTOTYPES[name]
+        setattr(self, name, function)
+        return function
+
+
+def load_library(libname=None):
+    '''the DriverLibrary of libname, by default get_libname()
+    Loads the shared library, so a missing library raises OSError here and not on the first call'''
+    if libname is None:
+        libname = get_libname()
+    if libname not in libraries:
+        library = DriverLibrary(libname)
+        library.load()
+        libraries[libname] = library
+    return libraries[libname]
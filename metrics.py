@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+"""
+Low overhead metrics for the hot paths: counters, gauges and histograms
+
+A disabled Metrics registry hands out NullMetric objects, and the hot paths
+check metrics.enabled once before taking any timestamps, so switching the
+metrics off costs one attribute lookup per callback.
+
+snapshot() returns all values as a dictionary, prometheus_text() in the
+Prometheus text format. serve() makes the text available on a local socket:
+a TCP port (plain HTTP, /metrics can be scraped by Prometheus) or a Unix
+socket path (the text is sent on connect). The servers are imported by
+serve(), importing the module stays cheap for the hot path.
+"""
+
+import bisect
+import os
+import socket
+import threading
+import time
+
+# Upper bounds of the histogram buckets, 1 us to about 1 s
+DURATION_BUCKETS = [1e-6*2**i for i in range(21)]
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{'+','.join('%s="%s"' % item for item in labels)+'}'
+
+
+class NullMetric:
+    '''does nothing, returned by a disabled registry'''
+    value = 0
+
+    def inc(self, n=1):
+        pass
+
+    def set(self, value):
+        pass
+
+    def observe(self, value):
+        pass
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, n=1):
+        self.value += n
+
+
+class Gauge:
+    kind = 'gauge'
+
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, buckets=DURATION_BUCKETS):
+        self.buckets = list(buckets)
+        # one count per bucket plus the +Inf bucket
+        self.counts = [0]*(len(self.buckets)+1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def percentile(self, q):
+        '''upper bound of the bucket that contains the q-th percentile'''
+        if self.count == 0:
+            return None
+        limit = q/100.0*self.count
+        cumulative = 0
+        for bound, count in zip(self.buckets+[float('inf')], self.counts):
+            cumulative += count
+            if cumulative >= limit:
+                return bound
+        return float('inf')
+
+
+class Metrics:
+    def __init__(self, enabled=True, prefix='drdaq_'):
+        self.enabled = enabled
+        self.prefix = prefix
+        self.metrics = {}
+        self.help = {}
+        # metrics are added by any thread while the server thread reads them
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.server = None
+        self.null = NullMetric()
+
+    def get(self, cls, name, help, labels, *args):
+        if not self.enabled:
+            return self.null
+        key = (self.prefix+name, tuple(sorted((labels or {}).items())))
+        metric = self.metrics.get(key)
+        if metric is None:
+            with self.lock:
+                metric = self.metrics.get(key)
+                if metric is None:
+                    metric = self.metrics[key] = cls(*args)
+                    self.help[key[0]] = help
+        return metric
+
+    def items(self):
+        '''((name, labels), metric) of all metrics sorted, a copy taken under the lock'''
+        with self.lock:
+            return sorted(self.metrics.items())
+
+    def counter(self, name, help='', labels=None):
+        return self.get(Counter, name, help, labels)
+
+    def gauge(self, name, help='', labels=None):
+        return self.get(Gauge, name, help, labels)
+
+    def histogram(self, name, help='', labels=None, buckets=DURATION_BUCKETS):
+        return self.get(Histogram, name, help, labels, buckets)
+
+# Output
+    def snapshot(self):
+        '''all metrics as {name{labels}: value}, histograms as dictionaries'''
+        values = {'uptime_seconds':time.time()-self.start_time}
+        for (name, labels), metric in self.items():
+            if metric.kind == 'histogram':
+                value = {'count':metric.count, 'sum':metric.sum,
+                         'p50':metric.percentile(50), 'p99':metric.percentile(99)}
+            else:
+                value = metric.value
+            values[name+format_labels(labels)] = value
+        return values
+
+    def prometheus_text(self):
+        lines = []
+        described = set()
+        for (name, labels), metric in self.items():
+            if name not in described:
+                described.add(name)
+                if self.help.get(name):
+                    lines.append('# HELP %s %s' % (name, self.help[name]))
+                lines.append('# TYPE %s %s' % (name, metric.kind))
+            if metric.kind == 'histogram':
+                cumulative = 0
+                for bound, count in zip(metric.buckets+['+Inf'], metric.counts):
+                    cumulative += count
+                    lines.append('%s_bucket%s %d' % (name, format_labels(labels+(('le',str(bound)),)), cumulative))
+                lines.append('%s_sum%s %r' % (name, format_labels(labels), metric.sum))
+                lines.append('%s_count%s %d' % (name, format_labels(labels), metric.count))
+            else:
+                lines.append('%s%s %r' % (name, format_labels(labels), metric.value))
+        return '\n'.join(lines)+'\n'
+
+# Local socket
+    def serve(self, address=('127.0.0.1', 9464)):
+        '''serve prometheus_text() in a background thread
+        address: (host, port) for HTTP or a path for a Unix socket'''
+        import socketserver
+        import http.server
+        registry = self
+        if isinstance(address, str):
+            if os.path.exists(address):
+                os.remove(address)
+
+            class Handler(socketserver.BaseRequestHandler):
+                def handle(self):
+                    self.request.sendall(registry.prometheus_text().encode())
+
+            self.server = socketserver.ThreadingUnixStreamServer(address, Handler)
+        else:
+            class Handler(http.server.BaseHTTPRequestHandler):
+                def do_GET(self):
+                    body = registry.prometheus_text().encode()
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def log_message(self, format, *args):
+                    pass
+
+            self.server = http.server.ThreadingHTTPServer(address, Handler)
+
+        self.server.daemon_threads = True
+        thread = threading.Thread(target=self.server.serve_forever, name='Metrics server')
+        thread.daemon = True
+        thread.start()
+        return self.server
+
+    def stop_serving(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+def read_unix_socket(path):
+    '''returns the text served on a Unix socket by Metrics.serve(path)'''
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.connect(path)
+    chunks = []
+    while True:
+        chunk = client.recv(65536)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    client.close()
+    return b''.join(chunks).decode()
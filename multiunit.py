@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming from several Picoscopes in one process
+
+Every unit runs its own DRDAQ acquisition thread, the manager only collects
+the blocks, stamps them with the time of their first sample and merges them
+into one stream ordered by time.
+"""
+
+import sys
+import ctypes
+import heapq
+import time
+
+import DrDAQ
+from DrDAQ import DRDAQ
+from driver import load_library
+
+# Blocks of a unit that stopped delivering are held back at most this many seconds
+MERGE_LATENCY = 0.5
+# Seconds between two merges of blocks()
+MERGE_POLL_INTERVAL = 0.005
+# Units of the simulated library that takes over if there is no library or no unit, see DrDAQ.SIMULATE
+SIMULATED_UNITS = 2
+
+
+def get_simulated_library(reason):
+    print('\n'+reason+', switching to fake data mode\n')
+    from simdriver import SimulatedLibrary
+    return SimulatedLibrary(units=SIMULATED_UNITS)
+
+
+def open_library(libname=None, lib=None):
+    '''lib, or the library loaded once per process, the simulated one if there is none and DrDAQ.SIMULATE is set'''
+    if lib is not None:
+        return lib
+    try:
+        return load_library(libname)
+    except OSError:
+        if not DrDAQ.get_simulate():
+            raise
+        return get_simulated_library('No Picoscope library found')
+
+
+def enumerate_units(libname=None, lib=None):
+    '''returns the serial numbers of all connected units'''
+    lib = open_library(libname, lib)
+
+    count = ctypes.c_int16(0)
+    serials = ctypes.create_string_buffer(1024)
+    serialLth = ctypes.c_int16(len(serials))
+    res = lib.ps4000aEnumerateUnits(ctypes.byref(count), serials, ctypes.byref(serialLth))
+    if DrDAQ.VERBOSE:
+        print('==== EnumerateUnits ====')
+        print(' Result: '+str(res)+' (0 = PICO_OK)')
+        print(' Units found: '+str(count.value))
+    if res != 0 or count.value == 0:
+        return []
+    return serials.value.decode().split(',')
+
+
+class DRDAQManager:
+    def __init__(self, serials=None, libname=None, lib=None):
+        '''opens all units in serials, or all connected units if serials is None
+        lib: library object shared by all units, e.g. simdriver.SimulatedLibrary(units=4)'''
+        lib = open_library(libname, lib)
+        if serials is None:
+            serials = enumerate_units(lib=lib)
+            # like DRDAQ.open_unit, the simulator takes over without units only if SIMULATE is set
+            if not serials and DrDAQ.get_simulate() and not self.is_simulated(lib):
+                lib = get_simulated_library('No Picoscope found')
+                serials = enumerate_units(lib=lib)
+        self.lib = lib
+        self.units = {}
+        for serial in serials:
+            self.units[serial] = DRDAQ(serial=serial, libname=libname, lib=lib)
+
+        # Per unit throughput counters
+        self.counters = {}
+        # Merge state: heap of (timestamp, sequence number, serial, block)
+        self.heap = []
+        self.sequence = 0
+        # Time of the sample after the last collected block, per unit
+        self.latest = {}
+
+    def is_simulated(self, lib):
+        simdriver = sys.modules.get('simdriver')
+        return simdriver is not None and isinstance(lib, simdriver.SimulatedLibrary)
+
+    def run_streaming(self, downSampleRatio=1, downSampleRatioMode=0, pollInterval=None):
+        for serial, unit in self.units.items():
+            unit.run_streaming(downSampleRatio, downSampleRatioMode, pollInterval)
+            self.counters[serial] = {'blocks':0, 'samples':0, 'start_time':time.time()}
+            self.latest[serial] = None
+
+    def stop_sampling(self):
+        for unit in self.units.values():
+            unit.stop_sampling()
+
+    def close_units(self):
+        for unit in self.units.values():
+            unit.close_unit()
+
+# Collect the new blocks of all units
+    def poll(self):
+        for serial, unit in self.units.items():
+            data = unit.get_queue_data()
+            if data is None:
+                continue
+            sampleIndex, timestamp = unit.get_block_start()
+            interval = unit.get_value_interval_seconds()
+            heapq.heappush(self.heap, (timestamp, self.sequence, serial, data.copy()))
+            self.sequence += 1
+
+            counter = self.counters[serial]
+            counter['blocks'] += 1
+            counter['samples'] += data.shape[-1]
+            self.latest[serial] = timestamp + data.shape[-1]*interval
+
+# Return the collected blocks in time order as a list of (timestamp, serial, block)
+    def get_merged_blocks(self, maxLatency=MERGE_LATENCY):
+        self.poll()
+        if not self.heap:
+            return []
+
+        # A block can be emitted once every unit has delivered data past its timestamp,
+        # or when it is older than maxLatency compared to the newest data
+        latest = [t for t in self.latest.values() if t is not None]
+        if len(latest) == len(self.latest):
+            watermark = min(latest)
+        else:
+            watermark = float('-inf')
+        watermark = max(watermark, max(latest)-maxLatency)
+
+        blocks = []
+        while self.heap and self.heap[0][0] <= watermark:
+            timestamp, sequence, serial, block = heapq.heappop(self.heap)
+            blocks.append((timestamp, serial, block))
+        return blocks
+
+    def blocks(self, pollInterval=MERGE_POLL_INTERVAL):
+        '''generator of (timestamp, serial, block) over all units, ordered by time'''
+        while any(unit.acquisition_thread is not None for unit in self.units.values()):
+            for block in self.get_merged_blocks():
+                yield block
+            time.sleep(pollInterval)
+
+# Samples per second and blocks of each unit and of all units together
+    def get_throughput(self):
+        now = time.time()
+        throughput = {}
+        total = 0.0
+        for serial, counter in self.counters.items():
+            rate = counter['samples']/max(now-counter['start_time'], 1e-9)
+            throughput[serial] = {'blocks':counter['blocks'],
+                                  'samples':counter['samples'],
+                                  'samples_per_second':rate}
+            total += rate
+        throughput['total_samples_per_second'] = total
+        return throughput
+
+
+if __name__ == '__main__':
+    manager = DRDAQManager()
+    try:
+        manager.run_streaming()
+        end = time.time()+2
+        for timestamp, serial, block in manager.blocks():
+            if time.time() > end:
+                break
+        manager.stop_sampling()
+        print(manager.get_throughput())
+    finally:
+        manager.close_units()
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""
+Incremental power quality analysis of a streamed channel
+
+Blocks of any size are fed to PQAnalyzer.process(). The signal is cut at the
+rising zero crossings into mains cycles, and every cyclesPerWindow cycles
+(10 at 50 Hz, 12 at 60 Hz) into a window. All cycles and windows completed by
+a block are evaluated together with numpy:
+ - per cycle:  RMS and frequency
+ - per window: RMS, frequency, harmonic amplitudes from one FFT and THD
+Samples after the last complete window are kept for the next block.
+With a DRDAQ, feed one row of each block: analyzer.process(pico.get_queue_volts()[0])
+
+Run this file to measure the throughput on a simulated 500 kS/s signal.
+"""
+
+import sys
+import time
+
+import numpy as np
+
+# Number of harmonics evaluated per window, including the fundamental
+HARMONICS = 40
+
+# Minimum distance of two zero crossings in nominal cycles
+CROSSING_HOLDOFF = 0.75
+
+CYCLE_DTYPE = np.dtype([('sample_index','<i8'),   # first sample of the cycle
+                        ('rms','<f8'),
+                        ('frequency','<f8')])
+
+WINDOW_DTYPE = np.dtype([('sample_index','<i8'),  # first sample of the window
+                         ('rms','<f8'),
+                         ('frequency','<f8'),
+                         ('thd','<f8'),
+                         ('harmonics','<f8',(HARMONICS,))])  # amplitudes, harmonics[0] is the fundamental
+
+
+class PQAnalyzer:
+    def __init__(self, sampleRate, frequency=50.0, cyclesPerWindow=None, sampleIndex=0):
+        '''sampleRate in samples per second | frequency: nominal mains frequency
+        sampleIndex: sample index of the first sample that will be processed'''
+        if cyclesPerWindow is None:
+            cyclesPerWindow = 12 if frequency == 60.0 else 10
+        self.sample_rate = float(sampleRate)
+        self.cycles_per_window = cyclesPerWindow
+        self.nominal_cycle = self.sample_rate/frequency
+        # FFT length: the nominal length of a window, harmonic h is then at bin h*cyclesPerWindow
+        self.window_length = int(round(self.nominal_cycle*cyclesPerWindow))
+
+        # Samples not yet part of a complete window and the sample index of the first one
+        self.carry = np.zeros(0)
+        self.carry_index = sampleIndex
+
+    def find_crossings(self, x):
+        '''fractional positions of the rising zero crossings, crossings caused by noise
+        (also those on the falling edge) less than CROSSING_HOLDOFF cycles after the previous one are ignored'''
+        rising = np.flatnonzero((x[:-1] < 0) & (x[1:] >= 0))
+        positions = rising + x[rising]/(x[rising]-x[rising+1])
+        accepted = []
+        for position in positions:
+            if not accepted or position-accepted[-1] > CROSSING_HOLDOFF*self.nominal_cycle:
+                accepted.append(position)
+        return np.array(accepted)
+
+    def process(self, block):
+        '''block: samples of one channel, in volts or counts
+        returns (cycles, windows) as arrays of CYCLE_DTYPE and WINDOW_DTYPE'''
+        x = np.concatenate((self.carry, np.asarray(block, dtype=np.float64)))
+        crossings = self.find_crossings(x)
+
+        # Complete windows, the FFT of the last one must fit into the data as well
+        n = self.cycles_per_window
+        nwindows = max((len(crossings)-1)//n, 0)
+        while nwindows > 0 and int(np.ceil(crossings[(nwindows-1)*n]))+self.window_length > len(x):
+            nwindows -= 1
+
+        if nwindows == 0:
+            # no complete window, keep the data but never more than a few windows (e.g. no signal)
+            self.carry = x[-4*self.window_length:]
+            self.carry_index += len(x)-len(self.carry)
+            return np.zeros(0, dtype=CYCLE_DTYPE), np.zeros(0, dtype=WINDOW_DTYPE)
+
+        used = crossings[:nwindows*n+1]
+        bounds = np.ceil(used).astype(np.int64)
+        squares = np.concatenate(([0.0], np.cumsum(x*x)))
+
+        cycles = np.zeros(nwindows*n, dtype=CYCLE_DTYPE)
+        cycles['sample_index'] = self.carry_index+bounds[:-1]
+        cycles['rms'] = np.sqrt((squares[bounds[1:]]-squares[bounds[:-1]])/np.diff(bounds))
+        cycles['frequency'] = self.sample_rate/np.diff(used)
+
+        starts = bounds[:-1:n]
+        ends = bounds[n::n]
+        windows = np.zeros(nwindows, dtype=WINDOW_DTYPE)
+        windows['sample_index'] = self.carry_index+starts
+        windows['rms'] = np.sqrt((squares[ends]-squares[starts])/(ends-starts))
+        windows['frequency'] = n*self.sample_rate/(used[n::n]-used[:-1:n])
+
+        # One FFT over all windows
+        segments = x[starts[:,None]+np.arange(self.window_length)]
+        spectrum = np.abs(np.fft.rfft(segments, axis=1))*(2.0/self.window_length)
+        harmonics = spectrum[:,n*np.arange(1,HARMONICS+1)]
+        windows['harmonics'] = harmonics
+        windows['thd'] = np.sqrt(np.sum(harmonics[:,1:]**2, axis=1))/harmonics[:,0]
+
+        # Keep the data from the sample before the last used crossing on, it starts the next window
+        keep = int(np.ceil(used[-1]))-1
+        self.carry = x[keep:]
+        self.carry_index += keep
+        return cycles, windows
+
+
+def benchmark(seconds=10, sampleRate=500e3, blockSamples=50000):
+    '''prints the throughput of PQAnalyzer for a distorted 50 Hz signal'''
+    t = np.arange(int(seconds*sampleRate))/sampleRate
+    signal = 325*(np.sin(2*np.pi*50*t) + 0.05*np.sin(2*np.pi*150*t) + 0.03*np.sin(2*np.pi*250*t))
+    signal += np.random.normal(0, 0.5, len(t))
+
+    analyzer = PQAnalyzer(sampleRate)
+    windows = []
+    start = time.perf_counter()
+    for i in range(0, len(signal), blockSamples):
+        windows.append(analyzer.process(signal[i:i+blockSamples])[1])
+    duration = time.perf_counter()-start
+    windows = np.concatenate(windows)
+
+    print('Windows:     %d' % len(windows))
+    print('RMS:         %.2f V' % windows['rms'].mean())
+    print('Frequency:   %.4f Hz' % windows['frequency'].mean())
+    print('THD:         %.2f %%' % (100*windows['thd'].mean()))
+    print('Throughput:  %.2f MS/s, %.1fx realtime' % (len(signal)/duration/1e6, seconds/duration))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        benchmark(sampleRate=float(sys.argv[1]))
+    else:
+        benchmark()
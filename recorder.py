@@ -0,0 +1,408 @@
+# -*- coding: utf-8 -*-
+"""
+Recorder for streamed data: large preallocated segment files instead of one file per block
+
+A recording folder contains
+ - recording.ini:        channels, sample interval, segment size, compression, scale factors,
+                         anchor_ns and sample_interval_fs: time of sample index 0 in ns since the
+                         epoch and the exact sample interval, sample i was taken at
+                         anchor_ns + i*sample_interval_fs//10**6
+ - segment_00000.bin...: raw int16 samples, interleaved as (samples, channels)
+   or segment_00000.dz:  the same blocks, each compressed on its own (see compression.py)
+ - index.bin:            one INDEX_DTYPE record per block
+ - summary.bin:          one summary_dtype record per block: min, max, mean and RMS
+                         of every channel in counts, for queries without the samples
+The writer thread does all the file I/O, the acquisition only hands over the blocks.
+With compression the blocks are compressed in a process pool and written in order,
+the pool is started with start_pool before the acquisition threads.
+A Recording opens the segments with np.memmap and slices time ranges out of them.
+"""
+
+import os
+import queue
+import threading
+import configparser
+import collections
+import multiprocessing
+import concurrent.futures
+
+import numpy as np
+
+import compression
+from config import RANGE_VOLTS, MAX_Y, load_config
+from conversion import Converter
+
+# Samples per segment file and channel, 2**27 samples are 256 MB per channel
+SEGMENT_SAMPLES = 2**27
+
+# Blocks waiting for the writer thread before new blocks are dropped
+RECORDER_QUEUE_BLOCKS = 64
+
+# Compressed blocks in flight per worker of the process pool
+COMPRESSION_BLOCKS_PER_WORKER = 4
+
+# The workers are started by a forkserver, or spawned where there is none, never forked
+# from the acquiring process: a fork copies the locks held by its threads in that moment
+POOL_START_METHOD = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+
+# One index record per block
+INDEX_DTYPE = np.dtype([('segment','<u4'),        # number of the segment file
+                        ('offset','<u8'),         # first sample of the block in the segment
+                        ('samples','<u4'),        # number of samples of the block
+                        ('sample_index','<u8'),   # first sample of the block since the start of the recording
+                        ('timestamp','<f8'),      # time of the first sample in seconds since the epoch
+                        ('byte_offset','<u8'),    # first byte of the block in the segment file
+                        ('nbytes','<u4')])        # bytes of the block in the segment file
+
+SAMPLE_DTYPE = np.dtype('<i2')
+
+
+def summary_dtype(channels):
+    '''one summary record per block, the fields hold one value per channel'''
+    return np.dtype([('min','<i2',(channels,)),
+                     ('max','<i2',(channels,)),
+                     ('mean','<f4',(channels,)),
+                     ('rms','<f4',(channels,))])
+
+
+def block_summary(data):
+    '''summary record of a (samples, channels) block'''
+    summary = np.zeros(1, dtype=summary_dtype(data.shape[1]))
+    if data.shape[0]:
+        values = data.astype(np.float32)
+        summary['min'] = data.min(axis=0)
+        summary['max'] = data.max(axis=0)
+        summary['mean'] = values.mean(axis=0)
+        summary['rms'] = np.sqrt(np.mean(values*values, axis=0))
+    return summary
+
+
+def start_pool(workers=None):
+    '''process pool for Recorder(pool=...) with all workers running, start it before the acquisition threads'''
+    workers = workers or os.cpu_count() or 1
+    pool = concurrent.futures.ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context(POOL_START_METHOD))
+    concurrent.futures.wait([pool.submit(os.getpid) for worker in range(workers)])
+    return pool
+
+
+def segment_filename(folder, segment, compressed=False):
+    return os.path.join(folder, 'segment_%05d.%s' % (segment, 'dz' if compressed else 'bin'))
+
+
+class Recorder:
+    def __init__(self, folder, channels, sampleInterval, segmentSamples=SEGMENT_SAMPLES, queueBlocks=RECORDER_QUEUE_BLOCKS,
+                 compress=False, workers=None, scales=None, anchorNs=None, intervalFs=None, simulated=False, pool=None):
+        '''channels: list of the recorded channel numbers, the rows of the blocks | sampleInterval in seconds
+        compress: store the blocks compressed, using a pool of workers processes
+        pool: the pool of start_pool to compress with, kept running by close. By default the recorder starts its own
+        scales: (factors, offsets) to convert the recorded counts to volts, see DRDAQ.get_channel_scales
+        anchorNs, intervalFs: time of sample index 0 and sample interval as integers, see DRDAQ.get_sample_time_ns
+        simulated: the blocks come from simdriver, not from a unit, noted in recording.ini'''
+        self.folder = folder
+        self.channels = list(channels)
+        self.sample_interval = sampleInterval
+        self.segment_samples = segmentSamples
+        self.compress = compress
+        self.scales = scales
+        self.timing = {}
+        if anchorNs is not None and intervalFs is not None:
+            self.timing = {'anchor_ns':int(anchorNs), 'sample_interval_fs':int(intervalFs)}
+        self.simulated = simulated
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+
+        self.write_info()
+
+        self.segment = -1
+        self.segment_file = None
+        self.segment_used = 0
+        self.segment_bytes = 0
+        self.sample_index = 0
+        self.blocks_written = 0
+        self.blocks_dropped = 0
+        self.index_file = open(os.path.join(folder,'index.bin'), 'ab')
+        self.summary_file = open(os.path.join(folder,'summary.bin'), 'ab')
+
+        # Compression runs in worker processes, results are written in the order of the blocks
+        self.pool = None
+        self.own_pool = False
+        self.pending = collections.deque()
+        if compress:
+            self.pool = pool
+            if pool is None:
+                self.pool = start_pool(workers)
+                self.own_pool = True
+            self.max_pending = COMPRESSION_BLOCKS_PER_WORKER*(workers or os.cpu_count() or 1)
+
+        self.blockqueue = queue.Queue(maxsize=queueBlocks)
+        self.writer_thread = threading.Thread(target=self.writer_loop, name='Recorder')
+        self.writer_thread.daemon = True
+        self.writer_thread.start()
+
+    def write_info(self, **extra):
+        confparser = configparser.ConfigParser()
+        confparser['recording'] = {'channels':','.join(str(c) for c in self.channels),
+                                   'sample_interval':repr(self.sample_interval),
+                                   'segment_samples':str(self.segment_samples),
+                                   'dtype':SAMPLE_DTYPE.str,
+                                   'compression':compression.CODEC if self.compress else 'none'}
+        if self.scales is not None:
+            factors, offsets = self.scales
+            confparser['recording']['scale_factors'] = ','.join(repr(float(f)) for f in factors)
+            confparser['recording']['analog_offsets'] = ','.join(repr(float(o)) for o in offsets)
+        if self.simulated:
+            confparser['recording']['simulated'] = 'true'
+        for key, value in list(self.timing.items())+list(extra.items()):
+            confparser['recording'][key] = str(value)
+        with open(os.path.join(self.folder,'recording.ini'), 'w') as f:
+            confparser.write(f)
+
+# Acquisition side, never blocks
+    def write(self, block, timestamp, sampleIndex=None):
+        '''hand a (channels, samples) block to the writer thread, returns False if it was dropped'''
+        # The one copy of the block, also interleaves it to (samples, channels) for the file
+        data = np.ascontiguousarray(block.T, dtype=SAMPLE_DTYPE)
+        try:
+            self.blockqueue.put_nowait((data, timestamp, sampleIndex))
+            return True
+        except queue.Full:
+            self.blocks_dropped += 1
+            return False
+
+    def close(self):
+        self.blockqueue.put(None)
+        self.writer_thread.join()
+        if self.own_pool:
+            self.pool.shutdown()
+        self.close_segment()
+        self.index_file.close()
+        self.summary_file.close()
+        self.write_info(blocks=self.blocks_written, samples=self.sample_index, blocks_dropped=self.blocks_dropped)
+
+# Writer thread
+    def writer_loop(self):
+        while True:
+            try:
+                item = self.blockqueue.get(timeout=0.1)
+            except queue.Empty:
+                self.write_compressed()
+                continue
+            if item is None:
+                break
+            data, timestamp, sampleIndex = item
+            summary = block_summary(data)
+            if self.pool is None:
+                self.write_block(data.shape[0], memoryview(data).cast('B'), timestamp, sampleIndex, summary)
+            else:
+                future = self.pool.submit(compression.compress_block, data)
+                self.pending.append((future, data.shape[0], timestamp, sampleIndex, summary))
+                self.write_compressed()
+        self.write_compressed(wait=True)
+
+    def write_compressed(self, wait=False):
+        '''write the compressed blocks that are done, in order, waits if too many are in flight'''
+        while self.pending:
+            future, samples, timestamp, sampleIndex, summary = self.pending[0]
+            if not (wait or future.done() or len(self.pending) > self.max_pending):
+                return
+            self.pending.popleft()
+            self.write_block(samples, future.result(), timestamp, sampleIndex, summary)
+
+    def write_block(self, samples, payload, timestamp, sampleIndex, summary):
+        if self.segment_file is None or self.segment_used+samples > self.segment_samples:
+            self.open_segment(max(samples, self.segment_samples))
+        if sampleIndex is None:
+            sampleIndex = self.sample_index
+
+        nbytes = len(payload)
+        self.segment_file.write(payload)
+
+        record = np.array([(self.segment, self.segment_used, samples, sampleIndex, timestamp, self.segment_bytes, nbytes)], dtype=INDEX_DTYPE)
+        # the summary first, a reader never finds an index record without its summary
+        self.summary_file.write(summary.tobytes())
+        self.summary_file.flush()
+        self.index_file.write(record.tobytes())
+        self.index_file.flush()
+
+        self.segment_used += samples
+        self.segment_bytes += nbytes
+        self.sample_index = sampleIndex+samples
+        self.blocks_written += 1
+
+    def open_segment(self, samples):
+        self.close_segment()
+        self.segment += 1
+        self.segment_used = 0
+        self.segment_bytes = 0
+        self.segment_file = open(segment_filename(self.folder,self.segment,self.compress), 'w+b', buffering=0)
+        # Preallocate the whole segment so that the file system does not fragment it,
+        # compressed segments never get larger than raw ones
+        size = samples*len(self.channels)*SAMPLE_DTYPE.itemsize
+        if hasattr(os, 'posix_fallocate'):
+            os.posix_fallocate(self.segment_file.fileno(), 0, size)
+        else:
+            self.segment_file.truncate(size)
+
+    def close_segment(self):
+        if self.segment_file is None:
+            return
+        # Cut off the unused preallocated part
+        self.segment_file.truncate(self.segment_bytes)
+        self.segment_file.close()
+        self.segment_file = None
+
+
+def read_info(folder):
+    '''the [recording] section of recording.ini of a folder'''
+    confparser = configparser.ConfigParser()
+    confparser.read(os.path.join(folder,'recording.ini'))
+    return confparser['recording']
+
+
+def read_scales(info):
+    '''(factors, offsets) of a [recording] section, None if it has none'''
+    if 'scale_factors' not in info:
+        return None
+    factors = [float(f) for f in info['scale_factors'].split(',')]
+    offsets = [float(o) for o in info['analog_offsets'].split(',')]
+    return factors, offsets
+
+
+def read_parameter_scales(folder, channels):
+    '''(factors, offsets) from the channel ranges of the parameters.ini copied into folder,
+    None if there is none or it lacks a channel'''
+    path = os.path.join(folder, 'parameters.ini')
+    if not os.path.exists(path):
+        return None
+    settings = load_config(path).channels
+    if any(channel not in settings for channel in channels):
+        return None
+    factors = [RANGE_VOLTS[settings[channel]['range']]/MAX_Y for channel in channels]
+    offsets = [settings[channel]['analog_offset'] for channel in channels]
+    return factors, offsets
+
+
+class Recording:
+    def __init__(self, folder):
+        self.folder = folder
+        info = read_info(folder)
+        self.channels = [int(c) for c in info['channels'].split(',')]
+        self.sample_interval = float(info['sample_interval'])
+        self.dtype = np.dtype(info.get('dtype', SAMPLE_DTYPE.str))
+        self.compressed = info.get('compression', 'none') != 'none'
+        # The samples are stored as counts, the converter turns them into volts
+        self.converter = None
+        scales = read_scales(info)
+        if scales is not None:
+            self.converter = Converter(*scales)
+        # Integer timing, missing in recordings of older versions
+        self.anchor_ns = int(info['anchor_ns']) if 'anchor_ns' in info else None
+        self.interval_fs = int(info['sample_interval_fs']) if 'sample_interval_fs' in info else None
+        # True if the blocks came from the simulator
+        self.simulated = info.get('simulated', 'false') == 'true'
+
+        self.index = np.fromfile(os.path.join(folder,'index.bin'), dtype=INDEX_DTYPE)
+        # Per block summaries, missing in recordings of older versions
+        self.summary = None
+        summaryfile = os.path.join(folder,'summary.bin')
+        if os.path.exists(summaryfile):
+            self.summary = np.fromfile(summaryfile, dtype=summary_dtype(len(self.channels)))[:len(self.index)]
+        self.segments = {}
+
+    def __len__(self):
+        return len(self.index)
+
+    def get_segment(self, segment):
+        '''memmap of a segment file, opened on first use
+        (samples, channels) for raw segments, bytes for compressed segments'''
+        if segment not in self.segments:
+            blocks = self.index[self.index['segment'] == segment]
+            nbytes = int((blocks['byte_offset']+blocks['nbytes']).max())
+            filename = segment_filename(self.folder,segment,self.compressed)
+            if self.compressed:
+                self.segments[segment] = np.memmap(filename, dtype=np.uint8, mode='r', shape=(nbytes,))
+            else:
+                samples = nbytes//(len(self.channels)*self.dtype.itemsize)
+                self.segments[segment] = np.memmap(filename, dtype=self.dtype, mode='r', shape=(samples,len(self.channels)))
+        return self.segments[segment]
+
+    def get_block(self, blocknumber):
+        '''(channels, samples) of one block, a view for raw recordings'''
+        record = self.index[blocknumber]
+        segment = self.get_segment(int(record['segment']))
+        samples = int(record['samples'])
+        if self.compressed:
+            start = int(record['byte_offset'])
+            payload = segment[start:start+int(record['nbytes'])]
+            return compression.decompress_block(payload, samples, len(self.channels)).T
+        offset = int(record['offset'])
+        return segment[offset:offset+samples].T
+
+    def get_cuts(self, t1, t2):
+        '''(block number, first sample, end sample) of the parts of the blocks between the times t1 and t2
+        A sample stands for the interval up to the next one: from the sample of t1 up to, not including,
+        the sample of t2, so the cuts of (t1, t2) and (t2, t3) neither overlap nor miss a sample.
+        With the integer timing a time counts as the nearest sample: float seconds since the epoch
+        resolve only about 0.2 us, less than a sample interval'''
+        if self.anchor_ns is not None and self.interval_fs is not None:
+            # nearest sample: the sample at or after half an interval earlier
+            half = self.interval_fs//(2*10**6)
+            first = self.get_sample_index(int(round(t1*1e9))-half)
+            last = self.get_sample_index(int(round(t2*1e9))-half)
+            starts = self.index['sample_index'].astype(np.int64)
+            ends = starts + self.index['samples']
+            cuts = []
+            for blocknumber in range(np.searchsorted(ends, first, side='right'), np.searchsorted(starts, last, side='left')):
+                start = max(first-int(starts[blocknumber]), 0)
+                stop = min(last-int(starts[blocknumber]), int(self.index['samples'][blocknumber]))
+                if stop > start:
+                    cuts.append((blocknumber, start, stop))
+            return cuts
+
+        # recordings of older versions: float seconds
+        timestamps = self.index['timestamp']
+        ends = timestamps + self.index['samples']*self.sample_interval
+        cuts = []
+        for blocknumber in range(np.searchsorted(ends, t1, side='right'), np.searchsorted(timestamps, t2, side='left')):
+            start = max(int(np.floor((t1-timestamps[blocknumber])/self.sample_interval)), 0)
+            stop = min(int(np.floor((t2-timestamps[blocknumber])/self.sample_interval)), int(self.index['samples'][blocknumber]))
+            if stop > start:
+                cuts.append((blocknumber, start, stop))
+        return cuts
+
+    def get_samples(self, t1, t2, channel=None):
+        '''samples between the times t1 and t2 (seconds since the epoch) as (channels, samples),
+        or only the samples of one channel, gaps between blocks are left out, see get_cuts'''
+        pieces = [self.get_block(blocknumber)[:,start:stop] for blocknumber, start, stop in self.get_cuts(t1, t2)]
+
+        if not pieces:
+            data = np.zeros((len(self.channels),0), dtype=self.dtype)
+        elif len(pieces) == 1:
+            data = pieces[0]
+        else:
+            data = np.concatenate(pieces, axis=1)
+
+        if channel is None:
+            return data
+        return data[self.channels.index(channel)]
+
+    def get_sample_time_ns(self, sampleIndex):
+        '''time of a sample index (as in the index records) in ns since the epoch'''
+        return self.anchor_ns + sampleIndex*self.interval_fs//10**6
+
+    def get_sample_index(self, timeNs):
+        '''index of the sample taken at timeNs or just after it, e.g. to align two recordings:
+        other.get_sample_index(recording.get_sample_time_ns(i))'''
+        return -((self.anchor_ns-timeNs)*10**6//self.interval_fs)
+
+    def get_volts(self, t1, t2):
+        '''same as get_samples, converted to float32 volts
+        Without scale factors in recording.ini the ranges of the copied parameters.ini are used'''
+        if self.converter is None:
+            scales = read_parameter_scales(self.folder, self.channels)
+            if scales is None:
+                raise ValueError(self.folder+': no scale factors in recording.ini and no channel ranges in parameters.ini, '
+                                 'get_samples returns the counts')
+            self.converter = Converter(*scales)
+        counts = self.get_samples(t1, t2)
+        return self.converter.convert(counts, out=np.empty(counts.shape, dtype=np.float32))
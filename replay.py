@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+"""
+Replay of recorded sessions, for testing analysis code without capturing again
+
+A recording folder (see recorder.py) is read through np.memmap and played back
+in two ways:
+ - Replay(folder) yields the recorded blocks with their original sizes,
+   sample indices and timestamps, for code that takes blocks directly
+ - open_replay(folder) returns a DRDAQ whose driver is a ReplayLibrary, so the
+   blocks go through the buffer callback, the ring buffer and get_queue_data
+   like a live stream, together with the copied parameters.ini
+
+speed=1.0 plays the recording in real time, speed=10.0 ten times faster and
+speed=None as fast as the consumers allow. With speed=None the ReplayLibrary
+only delivers the next block when the consumer has taken the last one, so no
+sample is ever dropped, get_queue_data returns the recorded blocks one by one
+and every replay gives the consumers exactly the same data.
+
+    pico = open_replay(folder)
+    pico.run_streaming(session=False)
+    while not pico.lib.is_finished() or pico.ringbuffer.available():
+        data = pico.get_queue_data(timeout=0.1)
+
+session=False keeps the replayed run out of the data directory, without it
+run_streaming creates a session folder like for a live run.
+
+A replayed run keeps the anchor of the recording, so get_block_start returns
+the original times. Gaps in the recording (blocks dropped while recording) are
+closed up, the sample indices after a gap are those of the replay.
+"""
+
+import os
+import time
+
+from config import Config, TIME_UNITS, load_config
+from recorder import Recording
+from simdriver import SimulatedLibrary, PICO_OK, PICO_INVALID_HANDLE, deref, value
+
+# Seconds a paced Replay sleeps at most before checking the time again
+REPLAY_SLEEP = 0.01
+
+# Poll interval of the acquisition thread of a DRDAQ replaying as fast as possible
+REPLAY_POLL_INTERVAL = 0.00005
+
+
+def get_config(folder):
+    '''Config of a recording: the parameters.ini copied into the folder,
+    or the channels and the sample interval of recording.ini'''
+    path = os.path.join(folder, 'parameters.ini')
+    if os.path.exists(path):
+        return load_config(path)
+    recording = Recording(folder)
+    if recording.interval_fs is not None:
+        intervalFs = recording.interval_fs
+    else:
+        intervalFs = int(round(recording.sample_interval*1e15))
+    # the largest time unit that holds the interval as an integer
+    unit = max(u for u in TIME_UNITS.values() if intervalFs % 10**(3*u) == 0)
+    values = {'sample_interval':intervalFs//10**(3*unit), 'sample_interval_unit':unit, 'align_to_cycles':False}
+    return Config(values, dict((channel, {'enabled':True}) for channel in set(recording.channels)))
+
+
+def get_anchor_ns(recording):
+    '''time of the first recorded sample in ns since the epoch'''
+    if len(recording) == 0:
+        return time.time_ns()
+    first = recording.index[0]
+    if recording.anchor_ns is not None:
+        return recording.get_sample_time_ns(int(first['sample_index']))
+    return int(round(float(first['timestamp'])*1e9))
+
+
+class Replay:
+    def __init__(self, folder, speed=None):
+        '''speed: factor to real time, None for as fast as the blocks are taken'''
+        self.recording = Recording(folder)
+        self.speed = speed
+
+    def __len__(self):
+        return len(self.recording)
+
+    def __iter__(self):
+        '''(sample index, timestamp, (channels, samples) block) of every recorded block
+        The block is a view into the segment file if the recording is not compressed'''
+        index = self.recording.index
+        start = time.perf_counter()
+        for blocknumber in range(len(index)):
+            record = index[blocknumber]
+            if self.speed is not None:
+                # a block is complete when its last sample is taken
+                due = start + (float(record['timestamp']-index[0]['timestamp'])
+                               + int(record['samples'])*self.recording.sample_interval)/self.speed
+                while time.perf_counter() < due:
+                    time.sleep(min(due-time.perf_counter(), REPLAY_SLEEP))
+            yield int(record['sample_index']), float(record['timestamp']), self.recording.get_block(blocknumber)
+
+
+class ReplayLibrary(SimulatedLibrary):
+    def __init__(self, folder, speed=None):
+        '''a simulated ps4000a with one unit, that streams the blocks of a recording folder
+        speed: factor to real time, None for as fast as consumer_ready allows'''
+        SimulatedLibrary.__init__(self, speed=speed)
+        self.recording = Recording(folder)
+        # DRDAQ.run_streaming takes this as the anchor of the run
+        self.anchor_ns = get_anchor_ns(self.recording)
+        # Callable returning True when the consumer has taken all delivered samples,
+        # then the next block is delivered. None delivers the blocks when they are due
+        self.consumer_ready = None
+        self.block = 0
+        self.offset = 0
+        self.delivered = 0
+        self.finished = False
+
+    def is_finished(self):
+        '''True after the last recorded block was delivered'''
+        return self.finished
+
+    def ps4000aRunStreaming(self, handle, sampleInterval, sampleIntervalTimeUnits, maxPreTriggerSamples,
+                            maxPostTriggerSamples, autoStop, downSampleRatio, downSampleRatioMode, overviewBufferSize):
+        unit = self.get_unit(handle)
+        if unit is None:
+            return PICO_INVALID_HANDLE
+        # the recorded values are replayed as samples, at the interval of the recording
+        unit.sample_rate = 1.0/self.recording.sample_interval
+        if self.recording.interval_fs is not None:
+            scale = 10**(3*value(sampleIntervalTimeUnits))
+            if self.recording.interval_fs % scale == 0:
+                deref(sampleInterval).value = self.recording.interval_fs//scale
+        unit.buffer_length = value(overviewBufferSize)
+        unit.ratio = 1
+        unit.ratio_mode = value(downSampleRatioMode)
+        unit.write_position = 0
+        self.block = 0
+        self.offset = 0
+        self.delivered = 0
+        self.finished = len(self.recording) == 0
+        unit.streaming = True
+        unit.start = self.now()
+        return PICO_OK
+
+    def ps4000aGetStreamingLatestValues(self, handle, lpPs4000aReady, pParameter=None):
+        unit = self.get_unit(handle)
+        if unit is None:
+            return PICO_INVALID_HANDLE
+        if not unit.streaming or self.finished:
+            return PICO_OK
+
+        due = None
+        if self.speed is not None:
+            due = self.due(unit.start, unit.sample_rate)
+        blocks = len(self.recording)
+        if self.consumer_ready is not None:
+            if not self.consumer_ready():
+                return PICO_OK
+            # one block per call
+            blocks = self.block+1
+
+        index = self.recording.index
+        while self.block < blocks:
+            samples = int(index[self.block]['samples'])
+            # a block is delivered when all its samples are due, like the driver does
+            if due is not None and self.delivered+samples-self.offset > due:
+                break
+            start = unit.write_position
+            chunk = min(samples-self.offset, unit.buffer_length-start)
+            self.fill(unit, self.recording.get_block(self.block), start, chunk)
+            lpPs4000aReady(value(handle), chunk, start, 0, 0, 0, 0, pParameter)
+            unit.write_position = (start+chunk) % unit.buffer_length
+            self.delivered += chunk
+            self.offset += chunk
+            if self.offset == samples:
+                self.block += 1
+                self.offset = 0
+        self.finished = self.block == len(self.recording)
+        return PICO_OK
+
+    def fill(self, unit, block, start, chunk):
+        '''chunk samples of a recorded block into the buffers, rows of a channel that
+        appears twice (aggregate mode) go into its maximum and minimum buffer'''
+        filled = set()
+        for row, channel in enumerate(self.recording.channels):
+            buffers = unit.min_buffers if channel in filled else unit.buffers
+            filled.add(channel)
+            if channel in buffers:
+                buffers[channel][start:start+chunk] = block[row,self.offset:self.offset+chunk]
+
+
+def open_replay(folder, speed=None, metrics=None):
+    '''DRDAQ that streams the recording in folder, with the settings of its parameters.ini'''
+    import DrDAQ
+    library = ReplayLibrary(folder, speed)
+    pico = DrDAQ.DRDAQ(lib=library, metrics=metrics, config=get_config(folder))
+    if speed is None:
+        # the ring buffer is created again when the settings change, look it up every time
+        library.consumer_ready = lambda: pico.ringbuffer.lag() == 0
+        # the acquisition thread delivers the next block as soon as the consumer is ready
+        pico.poll_interval = REPLAY_POLL_INTERVAL
+    return pico
+
+
+if __name__ == '__main__':
+    # Replays a recording twice through the DRDAQ pipeline into a PQAnalyzer
+    import sys
+    import hashlib
+    from pqanalysis import PQAnalyzer
+
+    folder = sys.argv[1]
+    speed = float(sys.argv[2]) if len(sys.argv) > 2 else None
+    for run in range(2):
+        pico = open_replay(folder, speed)
+        analyzer = PQAnalyzer(1.0/pico.lib.recording.sample_interval, pico.config.mains_frequency, pico.config.window_cycles)
+        digest = hashlib.sha1()
+        samples = 0
+        start = time.perf_counter()
+        pico.run_streaming(session=False)
+        while not pico.lib.is_finished() or pico.ringbuffer.available():
+            data = pico.get_queue_volts(timeout=0.1)
+            if data is None:
+                continue
+            samples += data.shape[1]
+            cycles, windows = analyzer.process(data[0])
+            digest.update(windows.tobytes())
+        pico.stop_sampling()
+        pico.close_unit()
+        duration = time.perf_counter()-start
+        recorded = samples*pico.lib.recording.sample_interval
+        print(' Run %d: %d samples, %.1f s recorded in %.2f s (%.0fx), windows %s'
+              % (run+1, samples, recorded, duration, recorded/duration, digest.hexdigest()[:12]))
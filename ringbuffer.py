@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""
+Fixed size single-producer/single-consumer ring buffer for streamed samples
+
+The producer (the buffer callback) only ever touches write_count, the
+consumer only ever touches read_count, so no lock is needed between them.
+If the consumer falls behind, new samples that do not fit are dropped and
+counted instead of growing the memory.
+"""
+
+import numpy as np
+
+
+class RingBuffer:
+    def __init__(self, capacity, channels=None, dtype=np.int16):
+        '''capacity in samples | channels=None gives a 1-D ring, otherwise one row per channel'''
+        self.capacity = int(capacity)
+        if channels is None:
+            self.data = np.zeros(self.capacity, dtype=dtype)
+        else:
+            self.data = np.zeros((channels,self.capacity), dtype=dtype)
+
+        # Total number of samples ever written / read, only grow
+        self.write_count = 0
+        self.read_count = 0
+        # Samples handed out by the last read(), released on the next read()
+        self.pending = 0
+
+        # Overrun accounting
+        self.dropped = 0
+        self.high_water = 0
+
+# Producer side
+    def write(self, data):
+        '''copy data (samples in the last axis) into the ring, returns the number of samples stored'''
+        n = data.shape[-1]
+        free = self.capacity - (self.write_count - self.read_count)
+        if n > free:
+            self.dropped += n - free
+            n = free
+            data = data[...,:n]
+        if n == 0:
+            return 0
+
+        position = self.write_count % self.capacity
+        first = min(n, self.capacity-position)
+        self.data[...,position:position+first] = data[...,:first]
+        if first < n:
+            self.data[...,:n-first] = data[...,first:]
+
+        # Publish the samples only after they are copied
+        self.write_count += n
+        fill = self.write_count - self.read_count
+        if fill > self.high_water:
+            self.high_water = fill
+        return n
+
+# Consumer side
+    def read(self, n=None):
+        '''returns a list of one view, or two views if the data wraps around the end of the ring
+        The views stay valid until the next call of read() or release()'''
+        self.release()
+        available = self.write_count - self.read_count
+        if n is None or n > available:
+            n = available
+        if n == 0:
+            return []
+
+        position = self.read_count % self.capacity
+        first = min(n, self.capacity-position)
+        self.pending = n
+        if first == n:
+            return [self.data[...,position:position+n]]
+        return [self.data[...,position:], self.data[...,:n-first]]
+
+    def release(self):
+        '''give the samples of the last read() back to the producer'''
+        if self.pending:
+            self.read_count += self.pending
+            self.pending = 0
+
+    def clear(self):
+        self.pending = 0
+        self.read_count = self.write_count
+
+    def reset_stats(self):
+        '''starts the overrun accounting again, e.g. for a new run'''
+        self.dropped = 0
+        self.high_water = self.lag()
+
+# Statistics
+    def available(self):
+        '''samples written but not yet read'''
+        return self.write_count - self.read_count - self.pending
+
+    def lag(self):
+        '''samples the consumer is behind the producer, including unreleased ones'''
+        return self.write_count - self.read_count
+
+    def get_stats(self):
+        return {'capacity':self.capacity,
+                'written':self.write_count,
+                'read':self.read_count,
+                'lag':self.lag(),
+                'high_water':self.high_water,
+                'dropped':self.dropped}
@@ -5,47 +5,94 @@ Created on Sat Mar  7 12:26:44 2015
 @author: mbeltle
 """
 
+import os
 import sys
 import ctypes
 import time
+import threading
 import numpy as np
 
+from ringbuffer import RingBuffer
+from simdriver import SimulatedLibrary
+
 LIBNAME = 'C:\Program Files (x86)\Pico Technology\PicoScope6\\USBDrDAQ.dll'
 
-recording_block = ctypes.c_int16(200000)
-wanted_no_of_samples= ctypes.c_int16(20000)
-channel = ctypes.c_int16(4)
-no_of_active_channels=ctypes.c_int16(1)
-measurement_results = (ctypes.c_short * 20000)()
+# Default settings, each DRDAQ instance keeps its own copy
+US_FOR_BLOCK = 200000       # duration of one block in microseconds
+NO_OF_SAMPLES = 20000       # samples per channel and block
+CHANNELS = [4]              # USB DrDAQ channel numbers
+
+# UsbDrDaqRun methods
+BM_SINGLE = 0
+BM_WINDOW = 1
+BM_STREAM = 2
 
+# Ready polling of the continuous mode: first poll at this fraction of the expected block time,
+# then polls with a pause growing from READY_POLL_MIN to READY_POLL_MAX seconds
+READY_LEAD = 0.9
+READY_POLL_MIN = 50e-6
+READY_POLL_MAX = 2e-3
 
+# Size of the ring buffer of the continuous mode in blocks
+RING_BUFFER_BLOCKS = 16
 
 VERBOSE = 1
+# If 1, or with the environment variable DRDAQ_SIMULATE=1, uses simdriver.SimulatedLibrary
+# when the USBDrDAQ.dll is missing, see DrDAQ.SIMULATE
+SIMULATE = 0
 
 
 class DRDAQ:
-    def __init__(self):
-        self.handle = None   
-        self.lib = ctypes.windll.LoadLibrary(LIBNAME)
+    def __init__(self, lib=None, usForBlock=US_FOR_BLOCK, noOfSamples=NO_OF_SAMPLES, channels=CHANNELS):
+        '''lib: library object to use instead of the USBDrDAQ.dll, e.g. a simdriver.SimulatedLibrary'''
+        self.handle = None
+        if lib is not None:
+            self.lib = lib
+        else:
+            try:
+                self.lib = ctypes.windll.LoadLibrary(LIBNAME)
+            except (OSError, AttributeError):
+                if not (SIMULATE or os.environ.get('DRDAQ_SIMULATE', '0') not in ('', '0')):
+                    raise
+                print('\nNo Picoscope library found, switching to fake data mode\n')
+                self.lib = SimulatedLibrary()
+
+        # Interval settings of this instance
+        self.us_for_block = ctypes.c_int32(usForBlock)
+        self.no_of_samples = noOfSamples
+        self.channels = (ctypes.c_int16 * len(channels))(*channels)
+        self.no_of_active_channels = len(channels)
+
+        # Two block buffers, one is read by the driver while the other one is handed to the consumer
+        length = noOfSamples*len(channels)
+        self.block_buffers = [(ctypes.c_short * length)(), (ctypes.c_short * length)()]
+        self.block_arrays = [np.ctypeslib.as_array(b).reshape(noOfSamples,len(channels)) for b in self.block_buffers]
+        self.measurement_results = self.block_buffers[0]
+
+        # Continuous mode
+        self.continuous_thread = None
+        self.stop_event = threading.Event()
+        self.ringbuffer = None
+        self.ready_estimate = usForBlock*1e-6
+        self.blocks = 0
+        self.ready_polls = 0
+        self.dead_time = 0.0
+
         self.handle = self.open_unit()
         #self.get_DAQ_vertical_scaling()
         self.set_DAQ_interval()
-    
+
     def open_unit(self):
-        if VERBOSE: 
+        if VERBOSE:
                 print('===Connecting to DRDAQ====')
-        try:
-            self.handle=ctypes.c_int16() 
-            DrDaqStatus = self.lib.UsbDrDaqOpenUnit(ctypes.byref(self.handle))
-        except OSError:
-            print('\nNo Picoscope library found, switching to fake data mode\n')
-        
-        
+        self.handle=ctypes.c_int16()
+        DrDaqStatus = self.lib.UsbDrDaqOpenUnit(ctypes.byref(self.handle))
+
         if VERBOSE:
             print(' PicoStatus: '+str(DrDaqStatus))
             print(' Handle is '+str(self.handle.value))
         return self.handle
-            
+
     def close_unit(self):
         if VERBOSE:
             print('\n ===Closing Connection to DRDAQ====')
@@ -55,76 +102,165 @@ class DRDAQ:
                 print(' PicoStatus: '+str(res))
         except OSError:
             print('Closing failed')
-        
+
     def get_DAQ_info(self):
         print('Not yet implemented')
-        
+
     def set_DAQ_interval(self):
         if VERBOSE:
             print('\n ===Setting Sampling Rate===')
-        res = self.lib.UsbDrDaqSetInterval(self.handle,ctypes.byref(recording_block),wanted_no_of_samples,ctypes.byref(channel),no_of_active_channels)
+        res = self.lib.UsbDrDaqSetInterval(self.handle,ctypes.byref(self.us_for_block),self.no_of_samples,self.channels,self.no_of_active_channels)
         if VERBOSE:
             print(' Status of interval setting: '+str(res))
-    
+
     def run_single_shot(self):
-        res= self.lib.UsbDrDaqRun(self.handle,wanted_no_of_samples,ctypes.c_int16(1))
+        res= self.lib.UsbDrDaqRun(self.handle,self.no_of_samples,ctypes.c_int16(BM_WINDOW))
         if VERBOSE:
             print('\n Initialising single shot measurement')
             print(' Status of single shot run: '+str(res))
-    
+
     def sampling_done(self):
         done = ctypes.c_bool(0)
         res = self.lib.UsbDrDaqReady(self.handle,ctypes.byref(done))
         if VERBOSE:
-            print('\n Checking if sampling is done')            
+            print('\n Checking if sampling is done')
             print(' PicoStatus: '+str(res))
             print(' Sampling done is: '+str(done))
-            
+        return done.value
+
     def stop_sampling(self):
         res= self.lib.UsbDrDaqStop(self.handle)
         if VERBOSE:
             print('\n ===Stopping Sampling===')
             print('PicoStatus: '+str(res))
-    
-    def get_sampled_values(self):
-        noOfValues = wanted_no_of_samples
+
+    def get_sampled_values(self, bufferIndex=0):
+        '''reads the last block into one of the block buffers, returns it as (samples, channels) array'''
+        noOfValues = ctypes.c_uint32(self.no_of_samples)
         Overflow = ctypes.c_int16(0)
-        res= self.lib.UsbDrDaqGetValues(self.handle,ctypes.byref(measurement_results),ctypes.byref(noOfValues),ctypes.byref(Overflow),None)
+        res= self.lib.UsbDrDaqGetValues(self.handle,ctypes.byref(self.block_buffers[bufferIndex]),ctypes.byref(noOfValues),ctypes.byref(Overflow),None)
+        samples = self.block_arrays[bufferIndex][:noOfValues.value]
         if VERBOSE:
             print(' \n PicoStatus sampling: '+str(res))
             print(' Number of Samples measured: '+str(noOfValues))
             print(' Channel with Overflow: '+str(Overflow))
             if res == 0:
-                samples= np.ctypeslib.as_array(measurement_results)
                 print(str(samples))
-            return samples
-            
+        return samples
+
+# Continuous block mode: the next block is armed as soon as the last one is ready,
+# so the device records while the previous block is read and handed on
+    def start_continuous(self, callback=None):
+        '''callback(block) gets every block as (samples, channels) array, valid until the next callback returns
+        Without callback the blocks go into a ring buffer, see get_queue_data'''
+        if self.continuous_thread is not None:
+            return
+        if callback is None:
+            self.ringbuffer = RingBuffer(RING_BUFFER_BLOCKS*self.no_of_samples, channels=self.no_of_active_channels)
+            callback = self.write_ringbuffer
+        self.stop_event.clear()
+        self.continuous_thread = threading.Thread(target=self.continuous_loop, args=(callback,), name='DRDAQ block mode')
+        self.continuous_thread.daemon = True
+        self.continuous_thread.start()
+
+    def stop_continuous(self):
+        if self.continuous_thread is None:
+            return
+        self.stop_event.set()
+        self.continuous_thread.join()
+        self.continuous_thread = None
+        self.lib.UsbDrDaqStop(self.handle)
+
+    def continuous_loop(self, callback):
+        done = ctypes.c_bool(0)
+        noOfValues = ctypes.c_uint32(0)
+        overflow = ctypes.c_int16(0)
+        bufferIndex = 0
+
+        self.lib.UsbDrDaqRun(self.handle,self.no_of_samples,BM_WINDOW)
+        armed = time.perf_counter()
+        while not self.stop_event.is_set():
+            self.wait_ready(armed, done)
+            if self.stop_event.is_set():
+                break
+            ready = time.perf_counter()
+            # adapt the expected block time to what the device really needs
+            self.ready_estimate = 0.8*self.ready_estimate + 0.2*(ready-armed)
+
+            # Fetch the finished block first, UsbDrDaqGetValues ends the run and would cancel
+            # a block armed before it. The consumer gets the block after the next one is armed
+            noOfValues.value = self.no_of_samples
+            self.lib.UsbDrDaqGetValues(self.handle,ctypes.byref(self.block_buffers[bufferIndex]),ctypes.byref(noOfValues),ctypes.byref(overflow),None)
+            self.lib.UsbDrDaqRun(self.handle,self.no_of_samples,BM_WINDOW)
+            armed = time.perf_counter()
+            self.dead_time += armed-ready
+
+            callback(self.block_arrays[bufferIndex][:noOfValues.value])
+            self.blocks += 1
+            bufferIndex = 1-bufferIndex
+
+    def wait_ready(self, armed, done):
+        '''sleeps most of the expected block time, then polls UsbDrDaqReady with a growing pause'''
+        remaining = READY_LEAD*self.ready_estimate-(time.perf_counter()-armed)
+        if remaining > 0:
+            self.stop_event.wait(remaining)
+        pause = READY_POLL_MIN
+        while not self.stop_event.is_set():
+            self.lib.UsbDrDaqReady(self.handle,ctypes.byref(done))
+            self.ready_polls += 1
+            if done.value:
+                return
+            time.sleep(pause)
+            pause = min(2*pause, READY_POLL_MAX)
+
+    def write_ringbuffer(self, block):
+        self.ringbuffer.write(block.T)
+
+    def get_queue_data(self, n=None):
+        '''(channels, samples) of the blocks recorded in continuous mode, None if there is nothing new'''
+        views = self.ringbuffer.read(n)
+        if not views:
+            return None
+        elif len(views) == 1:
+            return views[0]
+        return np.concatenate(views, axis=-1)
+
+    def get_continuous_stats(self):
+        '''blocks, polls of UsbDrDaqReady per block and seconds between a block being ready and the next one armed'''
+        return {'blocks':self.blocks,
+                'polls_per_block':self.ready_polls/max(self.blocks,1),
+                'dead_time':self.dead_time,
+                'block_time_estimate':self.ready_estimate}
+
     def get_DAQ_vertical_scaling(self):
         print('\n ===Getting vertical scaling===')
         available_scalings= ctypes.c_int16()
         current_scaling=ctypes.c_int16()
         scaling_names_indices= (ctypes.c_char*1000)()
         name_size = ctypes.c_int16()
-        res= self.lib.UsbDrDaqGetScalings(self.handle,channel,ctypes.byref(available_scalings),ctypes.byref(current_scaling),ctypes.byref(scaling_names_indices),name_size)
+        res= self.lib.UsbDrDaqGetScalings(self.handle,self.channels[0],ctypes.byref(available_scalings),ctypes.byref(current_scaling),ctypes.byref(scaling_names_indices),name_size)
         if VERBOSE:
             print('\n ===Getting vertical scaling===')
             print('PicoStatus of vertical scaling aquisition: '+str(res))
-            print('current scaling: '+str(current_scaling)) 
+            print('current scaling: '+str(current_scaling))
             print('available scalings: '+str(available_scalings))
             print('PicoStatus: '+str(name_size))
-        
+
 if __name__ == '__main__':
         try:
-            DRDAQ = DRDAQ()
+            daq = DRDAQ()
         except:
             print('Error opening Picoscope')
-        DRDAQ.run_single_shot()
-        DRDAQ.sampling_done()
-        time.sleep(1)
-        DRDAQ.sampling_done()
-        samples= DRDAQ.get_sampled_values()
-        
-        DRDAQ.stop_sampling()
-        #DRDAQ.close_unit()
-
-
+            sys.exit(1)
+        daq.start_continuous()
+        end = time.time()+2
+        samples = 0
+        while time.time() < end:
+            data = daq.get_queue_data()
+            if data is not None:
+                samples += data.shape[1]
+            time.sleep(0.05)
+        daq.stop_continuous()
+        print(' Samples per channel: '+str(samples))
+        print(' '+str(daq.get_continuous_stats()))
+        daq.close_unit()
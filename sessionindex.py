@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+"""
+Persistent index over all recordings in a data directory
+
+Two files in the data directory hold the index:
+ - sessions.bin: one SESSION_DTYPE record per recording folder
+ - blocks.bin:   one BLOCK_DTYPE record per recorded block, with its time range,
+                 min, max and RMS of every channel and its place in the recording
+Both are built from the index.bin and summary.bin files the Recorder writes
+while recording. update() only reads the records added since the last update,
+so it can be called at any time, also while a recording is running.
+
+Queries only look at the index, the samples are read from the segment files
+only for the time ranges asked for:
+    index = SessionIndex(DrDAQ.get_datadirectory())
+    index.find_blocks(channel=0, rmsAbove=240.0)
+    index.get_samples(t1, t2, channel=0)
+"""
+
+import os
+
+import numpy as np
+
+from recorder import INDEX_DTYPE, Recording, read_info, read_scales, summary_dtype
+
+SESSIONS_FILE = 'sessions.bin'
+BLOCKS_FILE = 'blocks.bin'
+
+# Channel slots of the block records, one per channel A-H
+MAX_CHANNELS = 8
+
+SESSION_DTYPE = np.dtype([('name','S64'),             # folder name in the data directory
+                          ('start','<f8'),            # time of the first sample, seconds since the epoch
+                          ('end','<f8'),              # time after the last sample
+                          ('blocks','<u8'),           # blocks in the index
+                          ('sample_interval','<f8')]) # seconds between two samples
+
+# min, max and rms are volts if the recording has scale factors, otherwise counts,
+# NaN for channels that were not recorded
+BLOCK_DTYPE = np.dtype([('session','<u4'),            # record number in sessions.bin
+                        ('block','<u4'),              # block number in the recording
+                        ('start','<f8'),              # time of the first sample
+                        ('end','<f8'),                # time after the last sample
+                        ('min','<f4',(MAX_CHANNELS,)),
+                        ('max','<f4',(MAX_CHANNELS,)),
+                        ('rms','<f4',(MAX_CHANNELS,))])
+
+
+def summarize_blocks(index, summary, channels, sampleInterval, scales=None):
+    '''BLOCK_DTYPE records (without session and block) of index and summary records of one recording'''
+    blocks = np.zeros(len(index), dtype=BLOCK_DTYPE)
+    blocks['start'] = index['timestamp']
+    blocks['end'] = index['timestamp'] + index['samples']*sampleInterval
+    for field in ('min','max','rms'):
+        blocks[field] = np.nan
+    if summary is None:
+        return blocks
+
+    for row, channel in enumerate(channels):
+        if channel >= MAX_CHANNELS:
+            continue
+        low = summary['min'][:,row].astype(np.float64)
+        high = summary['max'][:,row].astype(np.float64)
+        rms = summary['rms'][:,row].astype(np.float64)
+        if scales is not None:
+            # volts = counts*factor - offset, also for the mean square
+            factor, offset = scales[0][row], scales[1][row]
+            mean = summary['mean'][:,row].astype(np.float64)
+            low, high = low*factor-offset, high*factor-offset
+            rms = np.sqrt(np.maximum(factor**2*rms**2 - 2*factor*offset*mean + offset**2, 0))
+        # a channel can fill several rows (aggregate mode), keep the widest range and the first RMS
+        blocks['min'][:,channel] = np.fmin(blocks['min'][:,channel], low)
+        blocks['max'][:,channel] = np.fmax(blocks['max'][:,channel], high)
+        if np.isnan(blocks['rms'][:,channel]).all():
+            blocks['rms'][:,channel] = rms
+    return blocks
+
+
+class SessionIndex:
+    def __init__(self, datadirectory, update=True):
+        '''opens the index of datadirectory, creates it if there is none'''
+        self.datadirectory = datadirectory
+        self.sessions_path = os.path.join(datadirectory, SESSIONS_FILE)
+        self.blocks_path = os.path.join(datadirectory, BLOCKS_FILE)
+        self.recordings = {}
+
+        if os.path.exists(self.sessions_path):
+            self.sessions = np.fromfile(self.sessions_path, dtype=SESSION_DTYPE)
+        else:
+            self.sessions = np.zeros(0, dtype=SESSION_DTYPE)
+        if os.path.exists(self.blocks_path):
+            self.blocks = np.fromfile(self.blocks_path, dtype=BLOCK_DTYPE)
+        else:
+            self.blocks = np.zeros(0, dtype=BLOCK_DTYPE)
+        # blocks appended by an update that did not get to write sessions.bin are read again
+        known = int(self.sessions['blocks'].sum())
+        if len(self.blocks) > known:
+            self.blocks = self.blocks[:known]
+            with open(self.blocks_path, 'r+b') as f:
+                f.truncate(known*BLOCK_DTYPE.itemsize)
+        self.session_numbers = dict((name.decode(), i) for i, name in enumerate(self.sessions['name']))
+
+        if update:
+            self.update()
+
+    def update(self):
+        '''adds new recording folders and new blocks of known ones, returns the number of new blocks'''
+        if not os.path.isdir(self.datadirectory):
+            return 0
+        sessions = list(self.sessions)
+        newblocks = []
+        for entry in sorted(os.scandir(self.datadirectory), key=lambda e: e.name):
+            if not entry.is_dir() or not os.path.exists(os.path.join(entry.path,'recording.ini')):
+                continue
+            indexfile = os.path.join(entry.path,'index.bin')
+            if not os.path.exists(indexfile):
+                continue
+            records = os.path.getsize(indexfile)//INDEX_DTYPE.itemsize
+            number = self.session_numbers.get(entry.name)
+            known = 0 if number is None else int(sessions[number]['blocks'])
+            if records <= known:
+                continue
+
+            info = read_info(entry.path)
+            channels = [int(c) for c in info['channels'].split(',')]
+            sampleInterval = float(info['sample_interval'])
+            index = np.fromfile(indexfile, dtype=INDEX_DTYPE, count=records-known, offset=known*INDEX_DTYPE.itemsize)
+            summary = None
+            summaryfile = os.path.join(entry.path,'summary.bin')
+            if os.path.exists(summaryfile):
+                dtype = summary_dtype(len(channels))
+                summary = np.fromfile(summaryfile, dtype=dtype, count=len(index), offset=known*dtype.itemsize)
+                # the summary is written before the index record, but be safe
+                index = index[:len(summary)]
+            if len(index) == 0:
+                continue
+
+            if number is None:
+                number = len(sessions)
+                self.session_numbers[entry.name] = number
+                session = np.zeros(1, dtype=SESSION_DTYPE)[0]
+                session['name'] = entry.name.encode()
+                session['start'] = np.inf
+                session['end'] = -np.inf
+                session['sample_interval'] = sampleInterval
+                sessions.append(session)
+
+            blocks = summarize_blocks(index, summary, channels, sampleInterval, read_scales(info))
+            blocks['session'] = number
+            blocks['block'] = np.arange(known, known+len(blocks))
+            newblocks.append(blocks)
+
+            session = sessions[number]
+            session['start'] = min(session['start'], blocks['start'].min())
+            session['end'] = max(session['end'], blocks['end'].max())
+            session['blocks'] = known+len(blocks)
+            # the cached Recording does not know the new blocks
+            self.recordings.pop(number, None)
+
+        if not newblocks:
+            return 0
+        newblocks = np.concatenate(newblocks)
+        # blocks first, sessions.bin says how many of them are valid
+        with open(self.blocks_path, 'ab') as f:
+            f.write(newblocks.tobytes())
+        self.sessions = np.array(sessions, dtype=SESSION_DTYPE)
+        with open(self.sessions_path+'.tmp', 'wb') as f:
+            f.write(self.sessions.tobytes())
+        os.replace(self.sessions_path+'.tmp', self.sessions_path)
+        self.blocks = np.concatenate((self.blocks, newblocks))
+        return len(newblocks)
+
+    def rebuild(self):
+        '''throws the index away and reads all recordings again'''
+        for path in (self.sessions_path, self.blocks_path):
+            if os.path.exists(path):
+                os.remove(path)
+        self.sessions = np.zeros(0, dtype=SESSION_DTYPE)
+        self.blocks = np.zeros(0, dtype=BLOCK_DTYPE)
+        self.session_numbers = {}
+        self.recordings = {}
+        return self.update()
+
+# Queries
+    def find_sessions(self, t1=-np.inf, t2=np.inf):
+        '''names of the recordings with samples between t1 and t2'''
+        selected = (self.sessions['start'] < t2) & (self.sessions['end'] > t1)
+        return [name.decode() for name in self.sessions['name'][selected]]
+
+    def find_blocks(self, channel=0, t1=-np.inf, t2=np.inf, rmsAbove=None, rmsBelow=None, maxAbove=None, minBelow=None):
+        '''block records between t1 and t2 that match all given limits of channel, in time order'''
+        blocks = self.blocks
+        selected = (blocks['start'] < t2) & (blocks['end'] > t1)
+        if rmsAbove is not None:
+            selected &= blocks['rms'][:,channel] > rmsAbove
+        if rmsBelow is not None:
+            selected &= blocks['rms'][:,channel] < rmsBelow
+        if maxAbove is not None:
+            selected &= blocks['max'][:,channel] > maxAbove
+        if minBelow is not None:
+            selected &= blocks['min'][:,channel] < minBelow
+        found = blocks[selected]
+        return found[np.argsort(found['start'], kind='stable')]
+
+    def get_recording(self, session):
+        if session not in self.recordings:
+            name = self.sessions['name'][session].decode()
+            self.recordings[session] = Recording(os.path.join(self.datadirectory, name))
+        return self.recordings[session]
+
+    def get_block(self, record):
+        '''(channels, samples) counts of a record returned by find_blocks'''
+        return self.get_recording(int(record['session'])).get_block(int(record['block']))
+
+    def get_samples(self, t1, t2, channel=0):
+        '''counts of one channel between t1 and t2, as a list of (time of the first sample, samples),
+        one entry per recording'''
+        pieces = []
+        for name in self.find_sessions(t1, t2):
+            session = self.session_numbers[name]
+            recording = self.get_recording(session)
+            if channel not in recording.channels:
+                continue
+            samples = recording.get_samples(t1, t2, channel)
+            if len(samples) == 0:
+                continue
+            # time of the first returned sample
+            blocknumber, start, stop = recording.get_cuts(t1, t2)[0]
+            record = recording.index[blocknumber]
+            if recording.anchor_ns is not None:
+                timestamp = recording.get_sample_time_ns(int(record['sample_index'])+start)/1e9
+            else:
+                timestamp = float(record['timestamp']) + start*recording.sample_interval
+            pieces.append((timestamp, samples))
+        return pieces
+
+
+if __name__ == '__main__':
+    import sys
+    import time
+    datadirectory = sys.argv[1] if len(sys.argv) > 1 else '.'
+    start = time.perf_counter()
+    index = SessionIndex(datadirectory)
+    print(' %d sessions, %d blocks, updated in %.3f s' % (len(index.sessions), len(index.blocks), time.perf_counter()-start))
+    for session in index.sessions:
+        print(' '+session['name'].decode()+': '+time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(session['start']))
+              +', %.1f s, %d blocks' % (session['end']-session['start'], session['blocks']))
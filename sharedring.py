@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+"""
+Fan-out of the streamed blocks to other processes through shared memory
+
+The Publisher copies every block once into a ring in a
+multiprocessing.shared_memory segment. Any number of Subscribers in other
+processes attach to the segment by its name and read the ring with their
+own cursor, as numpy views into the shared memory: nothing is pickled and
+nothing is copied per subscriber.
+
+The publisher never waits for a subscriber. A subscriber that falls more than
+the ring capacity behind skips to the oldest samples still in the ring, and
+counts the skipped samples in lost. If the publisher overwrote samples
+while the subscriber was still working on them, the next read counts them
+in overwritten. Both are overrun notifications, see Subscriber.get_stats().
+
+    publisher side:  pico.publish('drdaq')
+    subscriber side: subscriber = Subscriber('drdaq')
+                     while True:
+                         data = subscriber.read(timeout=0.1)
+"""
+
+import sys
+import time
+from multiprocessing import shared_memory, resource_tracker
+
+import numpy as np
+
+MAGIC = 0x44524451
+
+# Header at the start of the segment, the samples follow at HEADER_SIZE
+HEADER_DTYPE = np.dtype([('magic','<u4'),
+                         ('channels','<u4'),
+                         ('capacity','<u8'),        # samples per channel in the ring
+                         ('write_count','<u8'),     # samples per channel ever written, set after the copy
+                         ('anchor_ns','<i8'),       # time of stream index 0 of the run, ns since the epoch
+                         ('interval_fs','<u8'),     # femtoseconds between two samples
+                         ('index_offset','<i8'),    # stream index of the run minus index in the ring
+                         ('closed','<u4'),          # 1 after Publisher.end()
+                         ('dtype','S4')])
+HEADER_SIZE = 64
+
+# Seconds between two checks of a waiting subscriber
+SUBSCRIBER_POLL = 0.0005
+
+
+def attach_segment(name):
+    '''opens an existing segment without handing it to the resource tracker of this process,
+    which would remove it when the subscriber exits'''
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+    # older versions always register, and unregistering would also drop the registration
+    # of a publisher that shares the tracker with a forked subscriber
+    register = resource_tracker.register
+    resource_tracker.register = lambda name, rtype: None
+    try:
+        return shared_memory.SharedMemory(name=name)
+    finally:
+        resource_tracker.register = register
+
+
+class Publisher:
+    def __init__(self, name, channels, capacity, dtype=np.int16, anchorNs=0, intervalFs=0, indexOffset=0):
+        '''name: name of the shared memory segment | channels: rows of the blocks
+        capacity: samples per channel in the ring
+        anchorNs, intervalFs, indexOffset: timing as in set_timing'''
+        dtype = np.dtype(dtype)
+        self.capacity = int(capacity)
+        self.segment = shared_memory.SharedMemory(name=name, create=True, size=HEADER_SIZE+channels*self.capacity*dtype.itemsize)
+        self.name = self.segment.name
+        self.header = np.ndarray((), dtype=HEADER_DTYPE, buffer=self.segment.buf)
+        self.data = np.ndarray((channels,self.capacity), dtype=dtype, buffer=self.segment.buf, offset=HEADER_SIZE)
+        self.header['channels'] = channels
+        self.header['capacity'] = self.capacity
+        self.header['write_count'] = 0
+        self.set_timing(anchorNs, intervalFs, indexOffset)
+        self.header['closed'] = 0
+        self.header['dtype'] = dtype.str.encode()
+        # the magic number last, a subscriber attaching now finds a complete header
+        self.header['magic'] = MAGIC
+        self.write_count = 0
+
+    def set_timing(self, anchorNs, intervalFs, indexOffset=0):
+        '''sample i of the ring is stream index i+indexOffset, taken at anchorNs + (i+indexOffset)*intervalFs//10**6,
+        integers as in DRDAQ.get_sample_time_ns'''
+        self.header['anchor_ns'] = anchorNs
+        self.header['interval_fs'] = intervalFs
+        self.header['index_offset'] = indexOffset
+
+    def write(self, block):
+        '''copies a (channels, samples) block into the ring, never blocks'''
+        n = block.shape[-1]
+        if n > self.capacity:
+            # only the newest samples fit, the older ones count as written
+            block = block[...,-self.capacity:]
+            self.write_count += n-self.capacity
+            n = self.capacity
+        position = self.write_count % self.capacity
+        first = min(n, self.capacity-position)
+        self.data[:,position:position+first] = block[:,:first]
+        if first < n:
+            self.data[:,:n-first] = block[:,first:]
+        # publish the samples only after they are copied
+        self.write_count += n
+        self.header['write_count'] = self.write_count
+        return n
+
+    def end(self):
+        '''marks the stream as ended and removes the name of the segment, attached subscribers keep their mapping
+        write still works until release, so a writer in another thread can finish its block'''
+        self.header['closed'] = 1
+        self.segment.unlink()
+
+    def release(self):
+        '''unmaps the segment, after the last write'''
+        del self.header
+        del self.data
+        self.segment.close()
+
+    def close(self):
+        self.end()
+        self.release()
+
+
+class Subscriber:
+    def __init__(self, name, fromStart=False):
+        '''attaches to the segment of a Publisher | fromStart: begin with the oldest samples
+        in the ring instead of the next new ones'''
+        self.segment = attach_segment(name)
+        self.header = np.ndarray((), dtype=HEADER_DTYPE, buffer=self.segment.buf)
+        if self.header['magic'] != MAGIC:
+            raise ValueError(name+' is not a DRDAQ shared ring')
+        self.capacity = int(self.header['capacity'])
+        channels = int(self.header['channels'])
+        self.data = np.ndarray((channels,self.capacity), dtype=np.dtype(self.header['dtype'].item().decode()),
+                               buffer=self.segment.buf, offset=HEADER_SIZE)
+
+        written = int(self.header['write_count'])
+        self.cursor = max(written-self.capacity, 0) if fromStart else written
+        # first sample of the data returned by the last read
+        self.read_start = self.cursor
+        self.read_end = self.cursor
+        self.lost = 0
+        self.overwritten = 0
+        self.reads = 0
+
+    def available(self):
+        return int(self.header['write_count'])-self.cursor
+
+    def is_closed(self):
+        return bool(self.header['closed'])
+
+    def read(self, n=None, timeout=None):
+        '''new samples as (channels, samples) array, None if there are none within timeout seconds
+        The array is a view into the shared memory if the data does not wrap around the end of the ring,
+        it is valid until the publisher has written another capacity samples'''
+        written = int(self.header['write_count'])
+        if written == self.cursor and timeout:
+            end = time.perf_counter()+timeout
+            while written == self.cursor and time.perf_counter() < end and not self.header['closed']:
+                time.sleep(SUBSCRIBER_POLL)
+                written = int(self.header['write_count'])
+
+        # the data of the last read was overwritten while it was in use
+        if written-self.read_start > self.capacity and self.read_end > self.read_start:
+            self.overwritten += min(written-self.capacity, self.read_end)-self.read_start
+
+        # fallen behind by more than the ring: skip to the oldest samples still there
+        if written-self.cursor > self.capacity:
+            self.lost += written-self.capacity-self.cursor
+            self.cursor = written-self.capacity
+
+        count = written-self.cursor
+        if n is not None:
+            count = min(count, n)
+        self.read_start = self.read_end = self.cursor
+        if count <= 0:
+            return None
+
+        position = self.cursor % self.capacity
+        first = min(count, self.capacity-position)
+        if first == count:
+            data = self.data[:,position:position+count]
+        else:
+            data = np.concatenate((self.data[:,position:], self.data[:,:count-first]), axis=1)
+        self.cursor += count
+        self.read_end = self.cursor
+        self.reads += 1
+        return data
+
+    def get_sample_time_ns(self, sampleIndex):
+        '''time of sample sampleIndex of the ring in ns since the epoch, exact as an integer'''
+        index = int(sampleIndex)+int(self.header['index_offset'])
+        return int(self.header['anchor_ns'])+index*int(self.header['interval_fs'])//10**6
+
+    def get_block_start(self):
+        '''sample index and time of the first sample of the data last returned by read'''
+        return self.read_start, self.get_sample_time_ns(self.read_start)/1e9
+
+    def get_stats(self):
+        return {'cursor':self.cursor,
+                'lag':int(self.header['write_count'])-self.cursor,
+                'reads':self.reads,
+                'lost':self.lost,
+                'overwritten':self.overwritten}
+
+    def close(self):
+        del self.header
+        del self.data
+        self.segment.close()
+
+
+def subscriber_process(name, seconds, results):
+    subscriber = Subscriber(name)
+    samples = 0
+    end = time.perf_counter()+seconds
+    while time.perf_counter() < end and not subscriber.is_closed():
+        data = subscriber.read(timeout=0.05)
+        if data is not None:
+            samples += data.shape[1]
+    stats = subscriber.get_stats()
+    stats['samples'] = samples
+    results.put(stats)
+    subscriber.close()
+
+
+if __name__ == '__main__':
+    # Fan-out of a simulated 500 kS/s stream to several subscriber processes
+    import multiprocessing
+    import DrDAQ
+    from simdriver import SimulatedLibrary
+
+    subscribers = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    seconds = 3.0
+    pico = DrDAQ.DRDAQ(lib=SimulatedLibrary())
+    publisher = pico.publish()
+    results = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=subscriber_process, args=(publisher.name, seconds, results))
+                 for i in range(subscribers)]
+    for process in processes:
+        process.start()
+    try:
+        pico.run_streaming()
+        time.sleep(seconds)
+        pico.stop_sampling()
+        for process in processes:
+            print(' Subscriber: '+str(results.get(timeout=seconds)))
+        print(' Published: '+str(publisher.write_count)+' samples per channel')
+    finally:
+        for process in processes:
+            process.join()
+        pico.close_unit()
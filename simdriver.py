@@ -0,0 +1,423 @@
+# -*- coding: utf-8 -*-
+"""
+Simulated Picoscope library for testing without hardware
+
+SimulatedLibrary has the same functions as the ps4000a and UsbDrDaq libraries,
+as far as DRDAQ and schnelltest.DRDAQ use them, and takes the same ctypes
+arguments. Every open unit produces phase continuous mains waveforms (three
+phases with harmonics and noise) from tables that are computed once when
+streaming starts.
+
+speed=1.0 produces the samples in real time, speed=10.0 ten times faster,
+speed=None as fast as the data is fetched.
+"""
+
+import ctypes
+import time
+
+import numpy as np
+
+from config import RANGE_VOLTS
+from driver import PROTOTYPES
+
+PICO_OK = 0
+PICO_INVALID_HANDLE = 12
+PICO_NOT_USED = 29
+
+# Peak amplitude of the simulated signal in volts and its noise in counts
+AMPLITUDE_VOLTS = 18.0
+NOISE_COUNTS = 2.0
+MAINS_FREQUENCY = 50.0
+# Harmonics of the simulated signal as (order, amplitude relative to the fundamental)
+HARMONICS = ((3,0.05), (5,0.03), (7,0.01))
+# Length of the waveform tables in mains cycles
+TABLE_CYCLES = 10
+
+# ps4000a downsampling modes
+RATIO_MODE_NONE = 0
+RATIO_MODE_AGGREGATE = 1
+RATIO_MODE_DECIMATE = 2
+RATIO_MODE_AVERAGE = 4
+
+# Full scale of the USB DrDAQ in counts
+USBDRDAQ_MAX_VALUE = 1023
+
+
+def deref(arg):
+    '''the ctypes object behind a ctypes.byref() argument'''
+    return getattr(arg, '_obj', arg)
+
+
+def value(arg):
+    '''plain value of an argument given as int, ctypes object or byref'''
+    arg = deref(arg)
+    return getattr(arg, 'value', arg)
+
+
+class WaveformTable:
+    def __init__(self, sampleRate, amplitude, phase=0.0, frequency=MAINS_FREQUENCY, cycles=TABLE_CYCLES, maxValue=32767):
+        '''one table of whole mains cycles, read out round and round so the phase never jumps'''
+        period = max(int(round(sampleRate/frequency)), 1)
+        x = 2*np.pi*np.arange(period*cycles)/period
+        signal = np.sin(x+phase)
+        for order, relative in HARMONICS:
+            signal += relative*np.sin(order*(x+phase))
+        signal = amplitude*signal + np.random.normal(0, NOISE_COUNTS, len(x))
+        self.table = np.clip(np.round(signal), -maxValue, maxValue).astype(np.int16)
+        self.position = 0
+
+    def fill(self, out):
+        '''copy the next len(out) samples into out'''
+        n = len(out)
+        length = len(self.table)
+        done = 0
+        while done < n:
+            chunk = min(n-done, length-self.position)
+            out[done:done+chunk] = self.table[self.position:self.position+chunk]
+            done += chunk
+            self.position = (self.position+chunk) % length
+
+    def skip(self, n):
+        self.position = (self.position+n) % len(self.table)
+
+
+class SimulatedUnit:
+    def __init__(self, serial):
+        self.serial = serial
+        self.channels = {}
+        self.buffers = {}
+        # minimum buffers of the aggregate mode, the maxima go into buffers
+        self.min_buffers = {}
+        self.ratio = 1
+        self.ratio_mode = RATIO_MODE_NONE
+        self.streaming = False
+        self.tables = {}
+        # USB DrDAQ block mode
+        self.block_channels = [0]
+        self.block_samples = 0
+        self.block_interval = 0.0
+        self.block_start = None
+        # Simple trigger: (source channel, threshold in counts, direction) or None
+        self.trigger = None
+        self.triggered = False
+
+
+def check_arguments(name, function, count):
+    '''function that, like a ctypes function with argtypes, refuses a call with the wrong number of arguments'''
+    def checked(*args):
+        if len(args) != count:
+            raise TypeError('%s takes %d arguments (%d given)' % (name, count, len(args)))
+        return function(*args)
+    checked.__name__ = name
+    return checked
+
+
+class SimulatedLibrary:
+    def __init__(self, speed=1.0, units=1, timing=False):
+        '''speed: factor to real time, None for as fast as possible | units: number of simulated units
+        timing: record the duration of every buffer callback in callback_durations'''
+        self.speed = speed
+        self.callback_durations = [] if timing else None
+        self.serials = ['SIM%04d' % (i+1) for i in range(units)]
+        self.units = {}
+        self.next_handle = 1
+        # Samples skipped because the data was not fetched in time, per handle
+        self.lost_samples = {}
+        # the calls are checked against driver.PROTOTYPES, as the real library binding does
+        for name, (restype, argtypes) in PROTOTYPES.items():
+            if hasattr(self, name):
+                setattr(self, name, check_arguments(name, getattr(self, name), len(argtypes)))
+
+    def get_unit(self, handle):
+        return self.units.get(value(handle))
+
+    def now(self):
+        return time.perf_counter()
+
+    def due(self, start, rate):
+        '''samples the device has produced since start'''
+        return int((self.now()-start)*rate*self.speed)
+
+# Open and close
+    def open(self, handle, serial=None):
+        opened = [unit.serial for unit in self.units.values()]
+        free = [s for s in self.serials if s not in opened]
+        if serial is not None:
+            free = [s for s in free if s == serial]
+        if not free:
+            deref(handle).value = 0
+            return PICO_NOT_USED
+        deref(handle).value = self.next_handle
+        self.units[self.next_handle] = SimulatedUnit(free[0])
+        self.lost_samples[self.next_handle] = 0
+        self.next_handle += 1
+        return PICO_OK
+
+    def ps4000aOpenUnit(self, handle, serial=None):
+        if serial is not None:
+            serial = value(serial)
+            if isinstance(serial, bytes):
+                serial = serial.decode()
+        return self.open(handle, serial)
+
+    def UsbDrDaqOpenUnit(self, handle):
+        return self.open(handle)
+
+    def ps4000aEnumerateUnits(self, count, serials, serialLth):
+        deref(count).value = len(self.serials)
+        deref(serials).value = ','.join(self.serials).encode()
+        deref(serialLth).value = len(','.join(self.serials))
+        return PICO_OK
+
+    def ps4000aPingUnit(self, handle):
+        return PICO_OK if self.get_unit(handle) is not None else PICO_INVALID_HANDLE
+
+    def UsbDrDaqPingUnit(self, handle):
+        return self.ps4000aPingUnit(handle)
+
+    def ps4000aChangePowerSource(self, handle, powerState):
+        return PICO_OK
+
+    def ps4000aCloseUnit(self, handle):
+        if self.units.pop(value(handle), None) is None:
+            return PICO_INVALID_HANDLE
+        return PICO_OK
+
+    def UsbDrDaqCloseUnit(self, handle):
+        return self.ps4000aCloseUnit(handle)
+
+# ps4000a streaming
+    def ps4000aSetChannel(self, handle, channel, enabled, dc, vertrange, analogOffset):
+        unit = self.get_unit(handle)
+        if unit is None:
+            return PICO_INVALID_HANDLE
+        unit.channels[value(channel)] = (bool(value(enabled)), value(vertrange), value(analogOffset))
+        return PICO_OK
+
+    def ps4000aSetSimpleTrigger(self, handle, enable, source, threshold, direction, delay, autoTrigger_ms):
+        unit = self.get_unit(handle)
+        if unit is None:
+            return PICO_INVALID_HANDLE
+        if value(enable):
+            unit.trigger = (value(source), value(threshold), value(direction))
+        else:
+            unit.trigger = None
+        return PICO_OK
+
+    def find_trigger(self, unit, start, chunk):
+        '''position of the trigger in the new samples relative to start, or None'''
+        source, threshold, direction = unit.trigger
+        if unit.triggered or source not in unit.buffers:
+            return None
+        x = unit.buffers[source][start:start+chunk].astype(np.int32)
+        if direction == 0:
+            hits = np.flatnonzero(x > threshold)
+        elif direction == 1:
+            hits = np.flatnonzero(x < threshold)
+        else:
+            rising = np.flatnonzero((x[:-1] < threshold) & (x[1:] >= threshold))+1
+            falling = np.flatnonzero((x[:-1] > threshold) & (x[1:] <= threshold))+1
+            hits = {2:rising, 3:falling}.get(direction, np.sort(np.concatenate((rising, falling))))
+        if len(hits) == 0:
+            return None
+        unit.triggered = True
+        return int(hits[0])
+
+    def ps4000aGetTimebase(self, handle, timebase, noSamples, timeIntervalNanoseconds, maxSamples, segmentIndex):
+        if self.get_unit(handle) is None:
+            return PICO_INVALID_HANDLE
+        # ps4000a: 12.5 ns * (timebase+1)
+        deref(timeIntervalNanoseconds).value = int(12.5*(value(timebase)+1))
+        deref(maxSamples).value = 2**27
+        return PICO_OK
+
+    def ps4000aSetDataBuffer(self, handle, channel, buffer, bufferLth, segmentIndex, mode):
+        unit = self.get_unit(handle)
+        if unit is None:
+            return PICO_INVALID_HANDLE
+        buffer = deref(buffer)
+        if isinstance(buffer, ctypes.Array):
+            array = np.ctypeslib.as_array(buffer)
+        else:
+            array = np.ctypeslib.as_array(buffer, shape=(value(bufferLth),))
+        unit.buffers[value(channel)] = array[:value(bufferLth)]
+        return PICO_OK
+
+    def ps4000aSetDataBuffers(self, handle, channel, bufferMax, bufferMin, bufferLth, segmentIndex, mode):
+        res = self.ps4000aSetDataBuffer(handle, channel, bufferMax, bufferLth, segmentIndex, mode)
+        if res != PICO_OK or bufferMin is None:
+            return res
+        bufferMin = deref(bufferMin)
+        if isinstance(bufferMin, ctypes.Array):
+            array = np.ctypeslib.as_array(bufferMin)
+        else:
+            array = np.ctypeslib.as_array(bufferMin, shape=(value(bufferLth),))
+        self.get_unit(handle).min_buffers[value(channel)] = array[:value(bufferLth)]
+        return PICO_OK
+
+    def ps4000aRunStreaming(self, handle, sampleInterval, sampleIntervalTimeUnits, maxPreTriggerSamples,
+                            maxPostTriggerSamples, autoStop, downSampleRatio, downSampleRatioMode, overviewBufferSize):
+        unit = self.get_unit(handle)
+        if unit is None:
+            return PICO_INVALID_HANDLE
+        # the requested interval is always available, it is written back unchanged
+        interval = value(sampleInterval)*10.0**(3*value(sampleIntervalTimeUnits)-15)
+        unit.sample_rate = 1.0/interval
+        unit.buffer_length = value(overviewBufferSize)
+        # buffer_length, write_position and the callbacks count downsampled values
+        unit.ratio_mode = value(downSampleRatioMode)
+        unit.ratio = max(value(downSampleRatio), 1) if unit.ratio_mode != RATIO_MODE_NONE else 1
+        unit.write_position = 0
+        unit.generated = 0
+        unit.triggered = False
+
+        # Precomputed waveforms, channel A,B,C are the three phases, the others repeat them
+        unit.tables = {}
+        for channel, (enabled, vertrange, analogOffset) in unit.channels.items():
+            if enabled:
+                amplitude = AMPLITUDE_VOLTS/RANGE_VOLTS[vertrange]*32767
+                unit.tables[channel] = WaveformTable(unit.sample_rate, amplitude, phase=-2*np.pi*(channel % 3)/3)
+
+        unit.streaming = True
+        unit.start = self.now()
+        return PICO_OK
+
+    def ps4000aGetStreamingLatestValues(self, handle, lpPs4000aReady, pParameter=None):
+        unit = self.get_unit(handle)
+        if unit is None:
+            return PICO_INVALID_HANDLE
+        if not unit.streaming:
+            return PICO_OK
+
+        ratio = unit.ratio
+        if self.speed is None:
+            n = unit.buffer_length
+        else:
+            n = (self.due(unit.start, unit.sample_rate)-unit.generated)//ratio
+            # The driver only holds one buffer length, older samples are lost
+            if n > unit.buffer_length:
+                lost = (n-unit.buffer_length)*ratio
+                self.lost_samples[value(handle)] += lost
+                for table in unit.tables.values():
+                    table.skip(lost)
+                unit.generated += lost
+                n = unit.buffer_length
+        if n <= 0:
+            return PICO_OK
+
+        # Like the driver, a callback never wraps around the end of the buffers
+        while n > 0:
+            start = unit.write_position
+            chunk = min(n, unit.buffer_length-start)
+            for channel, table in unit.tables.items():
+                if channel not in unit.buffers:
+                    table.skip(chunk*ratio)
+                elif ratio == 1:
+                    table.fill(unit.buffers[channel][start:start+chunk])
+                else:
+                    self.downsample(unit, channel, table, start, chunk)
+            triggerAt = None
+            if unit.trigger is not None:
+                triggerAt = self.find_trigger(unit, start, chunk)
+            triggered = int(triggerAt is not None)
+            triggerAt = triggerAt or 0
+            if self.callback_durations is None:
+                lpPs4000aReady(value(handle), chunk, start, 0, triggerAt, triggered, 0, pParameter)
+            else:
+                called = time.perf_counter()
+                lpPs4000aReady(value(handle), chunk, start, 0, triggerAt, triggered, 0, pParameter)
+                self.callback_durations.append(time.perf_counter()-called)
+            unit.write_position = (start+chunk) % unit.buffer_length
+            unit.generated += chunk*ratio
+            n -= chunk
+        return PICO_OK
+
+    def downsample(self, unit, channel, table, start, chunk):
+        '''chunk downsampled values of one channel into its buffers, like the driver does'''
+        raw = np.empty(chunk*unit.ratio, dtype=np.int16)
+        table.fill(raw)
+        raw = raw.reshape(chunk, unit.ratio)
+        out = unit.buffers[channel][start:start+chunk]
+        if unit.ratio_mode == RATIO_MODE_AGGREGATE:
+            np.max(raw, axis=1, out=out)
+            if channel in unit.min_buffers:
+                np.min(raw, axis=1, out=unit.min_buffers[channel][start:start+chunk])
+        elif unit.ratio_mode == RATIO_MODE_AVERAGE:
+            out[:] = np.round(raw.mean(axis=1))
+        else:
+            out[:] = raw[:,0]
+
+    def ps4000aStop(self, handle):
+        unit = self.get_unit(handle)
+        if unit is None:
+            return PICO_INVALID_HANDLE
+        unit.streaming = False
+        unit.block_start = None
+        return PICO_OK
+
+# USB DrDAQ block mode
+    def UsbDrDaqSetInterval(self, handle, usForBlock, idealNoOfSamples, channels, noOfChannels):
+        unit = self.get_unit(handle)
+        if unit is None:
+            return PICO_INVALID_HANDLE
+        channels = deref(channels)
+        if isinstance(channels, ctypes.Array):
+            unit.block_channels = list(channels)[:value(noOfChannels)]
+        else:
+            unit.block_channels = [value(channels)]
+        unit.block_samples = value(idealNoOfSamples)
+        unit.block_interval = value(usForBlock)*1e-6/max(unit.block_samples,1)
+        rate = 1.0/unit.block_interval if unit.block_interval > 0 else 1.0
+        unit.tables = {}
+        for channel in unit.block_channels:
+            unit.tables[channel] = WaveformTable(rate, 0.8*USBDRDAQ_MAX_VALUE, maxValue=USBDRDAQ_MAX_VALUE)
+        return PICO_OK
+
+    def UsbDrDaqRun(self, handle, noOfValues, method):
+        unit = self.get_unit(handle)
+        if unit is None:
+            return PICO_INVALID_HANDLE
+        unit.block_samples = value(noOfValues)
+        unit.block_start = self.now()
+        return PICO_OK
+
+    def UsbDrDaqReady(self, handle, ready):
+        unit = self.get_unit(handle)
+        if unit is None:
+            return PICO_INVALID_HANDLE
+        if unit.block_start is None:
+            done = False
+        elif self.speed is None:
+            done = True
+        else:
+            done = self.due(unit.block_start, 1.0/unit.block_interval) >= unit.block_samples
+        deref(ready).value = done
+        return PICO_OK
+
+    def UsbDrDaqStop(self, handle):
+        return self.ps4000aStop(handle)
+
+    def UsbDrDaqGetValues(self, handle, values, noOfValues, overflow, triggerIndex):
+        unit = self.get_unit(handle)
+        if unit is None:
+            return PICO_INVALID_HANDLE
+        values = np.ctypeslib.as_array(deref(values))
+        nchannels = len(unit.block_channels)
+        n = min(value(noOfValues), unit.block_samples, len(values)//nchannels)
+        # values are interleaved: sample 0 of every channel, sample 1 of every channel, ...
+        interleaved = values[:n*nchannels].reshape(n, nchannels)
+        for i, channel in enumerate(unit.block_channels):
+            unit.tables[channel].fill(interleaved[:,i])
+        deref(noOfValues).value = n
+        if overflow is not None:
+            deref(overflow).value = 0
+        # like the driver, reading the values ends the run
+        unit.block_start = None
+        return PICO_OK
+
+    def UsbDrDaqGetScalings(self, handle, channel, nScales, currentScale, names, namesSize):
+        if self.get_unit(handle) is None:
+            return PICO_INVALID_HANDLE
+        deref(nScales).value = 1
+        deref(currentScale).value = 0
+        return PICO_OK
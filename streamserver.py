@@ -0,0 +1,386 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming of the blocks of a DRDAQ to other programs over a local socket
+
+StreamServer listens on a TCP port or a Unix socket path (as Metrics.serve)
+and sends every connected client the stream in binary frames. A frame is a
+FRAME_DTYPE header followed by the values of one channel: raw int16 counts,
+or the float32 means of a 'mean' decimation tier.
+
+A client starts with one request line and gets one answer line:
+    -> channels=0,1 tier=minmax100 batch=8192\n    (all keys are optional)
+    <- ok channels=0,1 tier=minmax100 factor=100\n or error <reason>\n
+after that only frames follow. Without tier the client gets the full rate.
+
+The server reads the blocks from the shared memory ring of DRDAQ.publish()
+with one sharedring.Subscriber per client, so a slow client never slows down
+the acquisition or the other clients, it loses samples instead (lost in
+get_stats). Small blocks are batched until batch values per channel or
+BATCH_LATENCY seconds have come together, then all frames of the batch go out
+in one sendmsg: the headers and the samples in the shared memory are handed to
+the kernel as they are, without joining them into one buffer first.
+
+    server = pico.serve_stream(('127.0.0.1', 9465))
+    client = StreamClient(('127.0.0.1', 9465), channels=[0])
+    header, values = client.read()
+
+Run this file for a loopback benchmark with several clients.
+"""
+
+import os
+import socket
+import socketserver
+import threading
+import time
+
+import numpy as np
+
+from config import parse_tiers
+from decimation import Decimator
+from sharedring import Subscriber, SUBSCRIBER_POLL
+
+FRAME_MAGIC = 0x46524444
+
+# kind of the values of a frame
+KIND_SAMPLES = 0
+KIND_MAX = 1    # maxima of the aggregate mode or a minmax tier
+KIND_MIN = 2    # minima of the aggregate mode or a minmax tier
+KIND_MEAN = 3   # float32 means of a mean tier
+
+# Header of every frame, the values follow
+FRAME_DTYPE = np.dtype([('magic','<u4'),
+                        ('channel','<u2'),
+                        ('kind','<u2'),
+                        ('sample_index','<u8'),   # stream index of the first sample the values stand for
+                        ('time_ns','<i8'),        # time of that sample, ns since the epoch
+                        ('factor','<u4'),         # samples per value, 1 for the full rate
+                        ('count','<u4'),          # number of values
+                        ('scale','<f4'),          # volts = value*scale - offset
+                        ('offset','<f4'),
+                        ('nbytes','<u4'),         # bytes of the values
+                        ('reserved','<u4')])
+
+# Values per channel a batch waits for, at most BATCH_LATENCY seconds
+BATCH_SAMPLES = 8192
+BATCH_LATENCY = 0.02
+
+# Buffers per sendmsg call
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 1024
+
+
+def send_buffers(sock, buffers):
+    '''sends all buffers (uint8 arrays) with as few calls as possible, without joining them'''
+    if not hasattr(sock, 'sendmsg'):
+        # no scatter-gather (Windows), one copy
+        sock.sendall(b''.join(buffers))
+        return
+    first = 0
+    while first < len(buffers):
+        sent = sock.sendmsg(buffers[first:first+IOV_MAX])
+        while first < len(buffers) and sent >= len(buffers[first]):
+            sent -= len(buffers[first])
+            first += 1
+        if sent:
+            buffers[first] = buffers[first][sent:]
+
+
+class TCPServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+class UnixServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+def parse_request(line):
+    '''request line -> (channels or None, tier name or None, batch)'''
+    channels, tier, batch = None, None, BATCH_SAMPLES
+    for item in line.split():
+        key, _, text = item.partition('=')
+        if key == 'channels':
+            channels = [int(c) for c in text.split(',') if c]
+        elif key == 'tier':
+            tier = text or None
+        elif key == 'batch':
+            batch = max(int(text), 1)
+        else:
+            raise ValueError('unknown key '+key)
+    return channels, tier, batch
+
+
+class StreamServer:
+    def __init__(self, pico, address=('127.0.0.1', 9465)):
+        '''serves the blocks of pico in a background thread
+        address: (host, port) for TCP, port 0 picks a free one, or a path for a Unix socket'''
+        self.pico = pico
+        self.publisher = pico.publish()
+        self.stopping = threading.Event()
+        self.clients = {}
+        self.lock = threading.Lock()
+        streamserver = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                streamserver.serve_client(self.request, self.rfile, self.client_address)
+
+        if isinstance(address, str):
+            if os.path.exists(address):
+                os.remove(address)
+            self.server = UnixServer(address, Handler)
+        else:
+            self.server = TCPServer(address, Handler)
+        self.address = self.server.server_address
+        thread = threading.Thread(target=self.server.serve_forever, name='Stream server')
+        thread.daemon = True
+        thread.start()
+
+    def serve_client(self, sock, rfile, address):
+        try:
+            channels, tier, batch = parse_request(rfile.readline(1024).decode('ascii', 'replace'))
+            rows, kinds, tiers = self.select(channels, tier)
+        except ValueError as e:
+            sock.sendall(('error '+str(e)+'\n').encode())
+            return
+        if sock.family != getattr(socket, 'AF_UNIX', None):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        channelList = ','.join(str(self.pico.row_channels[row]) for row in rows)
+        answer = 'ok channels='+channelList
+        if tiers:
+            answer += ' tier='+tier+' factor='+str(tiers[0][1])
+        sock.sendall((answer+'\n').encode())
+
+        subscriber = Subscriber(self.publisher.name)
+        stats = {'address':str(address), 'channels':channelList, 'tier':tier, 'frames':0, 'bytes':0}
+        with self.lock:
+            self.clients[id(stats)] = (stats, subscriber)
+        try:
+            self.stream(sock, subscriber, rows, kinds, tiers, batch, stats)
+        except OSError:
+            # the client went away
+            pass
+        finally:
+            with self.lock:
+                del self.clients[id(stats)]
+            subscriber.close()
+
+    def select(self, channels, tier):
+        '''rows of the published blocks, the kind of their values and the tier for a request'''
+        rowChannels = self.pico.row_channels
+        if channels is None:
+            channels = sorted(set(rowChannels))
+        for channel in channels:
+            if channel not in rowChannels:
+                raise ValueError('channel '+str(channel)+' is not streamed')
+        rows = [row for row, channel in enumerate(rowChannels) if channel in channels]
+        # a channel with two rows is the aggregate mode: maxima, then minima
+        kinds = [KIND_SAMPLES if rowChannels.count(rowChannels[row]) == 1 else
+                 (KIND_MAX if rowChannels.index(rowChannels[row]) == row else KIND_MIN) for row in rows]
+        tiers = []
+        if tier is not None:
+            tiers = parse_tiers(tier)
+            if len(tiers) != 1:
+                raise ValueError('one tier like minmax100 or mean10000')
+        return rows, kinds, tiers
+
+    def stream(self, sock, subscriber, rows, kinds, tiers, batch, stats):
+        factors, offsets = self.pico.get_channel_scales()
+        channels = [self.pico.row_channels[row] for row in rows]
+        allRows = rows == list(range(len(self.pico.row_channels)))
+        decimator = None
+        lost = 0
+        while not self.stopping.is_set() and not subscriber.is_closed():
+            end = time.perf_counter()+BATCH_LATENCY
+            while subscriber.available() < batch and time.perf_counter() < end and not self.stopping.is_set():
+                time.sleep(SUBSCRIBER_POLL)
+
+            frames = []
+            values = []
+            while True:
+                # up to the end of the ring, so the data is a view and not a copy
+                data = subscriber.read(subscriber.capacity-subscriber.cursor % subscriber.capacity)
+                if data is None:
+                    break
+                index = subscriber.read_start
+                if tiers:
+                    if decimator is None or subscriber.lost != lost:
+                        # the tier restarts after lost samples
+                        decimator = Decimator(len(rows), tiers, origin=index)
+                        lost = subscriber.lost
+                    decimator.process(data if allRows else data[rows])
+                    continue
+                for i, row in enumerate(rows):
+                    frames.append((FRAME_MAGIC, channels[i], kinds[i], index, subscriber.get_sample_time_ns(index), 1,
+                                   data.shape[1], factors[row], offsets[row], 2*data.shape[1], 0))
+                    values.append(data[row].view(np.uint8))
+
+            if decimator is not None:
+                kind, factor = tiers[0]
+                name = kind+str(factor)
+                tierdata = decimator.get_data(name)
+                if tierdata is not None:
+                    index = decimator.get_start(name)
+                    if kind == 'minmax':
+                        tierkinds = [(i, KIND_MAX) for i in range(len(rows))]+[(i, KIND_MIN) for i in range(len(rows))]
+                    else:
+                        tierkinds = [(i, KIND_MEAN) for i in range(len(rows))]
+                    for tierrow, (i, tierkind) in enumerate(tierkinds):
+                        row = tierdata[tierrow]
+                        frames.append((FRAME_MAGIC, channels[i], tierkind, index, subscriber.get_sample_time_ns(index), factor,
+                                       row.shape[0], factors[rows[i]], offsets[rows[i]], row.nbytes, 0))
+                        values.append(np.ascontiguousarray(row).view(np.uint8))
+
+            if not frames:
+                continue
+            headers = np.array(frames, dtype=FRAME_DTYPE).view(np.uint8)
+            size = FRAME_DTYPE.itemsize
+            buffers = []
+            for i, payload in enumerate(values):
+                buffers.append(headers[i*size:(i+1)*size])
+                buffers.append(payload)
+            send_buffers(sock, buffers)
+            stats['frames'] += len(frames)
+            stats['bytes'] += len(headers)+sum(len(payload) for payload in values)
+        if self.stopping.is_set() or subscriber.is_closed():
+            sock.shutdown(socket.SHUT_RDWR)
+
+    def get_stats(self):
+        '''one dict per connected client: frames and bytes sent, samples lost and overwritten'''
+        with self.lock:
+            clients = list(self.clients.values())
+        return [dict(stats, **subscriber.get_stats()) for stats, subscriber in clients]
+
+    def close(self):
+        self.stopping.set()
+        self.server.shutdown()
+        self.server.server_close()
+        if isinstance(self.address, str) and os.path.exists(self.address):
+            os.remove(self.address)
+
+
+class StreamClient:
+    def __init__(self, address, channels=None, tier=None, batch=None):
+        '''connects to a StreamServer | channels: channel numbers, None for all
+        tier: e.g. 'minmax100' or 'mean10000', None for the full rate | batch: values per channel and batch'''
+        if isinstance(address, str):
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.connect(address)
+        request = []
+        if channels is not None:
+            request.append('channels='+','.join(str(c) for c in channels))
+        if tier is not None:
+            request.append('tier='+tier)
+        if batch is not None:
+            request.append('batch='+str(batch))
+        self.sock.sendall((' '.join(request)+'\n').encode())
+
+        answer = b''
+        while not answer.endswith(b'\n'):
+            chunk = self.sock.recv(1)
+            if not chunk:
+                break
+            answer += chunk
+        answer = answer.decode().strip()
+        if not answer.startswith('ok'):
+            self.sock.close()
+            raise ValueError(answer)
+        self.info = dict(item.partition('=')[::2] for item in answer.split()[1:])
+        self.header = np.zeros(1, dtype=FRAME_DTYPE)
+
+    def receive_into(self, buffer):
+        view = memoryview(buffer).cast('B')
+        received = 0
+        while received < len(view):
+            n = self.sock.recv_into(view[received:])
+            if n == 0:
+                return False
+            received += n
+        return True
+
+    def read(self):
+        '''next frame as (header, values), None when the server closed the stream
+        values are int16 counts or float32 means (KIND_MEAN), volts = values*scale - offset'''
+        if not self.receive_into(self.header):
+            return None
+        header = self.header[0].copy()
+        if header['magic'] != FRAME_MAGIC:
+            raise ValueError('not a DRDAQ stream frame')
+        values = np.empty(int(header['count']), dtype=np.float32 if header['kind'] == KIND_MEAN else np.int16)
+        if not self.receive_into(values):
+            return None
+        return header, values
+
+    def close(self):
+        self.sock.close()
+
+
+def client_process(address, seconds, results, channels=None, tier=None):
+    client = StreamClient(address, channels, tier)
+    samples = 0
+    frames = 0
+    continuous = True
+    expected = {}
+    end = time.perf_counter()+seconds
+    while time.perf_counter() < end:
+        frame = client.read()
+        if frame is None:
+            break
+        header, values = frame
+        channel = (int(header['channel']), int(header['kind']))
+        if channel in expected and expected[channel] != header['sample_index']:
+            continuous = False
+        expected[channel] = int(header['sample_index'])+len(values)*int(header['factor'])
+        samples += len(values)
+        frames += 1
+    client.close()
+    results.put({'samples':samples, 'frames':frames, 'continuous':continuous})
+
+
+if __name__ == '__main__':
+    # Loopback benchmark: a simulated DRDAQ streams to several client processes
+    import argparse
+    import multiprocessing
+    import DrDAQ
+    from simdriver import SimulatedLibrary
+
+    parser = argparse.ArgumentParser(description='Stream a simulated DRDAQ to clients on localhost')
+    parser.add_argument('--clients', type=int, default=3)
+    parser.add_argument('--seconds', type=float, default=5.0)
+    parser.add_argument('--speed', type=float, default=1.0, help='factor to the real time sample rate')
+    parser.add_argument('--unix', help='Unix socket path instead of a TCP port')
+    parser.add_argument('--tier', help='decimation tier for the clients, e.g. minmax100')
+    args = parser.parse_args()
+
+    pico = DrDAQ.DRDAQ(lib=SimulatedLibrary(speed=args.speed))
+    server = pico.serve_stream(args.unix or ('127.0.0.1', 0))
+    results = multiprocessing.Queue()
+    # the clients read until the server closes the connections
+    processes = [multiprocessing.Process(target=client_process, args=(server.address, args.seconds+10, results, None, args.tier))
+                 for i in range(args.clients)]
+    for process in processes:
+        process.start()
+    try:
+        time.sleep(0.5)
+        pico.run_streaming()
+        written = pico.publisher.write_count
+        started = time.perf_counter()
+        time.sleep(args.seconds)
+        stats = server.get_stats()
+        rate = (pico.publisher.write_count-written)/(time.perf_counter()-started)
+        pico.stop_sampling()
+        pico.stop_serving_stream()
+        for process in processes:
+            result = results.get(timeout=args.seconds+5)
+            print(' Client: %d values in %d frames, continuous: %s' % (result['samples'], result['frames'], result['continuous']))
+        for client in stats:
+            print(' Server: %(frames)d frames, %(bytes)d bytes, %(lost)d lost, %(overwritten)d overwritten' % client)
+        print(' Published: %.0f samples/s per channel, %d channels' % (rate, pico.publisher.data.shape[0]))
+    finally:
+        for process in processes:
+            process.join()
+        pico.close_unit()
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the software triggers, run with python -m pytest tests
+"""
+
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from trigger import RMSDeviationTrigger
+
+CYCLE = 1000
+AMPLITUDE = 10000.0
+
+
+def mains(amplitudes):
+    '''one (1, samples) block with one sine cycle per amplitude'''
+    phase = 2*np.pi*np.arange(CYCLE)/CYCLE
+    signal = np.concatenate([amplitude*np.sin(phase) for amplitude in amplitudes])
+    return np.round(signal).astype(np.int16)[np.newaxis,:]
+
+
+def feed(trigger, block, blockSamples=700):
+    hits = [trigger.find(block[:,i:i+blockSamples], i) for i in range(0, block.shape[1], blockSamples)]
+    return np.concatenate(hits)
+
+
+def test_steady_signal_does_not_trigger():
+    trigger = RMSDeviationTrigger(CYCLE, deviation=0.1)
+    assert len(feed(trigger, mains([AMPLITUDE]*50))) == 0
+
+
+def test_gradual_sag_triggers():
+    # 30 % sag, 3 % more in each of 10 cycles: neighbouring cycles differ by far less than the limit
+    sag = [AMPLITUDE*(1-0.03*i) for i in range(1, 11)]
+    block = mains([AMPLITUDE]*10 + sag + [0.7*AMPLITUDE]*10)
+    for adaptation in (0.0, 0.02):
+        hits = feed(RMSDeviationTrigger(CYCLE, deviation=0.1, adaptation=adaptation), block)
+        assert len(hits) > 0
+        # not before the sag passed 10 %
+        assert hits[0] >= 13*CYCLE
+        assert np.all(hits % CYCLE == 0)
+
+
+def test_reference_cycle_is_not_adapted_while_triggered():
+    trigger = RMSDeviationTrigger(CYCLE, deviation=0.1, adaptation=0.5)
+    hits = feed(trigger, mains([AMPLITUDE]*5 + [0.5*AMPLITUDE]*20))
+    # with the reference frozen the sag triggers in every cycle
+    assert len(hits) == 20
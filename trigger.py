@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+"""
+Triggered capture: keep only the data around events
+
+Software triggers look at one row of every (channels, samples) block and
+return the sample indices of their events:
+ - LevelTrigger:         the signal crosses a level
+ - SlopeTrigger:         the signal changes faster than a limit between two samples
+ - RMSDeviationTrigger:  a cycle differs from a reference cycle by more than a
+                         fraction of the reference RMS
+Hardware triggers of the scope (DRDAQ.set_simple_trigger) are added with
+EventCapture.add_events(DRDAQ.get_trigger_events()).
+
+EventCapture keeps the last samples in a HistoryBuffer and writes a window of
+preSamples before to postSamples after every event to a Recorder, overlapping
+windows are merged. Everything else is never written.
+"""
+
+import numpy as np
+
+
+class LevelTrigger:
+    def __init__(self, level, row=0, rising=True):
+        '''level in counts | row: row of the blocks to look at | rising or falling crossings'''
+        self.level = level
+        self.row = row
+        self.rising = rising
+        self.previous = None
+
+    def find(self, block, sampleIndex):
+        x = block[self.row]
+        offset = 0
+        if self.previous is not None:
+            x = np.concatenate(([self.previous], x))
+            offset = -1
+        self.previous = x[-1]
+        if self.rising:
+            hits = np.flatnonzero((x[:-1] < self.level) & (x[1:] >= self.level))+1
+        else:
+            hits = np.flatnonzero((x[:-1] > self.level) & (x[1:] <= self.level))+1
+        return sampleIndex+offset+hits
+
+
+class SlopeTrigger:
+    def __init__(self, maxStep, row=0):
+        '''maxStep: largest normal difference of two neighbouring samples in counts'''
+        self.max_step = maxStep
+        self.row = row
+        self.previous = None
+
+    def find(self, block, sampleIndex):
+        x = block[self.row].astype(np.int32)
+        offset = 0
+        if self.previous is not None:
+            x = np.concatenate(([self.previous], x))
+            offset = -1
+        self.previous = x[-1]
+        hits = np.flatnonzero(np.abs(np.diff(x)) > self.max_step)+1
+        # only the first sample of every run of steep samples
+        hits = hits[np.diff(hits, prepend=-2) > 1]
+        return sampleIndex+offset+hits
+
+
+class RMSDeviationTrigger:
+    def __init__(self, samplesPerCycle, deviation=0.1, row=0, reference=None, adaptation=0.02):
+        '''samplesPerCycle: nominal mains cycle length | deviation: RMS of the difference to the reference cycle
+        as fraction of the reference RMS | reference: samples of a normal cycle in counts, the first cycle if None
+        adaptation: weight of a new cycle in the reference (exponential mean, follows slow phase and amplitude
+        changes), cycles that trigger are never taken in, 0 keeps the reference fixed'''
+        self.cycle = int(samplesPerCycle)
+        self.deviation = deviation
+        self.row = row
+        self.adaptation = adaptation
+        self.reference = None
+        if reference is not None:
+            self.reference = np.array(reference, dtype=np.float64)
+        self.carry = np.zeros(0, dtype=np.float32)
+
+    def find(self, block, sampleIndex):
+        x = np.concatenate((self.carry, block[self.row].astype(np.float32)))
+        first = sampleIndex-len(self.carry)
+        ncycles = len(x)//self.cycle
+        self.carry = x[ncycles*self.cycle:]
+        cycles = x[:ncycles*self.cycle].reshape(ncycles, self.cycle)
+
+        hits = []
+        for i, cycle in enumerate(cycles):
+            if self.reference is None:
+                self.reference = cycle.astype(np.float64)
+                continue
+            limit = self.deviation*np.sqrt(np.mean(self.reference**2))
+            if np.sqrt(np.mean((cycle-self.reference)**2)) > limit:
+                hits.append(first+i*self.cycle)
+            elif self.adaptation:
+                self.reference += self.adaptation*(cycle-self.reference)
+        return np.array(hits, dtype=np.int64)
+
+
+class HistoryBuffer:
+    def __init__(self, channels, length, dtype=np.int16):
+        '''the last length samples of every channel, older ones are overwritten'''
+        self.data = np.zeros((channels,length), dtype=dtype)
+        self.length = length
+        # sample index after the last sample written, and of the oldest valid sample
+        self.end = 0
+        self.start = 0
+
+    def write(self, block, sampleIndex):
+        n = block.shape[1]
+        if sampleIndex != self.end:
+            # samples were lost, nothing before sampleIndex is valid any more
+            self.start = sampleIndex
+        if n > self.length:
+            block = block[:,-self.length:]
+            sampleIndex += n-self.length
+            n = self.length
+        position = sampleIndex % self.length
+        first = min(n, self.length-position)
+        self.data[:,position:position+first] = block[:,:first]
+        self.data[:,:n-first] = block[:,first:]
+        self.end = sampleIndex+n
+
+    def get(self, start, stop):
+        '''copy of the samples start..stop, as far as they are still in the buffer'''
+        start = max(start, self.end-self.length, self.start)
+        stop = min(stop, self.end)
+        if stop <= start:
+            return np.zeros((self.data.shape[0],0), dtype=self.data.dtype), start
+        indices = np.arange(start, stop) % self.length
+        return self.data[:,indices], start
+
+
+class EventCapture:
+    def __init__(self, channels, preSamples, postSamples, triggers=(), recorder=None,
+                 sampleInterval=None, startTime=None, historySamples=None):
+        '''channels: rows of the blocks | preSamples, postSamples: window around every event
+        recorder: recorder.Recorder the windows are written to
+        sampleInterval, startTime: to timestamp the windows, in seconds'''
+        self.pre = preSamples
+        self.post = postSamples
+        self.triggers = list(triggers)
+        self.recorder = recorder
+        self.sample_interval = sampleInterval
+        self.start_time = startTime
+        if historySamples is None:
+            historySamples = 2*(preSamples+postSamples)
+        self.history = HistoryBuffer(channels, historySamples)
+
+        # Windows [start, stop) waiting for their post trigger samples
+        self.pending = []
+        self.events = 0
+        self.windows = 0
+        self.samples_seen = 0
+        self.samples_stored = 0
+
+    def add_events(self, sampleIndices):
+        '''events from outside, e.g. hardware triggers'''
+        for event in sorted(sampleIndices):
+            self.events += 1
+            start, stop = event-self.pre, event+self.post
+            if self.pending and start <= self.pending[-1][1]:
+                self.pending[-1][1] = max(self.pending[-1][1], stop)
+            else:
+                self.pending.append([start, stop])
+
+    def process(self, block, sampleIndex):
+        '''feed the next block, returns the windows written as list of (start, data)'''
+        n = block.shape[1]
+        self.samples_seen += n
+        # the history must hold a whole window plus the new block
+        if n+self.pre+self.post > self.history.length:
+            history = HistoryBuffer(block.shape[0], 2*(n+self.pre+self.post), self.history.data.dtype)
+            data, start = self.history.get(self.history.end-self.history.length, self.history.end)
+            history.write(data, start)
+            self.history = history
+        self.history.write(block, sampleIndex)
+
+        events = []
+        for trigger in self.triggers:
+            events.extend(trigger.find(block, sampleIndex))
+        self.add_events(events)
+
+        written = []
+        while self.pending and self.pending[0][1] <= self.history.end:
+            start, stop = self.pending.pop(0)
+            data, start = self.history.get(start, stop)
+            if data.shape[1] == 0:
+                continue
+            if self.recorder is not None:
+                self.recorder.write(data, self.get_time(start), start)
+            self.windows += 1
+            self.samples_stored += data.shape[1]
+            written.append((start, data))
+        return written
+
+    def get_time(self, sampleIndex):
+        if self.sample_interval is None or self.start_time is None:
+            return 0.0
+        return self.start_time+sampleIndex*self.sample_interval
+
+    def get_stats(self):
+        return {'events':self.events,
+                'windows':self.windows,
+                'samples_seen':self.samples_seen,
+                'samples_stored':self.samples_stored,
+                'stored_fraction':self.samples_stored/max(self.samples_seen,1)}